@@ -0,0 +1,185 @@
+"""问答缓存：按 (图谱, 模式, 规范化问题) 缓存回答
+
+- 内存层：LRU + TTL；
+- 持久层（可选）：data/answer_cache.db，进程重启后仍可命中；条数上限按批淘汰（每写入约上限的 1/10 条检查一次，
+  超出时删除最旧与已过期的记录），不在每次写入时排序全表；
+- 每条缓存记录图谱数据版本（见 rag_service.graph_version），版本不一致即视为失效。
+"""
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from app.config import DATA_DIR
+
+CACHE_DB_PATH = DATA_DIR / "answer_cache.db"
+
+_WS_RE = re.compile(r"\s+")
+_TRAILING_PUNCT = "?？!！。.，,;；~～ "
+
+
+def normalize_query(text: str) -> str:
+    """全角转半角、小写、合并空白、去掉结尾标点，使仅有格式差异的问题共用缓存"""
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    t = _WS_RE.sub(" ", t).strip()
+    return t.rstrip(_TRAILING_PUNCT)
+
+
+class AnswerCache:
+    def __init__(self, db_path=CACHE_DB_PATH):
+        self.db_path = db_path
+        self.max_entries = 1000
+        self.ttl = 3600
+        self.persistent = False
+        self._mem: "OrderedDict[Tuple[int, str, str], Tuple[str, str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_ready = False
+        self._puts_since_evict = 0
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_entries: int, ttl: int, persistent: bool) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persistent = persistent
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        if not self._db_ready:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                graph_id INTEGER NOT NULL,
+                mode TEXT NOT NULL,
+                query_norm TEXT NOT NULL,
+                version TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (graph_id, mode, query_norm)
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_created ON answer_cache(created_at)")
+            conn.commit()
+            self._db_ready = True
+        return conn
+
+    def get(self, graph_id: int, mode: str, query_text: str, version: str) -> Optional[str]:
+        key = (graph_id, mode, normalize_query(query_text))
+        now = time.time()
+        with self._lock:
+            item = self._mem.get(key)
+            if item is not None:
+                answer, ver, created = item
+                if ver == version and (self.ttl <= 0 or now - created < self.ttl):
+                    self._mem.move_to_end(key)
+                    self.hits += 1
+                    return answer
+                del self._mem[key]
+        if self.persistent:
+            conn = self._conn()
+            try:
+                row = conn.execute(
+                    "SELECT answer, version, created_at FROM answer_cache WHERE graph_id = ? AND mode = ? AND query_norm = ?",
+                    key,
+                ).fetchone()
+                if row is not None:
+                    answer, ver, created = row
+                    if ver == version and (self.ttl <= 0 or now - created < self.ttl):
+                        with self._lock:
+                            self._put_mem(key, (answer, ver, created))
+                            self.hits += 1
+                        return answer
+                    conn.execute(
+                        "DELETE FROM answer_cache WHERE graph_id = ? AND mode = ? AND query_norm = ?", key
+                    )
+                    conn.commit()
+            finally:
+                conn.close()
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, graph_id: int, mode: str, query_text: str, version: str, answer: str) -> None:
+        if not answer or self.max_entries <= 0:
+            return
+        key = (graph_id, mode, normalize_query(query_text))
+        now = time.time()
+        with self._lock:
+            self._put_mem(key, (answer, version, now))
+        if self.persistent:
+            conn = self._conn()
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO answer_cache (graph_id, mode, query_norm, version, answer, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (*key, version, answer, now),
+                )
+                with self._lock:
+                    self._puts_since_evict += 1
+                    evict = self._puts_since_evict >= max(1, self.max_entries // 10)
+                    if evict:
+                        self._puts_since_evict = 0
+                if evict:
+                    self._evict(conn, now)
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        """持久层同样受条数上限约束：删除已过期的记录，仍超出时按写入时间删除最旧的"""
+        if self.ttl > 0:
+            conn.execute("DELETE FROM answer_cache WHERE created_at < ?", (now - self.ttl,))
+        (count,) = conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM answer_cache WHERE rowid IN (SELECT rowid FROM answer_cache ORDER BY created_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def _put_mem(self, key, item) -> None:
+        self._mem[key] = item
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def invalidate_graph(self, graph_id: int) -> None:
+        """删除某图谱的全部缓存（图谱被删除时调用；数据更新由版本号自动失效）"""
+        with self._lock:
+            for k in [k for k in self._mem if k[0] == graph_id]:
+                del self._mem[k]
+        if self.persistent or self._db_ready:
+            conn = self._conn()
+            try:
+                conn.execute("DELETE FROM answer_cache WHERE graph_id = ?", (graph_id,))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self.hits = 0
+            self.misses = 0
+        if self.persistent or self._db_ready:
+            conn = self._conn()
+            try:
+                conn.execute("DELETE FROM answer_cache")
+                conn.commit()
+            finally:
+                conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._mem),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "persistent": self.persistent,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+answer_cache = AnswerCache()
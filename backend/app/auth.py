@@ -9,7 +9,6 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
 from app.config import get_settings
 
-settings = get_settings()
 security = HTTPBearer(auto_error=False)
 
 # bcrypt 密码最大 72 字节
@@ -43,13 +42,13 @@ def create_access_token(username: str, role: str = "user") -> str:
     """role: 'admin' | 'user'"""
     expire = datetime.utcnow() + timedelta(hours=24)
     payload = {"sub": username, "exp": expire, "role": role}
-    return jwt.encode(payload, settings.secret_key, algorithm="HS256")
+    return jwt.encode(payload, get_settings().secret_key, algorithm="HS256")
 
 
 def decode_token(token: str) -> Optional[tuple[str, str]]:
     """成功返回 (username, role)，失败返回 None。"""
     try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=["HS256"])
+        payload = jwt.decode(token, get_settings().secret_key, algorithms=["HS256"])
         sub = payload.get("sub")
         role = payload.get("role", "user")
         if sub:
@@ -61,6 +60,7 @@ def decode_token(token: str) -> Optional[tuple[str, str]]:
 
 def verify_admin(username: str, password: str) -> bool:
     """管理员：与 .env 中的账号密码比对（明文比对，与现有逻辑一致）。"""
+    settings = get_settings()
     return username == settings.admin_username and password == settings.admin_password
 
 
@@ -72,7 +72,7 @@ async def get_current_admin(credentials: Optional[HTTPAuthorizationCredentials]
     if not decoded:
         raise HTTPException(status_code=401, detail="无效或过期的令牌")
     username, role = decoded
-    if role != "admin" or username != settings.admin_username:
+    if role != "admin" or username != get_settings().admin_username:
         raise HTTPException(status_code=401, detail="需要管理员权限")
     return username
 
@@ -0,0 +1,300 @@
+"""批量查询（评测集）：对一个图谱执行 JSONL 问题文件，逐条产出 JSONL 结果
+
+- 整个批次共用一个已加载的 LightRAG 实例（期间不会被实例池回收），同时进行的查询数受 concurrency 限制；
+  不经过回答缓存与并发合并，每个问题都真实执行一次；
+- 输入每行一个 JSON：{"id": "q1", "query": "...", "mode": "local"}，id 缺省为行号、mode 缺省为批次默认模式；
+  也可以直接是一个 JSON 字符串（只有问题）。空行忽略；
+- 结果按完成顺序产出：{"id", "query", "mode", "answer", "error", "status", "latency_ms"}，
+  同时逐行追加到结果文件；
+- 续跑：再次使用同一个结果文件时，跳过其中已成功（error 为空）的 id，失败的条目重新执行
+  （先把结果文件重写为只含成功条目）；
+- 计数：bypass_limit=False 时每条按普通查询预占图谱 daily_limit（满额后其余条目返回 429，失败退还）；
+  bypass_limit=True 时不占 daily_limit，改计入 batch_query_stats（管理端统计中的 batch_count）；
+- 命令行进程与服务进程共用计数：每次预占在 SQLite 写事务中检查并立即写入，计入服务进程已写入的次数，
+  不使用内存计数与 QUERY_STATS_JOURNAL 日志（服务进程最迟一个写入间隔后看到这些计数，见 app.database）。
+
+入口：管理端 POST /api/admin/graphs/{graph_id}/batch_query，或命令行（在 backend 目录下）：
+    python -m app.batch --graph-id 1 --input questions.jsonl --output results.jsonl [--resume] [--bypass-limit]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+from fastapi import HTTPException
+
+from app import database as _db
+from app import quota, tracing
+from app.config import DATA_DIR, get_settings
+from app.database import run_db, stat_counters
+from app.llm_scheduler import background
+from app.providers import use_reranker
+from app.rag_service import VALID_MODES, query_session
+
+BATCH_DIR = DATA_DIR / "batches"  # 管理端上传的批次：<batch_id>/{meta.json, input.jsonl, results.jsonl}
+MAX_CONCURRENCY = 32
+
+_BATCH_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_running: Set[str] = set()
+
+
+class BatchInputError(ValueError):
+    """输入文件格式错误（带行号）"""
+
+
+class StoredBatch:
+    """管理端批次在 data/batches 下的文件"""
+
+    def __init__(self, batch_id: str):
+        self.id = batch_id
+        self.dir = BATCH_DIR / batch_id
+        self.meta_path = self.dir / "meta.json"
+        self.input_path = self.dir / "input.jsonl"
+        self.results_path = self.dir / "results.jsonl"
+
+    @classmethod
+    def create(cls, graph_id: int, mode: str) -> "StoredBatch":
+        batch = cls(uuid.uuid4().hex)
+        batch.dir.mkdir(parents=True, exist_ok=True)
+        batch.meta = {"graph_id": graph_id, "mode": mode, "created_at": datetime.now(timezone.utc).isoformat()}
+        batch.meta_path.write_text(json.dumps(batch.meta), encoding="utf-8")
+        return batch
+
+    @classmethod
+    def open(cls, batch_id: str) -> Optional["StoredBatch"]:
+        """已有批次；batch_id 格式不对或不存在时返回 None"""
+        if not _BATCH_ID_RE.match(batch_id or ""):
+            return None
+        batch = cls(batch_id)
+        try:
+            batch.meta = json.loads(batch.meta_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return batch
+
+    def claim(self) -> bool:
+        """同一批次同时只能有一次执行（否则结果文件会交错写入）"""
+        if self.id in _running:
+            return False
+        _running.add(self.id)
+        return True
+
+    def release(self) -> None:
+        _running.discard(self.id)
+
+
+def _item_key(item_id: Any) -> str:
+    # 输入中的 id 可能是数字或字符串，续跑时按字符串比较
+    return str(item_id)
+
+
+def read_items(path: Path, default_mode: str = "hybrid") -> List[Dict[str, Any]]:
+    """解析 JSONL 问题文件，返回 [{"id", "query", "mode"}]；格式错误抛出 BatchInputError"""
+    items: List[Dict[str, Any]] = []
+    seen: Set[str] = set()
+    with open(path, "r", encoding="utf-8-sig") as fp:
+        for lineno, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise BatchInputError(f"第 {lineno} 行不是合法的 JSON：{e.msg}")
+            if isinstance(obj, str):
+                obj = {"query": obj}
+            if not isinstance(obj, dict):
+                raise BatchInputError(f"第 {lineno} 行应为 JSON 对象或字符串")
+            query_text = obj.get("query")
+            if not isinstance(query_text, str) or not query_text.strip():
+                raise BatchInputError(f"第 {lineno} 行缺少 query")
+            item_id = obj.get("id", lineno)
+            if _item_key(item_id) in seen:
+                raise BatchInputError(f"第 {lineno} 行的 id 重复：{item_id}")
+            seen.add(_item_key(item_id))
+            mode = obj.get("mode") or default_mode
+            mode = mode.strip().lower() if isinstance(mode, str) else mode
+            if mode not in VALID_MODES:
+                raise BatchInputError(f"第 {lineno} 行的 mode 无效：{mode}（可选 {' / '.join(VALID_MODES)}）")
+            items.append({"id": item_id, "query": query_text.strip(), "mode": mode})
+    if not items:
+        raise BatchInputError("文件中没有问题")
+    return items
+
+
+def load_completed(results_path: Path) -> Set[str]:
+    """读取已有结果文件，返回已成功的 id；同时把文件重写为只含成功条目（失败条目将重新执行）"""
+    if not results_path.exists():
+        return set()
+    done: Set[str] = set()
+    kept: List[str] = []
+    with open(results_path, "r", encoding="utf-8") as fp:
+        for line in fp:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 上次中断时写了一半的行
+            if isinstance(rec, dict) and rec.get("error") is None and _item_key(rec.get("id")) not in done:
+                done.add(_item_key(rec.get("id")))
+                kept.append(line if line.endswith("\n") else line + "\n")
+    tmp = results_path.with_name(results_path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as fp:
+        fp.writelines(kept)
+    os.replace(tmp, results_path)
+    return done
+
+
+async def _meter_batch(graph_id: int) -> None:
+    if stat_counters.write_through:
+        await run_db(_db.batch_stat_inc, graph_id)
+    else:
+        _db.batch_stat_inc(graph_id)
+
+
+async def _run_item(ask, graph: Dict[str, Any], item: Dict[str, Any], bypass_limit: bool) -> Dict[str, Any]:
+    rec: Dict[str, Any] = {**item, "answer": None, "error": None, "status": 200}
+    started = time.perf_counter()
+    res: Optional[quota.Reservation] = None
+    try:
+        async with tracing.traced("batch", graph["id"], item["mode"]):
+            with tracing.span("quota"):
+                if bypass_limit:
+                    await _meter_batch(graph["id"])
+                else:
+                    res = await quota.reserve(graph, None)
+            # 批量查询的 LLM 调用按后台优先级调度，不挤占在线查询
+            with use_reranker(graph.get("rerank_backend")), background():
+                answer = await ask(item["query"], item["mode"])
+            if not answer:
+                raise RuntimeError("模型返回为空")
+            rec["answer"] = answer
+    except HTTPException as e:
+        rec.update(error=e.detail, status=e.status_code)
+    except Exception as e:
+        rec.update(error=f"查询失败: {e}", status=500)
+    finally:
+        # 失败或被取消（客户端断开）时退还预占
+        if res is not None and rec["answer"] is None:
+            await quota.refund(res)
+    rec["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return rec
+
+
+async def run_batch(
+    graph: Dict[str, Any],
+    items: List[Dict[str, Any]],
+    concurrency: Optional[int] = None,
+    bypass_limit: bool = False,
+    results_path: Optional[Path] = None,
+    skip: Optional[Set[str]] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """执行批次，按完成顺序产出结果并追加到 results_path；skip 为已完成的 id（见 load_completed）。
+    调用方停止迭代时取消未完成的查询，已写入结果文件的条目可续跑"""
+    todo = [it for it in items if not skip or _item_key(it["id"]) not in skip]
+    if not todo:
+        return
+    concurrency = max(1, min(concurrency or get_settings().batch_query_concurrency, MAX_CONCURRENCY))
+    out = None
+    if results_path is not None:
+        results_path.parent.mkdir(parents=True, exist_ok=True)
+        out = open(results_path, "a", encoding="utf-8")
+    try:
+        async with query_session(graph["working_dir"]) as ask:
+            results: asyncio.Queue = asyncio.Queue()
+            pending = iter(todo)
+
+            async def worker() -> None:
+                for item in pending:
+                    await results.put(await _run_item(ask, graph, item, bypass_limit))
+
+            workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(todo)))]
+            try:
+                for _ in range(len(todo)):
+                    rec = await results.get()
+                    if out is not None:
+                        out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                        out.flush()
+                    yield rec
+            finally:
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+    finally:
+        if out is not None:
+            out.close()
+
+
+async def _main(args: argparse.Namespace) -> int:
+    graph = await run_db(_db.graph_get, args.graph_id)
+    if not graph:
+        print(f"图谱不存在：{args.graph_id}", file=sys.stderr)
+        return 1
+    try:
+        items = read_items(Path(args.input), args.mode)
+    except (OSError, BatchInputError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    output = Path(args.output)
+    if output.exists() and not args.resume:
+        print(f"结果文件已存在：{output}（续跑请加 --resume）", file=sys.stderr)
+        return 1
+    skip = load_completed(output) if args.resume else set()
+    total = len(items) - len(skip & {_item_key(it["id"]) for it in items})
+    print(f"共 {len(items)} 条，跳过已完成 {len(items) - total} 条", file=sys.stderr)
+    failed = 0
+    n = 0
+    async for rec in run_batch(graph, items, args.concurrency, args.bypass_limit, output, skip):
+        n += 1
+        if rec["error"] is not None:
+            failed += 1
+        print(f"[{n}/{total}] {rec['id']} {rec['mode']} {rec['latency_ms']}ms"
+              + (f" 失败：{rec['error']}" if rec["error"] is not None else ""), file=sys.stderr)
+    print(f"完成 {n} 条，失败 {failed} 条；结果：{output}", file=sys.stderr)
+    return 0 if failed == 0 else 2
+
+
+async def _run_cli(args: argparse.Namespace) -> int:
+    from app.http_client import http_clients
+    from app.rag_service import rag_pool
+
+    try:
+        return await _main(args)
+    finally:
+        await rag_pool.close_all()
+        await http_clients.close()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m app.batch", description="对一个图谱批量执行 JSONL 问题文件")
+    parser.add_argument("--graph-id", type=int, required=True, help="图谱 ID")
+    parser.add_argument("--input", required=True, help="问题文件（JSONL）")
+    parser.add_argument("--output", required=True, help="结果文件（JSONL）；续跑时跳过其中已成功的 id")
+    parser.add_argument("--mode", default="hybrid", choices=VALID_MODES, help="未指定 mode 的条目使用的模式")
+    parser.add_argument("--concurrency", type=int, default=None, help="同时进行的查询数（默认 BATCH_QUERY_CONCURRENCY）")
+    parser.add_argument("--resume", action="store_true", help="结果文件已存在时续跑")
+    parser.add_argument("--bypass-limit", action="store_true", help="不占 daily_limit，单独计入批量查询次数")
+    args = parser.parse_args(argv)
+
+    from app.config import ensure_dirs
+    ensure_dirs()
+    # 须在 init_db 之前设置：init_db 会按配置设置计数模式并回放日志
+    stat_counters.shared = True
+    _db.init_db()
+    try:
+        return asyncio.run(_run_cli(args))
+    finally:
+        # 退出前写入内存中的批量查询计数
+        stat_counters.close()
+        _db.close_pool()
+        _db.shutdown_executor()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
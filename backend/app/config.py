@@ -1,14 +1,26 @@
-"""应用配置 - 从 .env 加载"""
+"""应用配置 - 从 .env 加载
+
+配置在进程内只解析一次并共享；.env 修改后（后台按 mtime 定时检查，或管理端写入 .env 后显式调用
+reload_settings）重新加载，并通知 on_settings_change 注册的监听者重建依赖配置的客户端与实例。
+"""
+import logging
+import os
+import threading
 from pathlib import Path
+from typing import Callable, List, Optional, Set
 
 from pydantic_settings import BaseSettings
 
 
 # 项目根目录（backend 的上一级）
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
-# 数据目录：存放各图谱的 working_dir 和元数据
-DATA_DIR = PROJECT_ROOT / "data"
+# 数据目录：存放各图谱的 working_dir 和元数据（可用进程环境变量 RAG_DATA_DIR 指定其他目录，如压测时使用临时目录）
+DATA_DIR = Path(os.environ["RAG_DATA_DIR"]).resolve() if os.environ.get("RAG_DATA_DIR") else PROJECT_ROOT / "data"
 GRAPHS_DIR = DATA_DIR / "graphs"  # 每个图谱一个子目录 graph_<id>
+ENV_PATH = PROJECT_ROOT / ".env"
+SETTINGS_POLL_INTERVAL = 2  # 秒，后台检查 .env 是否变化的间隔
+
+logger = logging.getLogger(__name__)
 
 
 class Settings(BaseSettings):
@@ -20,6 +32,7 @@ class Settings(BaseSettings):
     siliconcloud_api_key: str = ""
     siliconcloud_embedding_model: str = "BAAI/bge-m3"
     siliconcloud_rerank_model: str = "BAAI/bge-reranker-v2-m3"
+    siliconcloud_api_base: str = "https://api.siliconflow.cn/v1"  # 硅基流动 OpenAI 兼容接口（embeddings / rerank）
 
     # 管理员
     admin_username: str = "admin"
@@ -28,15 +41,164 @@ class Settings(BaseSettings):
 
     # 数据库
     database_url: str = ""
+    db_pool_size: int = 8  # SQLite 连接池大小
+    db_busy_timeout_ms: int = 5000  # 等待写锁的最长时间
+    db_mmap_size_mb: int = 64
+    db_cached_statements: int = 128  # 每个连接缓存的预编译语句数
+
+    # 查询计数写回（见 app/database.py 查询统计）
+    query_stats_flush_interval: float = 2  # 秒，内存计数批量写入 SQLite 的间隔；0 表示每次立即写入
+    query_stats_journal: bool = False  # 计数先追加到 data/query_stats.journal，进程崩溃后启动时回放
+
+    # 图谱目录缓存（/graphs、/graphs_with_usage）
+    graph_catalog_ttl: float = 60  # 秒，缓存最长有效期；本进程内的图谱修改会立即失效
+
+    # 查询记录写入队列与清理（见 app/database.py 查询记录）
+    history_flush_interval: float = 1  # 秒，队列批量写入间隔
+    history_batch_size: int = 100  # 攒满该条数时立即写入
+    history_compress_min_bytes: int = 1024  # 回答超过该字节数时 zlib 压缩存储；0 表示不压缩
+    history_purge_interval: int = 3600  # 秒，后台删除 7 天前记录的间隔
+
+    # LightRAG 实例池（按 working_dir 复用已加载的图谱）
+    rag_pool_max_instances: int = 8
+    rag_pool_idle_ttl: int = 1800  # 秒，空闲超过该时长的实例被回收；0 表示不按空闲回收
+    rag_pool_memory_budget_mb: int = 2048  # 按存储文件大小估算的总内存预算；0 表示不限制
+
+    # 后台导入任务
+    ingest_workers: int = 2  # 同时执行的导入任务数；同一图谱的任务始终串行
+    ingest_batch_docs: int = 8  # 每次交给 LightRAG 的文档数，批内按 MAX_PARALLEL_INSERT 并行处理；每批后更新进度
+
+    # 上传大小上限（MB，0 表示不限制）；文件按块落盘，内存占用与文件大小无关
+    upload_max_file_mb: int = 200
+    upload_max_request_mb: int = 2048
+
+    # 上游 HTTP 连接池（每个上游一个会话，见 app/http_client.py）
+    http_pool_limit: int = 100  # 每个上游的最大连接数
+    http_pool_limit_per_host: int = 32
+    http_keepalive_timeout: float = 60  # 秒，空闲连接保留时长
+    http_connect_timeout: float = 10
+    http_request_timeout: float = 120  # 未单独指定时的请求总超时
+    http_max_retries: int = 3  # 429 / 5xx / 连接错误的最大重试次数
+    http_retry_backoff: float = 0.5  # 首次重试的退避基准（秒），指数增长并加随机抖动
+    http_retry_backoff_max: float = 8
+    llm_timeout: float = 180  # DeepSeek 单次请求超时；流式时为两次读取的最长间隔
+    embedding_timeout: float = 60
+    rerank_timeout: float = 30
+
+    # DeepSeek 调用调度（见 app/llm_scheduler.py，进程内所有图谱共用）
+    llm_max_concurrency: int = 16  # 同时在途的 LLM 请求上限；遇到 429 时自动收窄，之后逐步恢复
+    llm_background_max_concurrency: int = 8  # 其中导入任务与批量查询最多占用的数量，其余留给在线查询
+    llm_rpm: int = 0  # 每分钟请求数上限；0 表示不限制
+    llm_tpm: int = 0  # 每分钟 token 数上限（发出前按文本长度估算，完成后按实际用量校正）；0 表示不限制
+    llm_aimd_decrease: float = 0.5  # 收到 429 时并发窗口乘以该系数
+
+    # Embedding 服务层（见 app/embedding_service.py）
+    embedding_batch_size: int = 32  # 合批后每次上游请求的最大文本数
+    embedding_batch_wait_ms: int = 10  # 合批等待窗口
+    embedding_concurrency: int = 4  # 同时在途的 embedding 请求数
+    embedding_cache_enabled: bool = True  # 按文本哈希缓存向量到 data/embedding_cache/
+
+    # Embedding / Rerank 提供方（见 app/providers.py）：http 为 OpenAI 兼容接口，local 为本进程内的 sentence-transformers 模型
+    embedding_provider: str = "http"
+    embedding_api_base: str = ""  # 空表示沿用 SILICONCLOUD_API_BASE；设置后使用独立连接池，可指向集群内服务
+    embedding_api_key: str = ""  # 空表示沿用 SILICONCLOUD_API_KEY（单独配置地址时可留空）
+    embedding_dim: int = 1024  # 向量维度，须与已有图谱的向量库一致（启动时检查，不一致的图谱拒绝加载）
+    embedding_max_token_size: int = 8192
+    rerank_provider: str = "http"  # 另有 bm25：对候选文本本地计算 BM25，不经网络；图谱与单次请求可另选
+    rerank_budget_ms: int = 0  # 所选 rerank 后端超过该耗时即改用 RERANK_FALLBACK；0 表示不限时（出错时仍降级）
+    rerank_fallback: str = "bm25"  # 超时或出错时使用的后端；留空表示不降级（出错即失败）
+    rerank_api_base: str = ""  # 空表示沿用 SILICONCLOUD_API_BASE
+    rerank_api_key: str = ""  # 空表示沿用 SILICONCLOUD_API_KEY
+    rerank_batch_size: int = 0  # 单次 rerank 调用的最大文档数，超过时拆分后合并；0 表示不拆分
+    rerank_concurrency: int = 4  # 同时进行的 rerank 调用数
+    local_model_device: str = "cpu"  # 本地模型的推理设备（cpu / cuda）
+
+    # 问答缓存（按 图谱 + 模式 + 规范化问题）
+    answer_cache_max_entries: int = 1000  # 0 表示关闭缓存
+    answer_cache_ttl: int = 3600  # 秒；0 表示不过期（图谱数据变化时仍会失效）
+    answer_cache_persistent: bool = False  # 同时写入 data/answer_cache.db，重启后仍可命中
+    answer_cache_count_hits: bool = True  # 命中缓存是否计入每日查询次数
+    singleflight_count_shared: bool = True  # 相同问题并发合并为一次查询时，跟随者是否各自计入每日查询次数
+    user_daily_limit: int = 0  # 每个登录用户每日查询次数上限（跨图谱合计）；0 表示不限制
+
+    # 多图谱查询（/api/query/multi）
+    multi_query_concurrency: int = 4  # 同时查询的图谱数
+    multi_query_max_graphs: int = 10  # 单次请求最多图谱数
+    multi_query_top_n: int = 20  # 合并模式下 rerank 后保留的资料段数
+
+    # 只检索查询（/api/query/context：返回实体、关系、文本块，不调用 LLM 生成回答）
+    context_daily_limit: int = 0  # 每个图谱每日次数上限，与完整回答分开计数；0 表示不限制（仍计数）
+
+    # 查询耗时追踪（app.tracing，指标见 /api/admin/metrics）
+    server_timing: bool = False  # 查询响应带 Server-Timing 头（流式查询写在 usage 事件的 timings 中）
+
+    # 批量查询（app.batch：管理端上传 JSONL 或命令行 python -m app.batch）
+    batch_query_concurrency: int = 4  # 单个批次同时进行的查询数（共用同一个已加载的 LightRAG 实例）
+
+    # 语义缓存（问题向量余弦相似度超过阈值即复用回答；每次未命中精确缓存的查询多一次 embedding 调用）
+    semantic_cache_enabled: bool = False
+    semantic_cache_threshold: float = 0.95
+    semantic_cache_capacity: int = 512  # 每个图谱保留的问题数
 
     class Config:
-        env_file = PROJECT_ROOT / ".env"
+        env_file = ENV_PATH
         env_file_encoding = "utf-8"
         extra = "ignore"
 
 
+_settings: Optional[Settings] = None
+_settings_mtime: Optional[int] = None
+_settings_lock = threading.Lock()
+_listeners: List[Callable[[Settings, Settings, Set[str]], None]] = []
+
+
+def _env_mtime() -> Optional[int]:
+    try:
+        return ENV_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 def get_settings() -> Settings:
-    return Settings()
+    """进程内共享的配置对象；稳定状态下不读文件"""
+    global _settings, _settings_mtime
+    s = _settings
+    if s is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings_mtime = _env_mtime()
+                _settings = Settings()
+            s = _settings
+    return s
+
+
+def on_settings_change(fn: Callable[[Settings, Settings, Set[str]], None]):
+    """注册配置变化监听者 fn(旧配置, 新配置, 变化的字段名)。可能在任意线程中调用，应只做同步的轻量操作"""
+    _listeners.append(fn)
+    return fn
+
+
+def reload_settings(force: bool = True) -> Set[str]:
+    """重新读取 .env 并替换共享配置，返回变化的字段名。force=False 时 .env 的 mtime 未变则直接返回"""
+    global _settings, _settings_mtime
+    with _settings_lock:
+        mtime = _env_mtime()
+        if not force and _settings is not None and mtime == _settings_mtime:
+            return set()
+        old, new = _settings, Settings()
+        _settings, _settings_mtime = new, mtime
+    if old is None:
+        return set()
+    old_values, new_values = old.model_dump(), new.model_dump()
+    changed = {k for k, v in new_values.items() if old_values.get(k) != v}
+    if changed:
+        logger.info("配置已重新加载，变化项: %s", ", ".join(sorted(changed)))
+        for fn in list(_listeners):
+            try:
+                fn(old, new, changed)
+            except Exception:
+                logger.exception("配置变化处理失败: %s", getattr(fn, "__name__", fn))
+    return changed
 
 
 def ensure_dirs():
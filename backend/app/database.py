@@ -1,18 +1,200 @@
-"""SQLite 数据库：图谱元数据、每日查询统计、用户、查询记录"""
+"""SQLite 数据库：图谱元数据、每日查询统计、用户、查询记录、后台导入任务"""
+import asyncio
+import base64
+import functools
+import hashlib
+import queue
 import sqlite3
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 from datetime import date, datetime, timedelta, timezone
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
-from app.config import PROJECT_ROOT, DATA_DIR, GRAPHS_DIR
+from app.config import PROJECT_ROOT, DATA_DIR, GRAPHS_DIR, get_settings, on_settings_change
 
 DB_PATH = DATA_DIR / "rag_web.db"
 
 
+# 写锁等待的统计（见 _Connection）：真实的 SQLite 锁竞争，区别于连接池的检出等待
+_lock_stats_lock = threading.Lock()
+_lock_waits = 0
+_lock_wait_seconds = 0.0
+LOCK_RETRY_MAX_SLEEP = 0.05  # 秒，锁等待的退避上限
+
+
+def _is_locked(e: sqlite3.OperationalError) -> bool:
+    return "database is locked" in str(e)
+
+
+class _Connection(sqlite3.Connection):
+    """SQLite 自身的 busy_timeout 设为 0：语句遇到写锁（database is locked）时在这里退避重试，直到 DB_BUSY_TIMEOUT_MS，
+    从而统计真实的锁等待次数与时长。只重试开启事务的第一条写语句（此时尚未持有锁，先回滚再重试即可）；
+    已持有写锁的事务内不会再等锁，与 SQLite 的行为一致直接报错"""
+
+    busy_timeout = 5.0  # 秒，创建时按配置设置
+
+    def execute(self, sql, parameters=()):
+        return self._retry(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._retry(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, script):
+        # 脚本中途失败无法整体重试，交给 SQLite 自身等待
+        super().execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        try:
+            return super().executescript(script)
+        finally:
+            super().execute("PRAGMA busy_timeout=0")
+
+    def _retry(self, fn, *args):
+        global _lock_waits, _lock_wait_seconds
+        fresh = not self.in_transaction
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if not fresh or not _is_locked(e):
+                raise
+        start = time.perf_counter()
+        delay = 0.001
+        try:
+            while True:
+                if self.in_transaction:
+                    self.rollback()
+                if time.perf_counter() - start + delay > self.busy_timeout:
+                    raise sqlite3.OperationalError("database is locked")
+                time.sleep(delay)
+                delay = min(delay * 2, LOCK_RETRY_MAX_SLEEP)
+                try:
+                    return fn(*args)
+                except sqlite3.OperationalError as e:
+                    if not _is_locked(e):
+                        raise
+        finally:
+            with _lock_stats_lock:
+                _lock_waits += 1
+                _lock_wait_seconds += time.perf_counter() - start
+
+
 def _get_conn():
+    """新建一个已设置 pragma 的连接：WAL 日志（读写互不阻塞）、synchronous=NORMAL（WAL 下仍安全，
+    仅检查点时 fsync）、mmap 读，以及连接级的预编译语句缓存；等待写锁由 _Connection 负责"""
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    return sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    settings = get_settings()
+    conn = sqlite3.connect(
+        str(DB_PATH),
+        check_same_thread=False,
+        timeout=0,
+        cached_statements=settings.db_cached_statements,
+        factory=_Connection,
+    )
+    conn.busy_timeout = settings.db_busy_timeout_ms / 1000
+    conn.execute("PRAGMA busy_timeout=0")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA mmap_size={int(settings.db_mmap_size_mb) * 1024 * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class _ConnectionPool:
+    """线程安全的连接池：FastAPI 线程池中的 def 路由各自检出一个连接，用完归还，不再每次 open/close"""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self, timeout: Optional[float] = None) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                conn = _get_conn()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            conn.row_factory = sqlite3.Row
+            return conn
+        # 池已满：等待其他请求归还
+        start = time.perf_counter()
+        try:
+            return self._idle.get(timeout=timeout)
+        finally:
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += time.perf_counter() - start
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close_all(self) -> None:
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "idle": self._idle.qsize(),
+                "checkout_waits": self.waits,
+                "checkout_wait_seconds": round(self.wait_seconds, 6),
+            }
+
+
+_pool: Optional[_ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> _ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _ConnectionPool(get_settings().db_pool_size)
+    return _pool
+
+
+def close_pool() -> None:
+    """关闭所有空闲连接（应用关闭时调用）"""
+    if _pool is not None:
+        _pool.close_all()
+
+
+def db_pool_stats() -> Dict[str, Any]:
+    """连接池状态（checkout_*：等待空闲连接）与写锁等待（lock_*：等待其他连接或进程释放 SQLite 写锁）"""
+    stats = _get_pool().stats()
+    with _lock_stats_lock:
+        stats["lock_waits"] = _lock_waits
+        stats["lock_wait_seconds"] = round(_lock_wait_seconds, 6)
+    return stats
 
 
 def init_db():
@@ -26,7 +208,8 @@ def init_db():
             description TEXT DEFAULT '',
             working_dir TEXT UNIQUE,
             daily_limit INTEGER DEFAULT 100,
-            created_at TEXT NOT NULL
+            created_at TEXT NOT NULL,
+            rerank_backend TEXT
         );
         CREATE TABLE IF NOT EXISTS query_stats (
             graph_id INTEGER NOT NULL,
@@ -35,6 +218,27 @@ def init_db():
             PRIMARY KEY (graph_id, stat_date),
             FOREIGN KEY (graph_id) REFERENCES graphs(id)
         );
+        CREATE TABLE IF NOT EXISTS user_query_stats (
+            user_id INTEGER NOT NULL,
+            stat_date TEXT NOT NULL,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, stat_date),
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        CREATE TABLE IF NOT EXISTS batch_query_stats (
+            graph_id INTEGER NOT NULL,
+            stat_date TEXT NOT NULL,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (graph_id, stat_date),
+            FOREIGN KEY (graph_id) REFERENCES graphs(id)
+        );
+        CREATE TABLE IF NOT EXISTS context_query_stats (
+            graph_id INTEGER NOT NULL,
+            stat_date TEXT NOT NULL,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (graph_id, stat_date),
+            FOREIGN KEY (graph_id) REFERENCES graphs(id)
+        );
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
@@ -51,18 +255,58 @@ def init_db():
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (graph_id) REFERENCES graphs(id)
         );
-        CREATE INDEX IF NOT EXISTS idx_query_history_user_graph ON query_history(user_id, graph_id);
+        -- 分页按 (created_at, id) 倒序：两个索引分别覆盖「用户 + 图谱」与「仅用户」的过滤与排序，每页为一次索引范围扫描
+        DROP INDEX IF EXISTS idx_query_history_user_graph;
+        CREATE INDEX IF NOT EXISTS idx_query_history_user_graph_time ON query_history(user_id, graph_id, created_at, id);
+        CREATE INDEX IF NOT EXISTS idx_query_history_user_time ON query_history(user_id, created_at, id);
         CREATE INDEX IF NOT EXISTS idx_query_history_created ON query_history(created_at);
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            graph_id INTEGER NOT NULL,
+            working_dir TEXT NOT NULL,
+            status TEXT NOT NULL,
+            docs_total INTEGER DEFAULT 0,
+            docs_done INTEGER DEFAULT 0,
+            chunks INTEGER,
+            entities INTEGER,
+            errors INTEGER DEFAULT 0,
+            error TEXT DEFAULT '',
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            owner TEXT,
+            heartbeat_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+        CREATE INDEX IF NOT EXISTS idx_jobs_graph ON jobs(graph_id);
         """)
+        # 旧库补列（CREATE TABLE IF NOT EXISTS 不修改已有表）
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(graphs)")}
+        if "rerank_backend" not in columns:
+            conn.execute("ALTER TABLE graphs ADD COLUMN rerank_backend TEXT")
+        columns = {r[1] for r in conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at REAL")
         conn.commit()
     finally:
         conn.close()
+    stat_counters.configure(get_settings())
+    stat_counters.recover()
+    history_writer.configure(get_settings())
+
+
+@on_settings_change
+def _on_settings_change(old, new, changed) -> None:
+    # 连接池大小与 pragma 只在创建时生效，修改后需重启
+    stat_counters.configure(new)
+    history_writer.configure(new)
 
 
 @contextmanager
 def get_db():
-    conn = _get_conn()
-    conn.row_factory = sqlite3.Row
+    pool = _get_pool()
+    conn = pool.acquire()
     try:
         yield conn
         conn.commit()
@@ -70,7 +314,36 @@ def get_db():
         conn.rollback()
         raise
     finally:
-        conn.close()
+        pool.release(conn)
+
+
+# 专用 DB 线程：async 路由的数据库调用在这里执行，磁盘 fsync 不再阻塞事件循环；
+# 线程数与连接池大小一致，避免线程空等连接
+_db_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        with _pool_lock:
+            if _db_executor is None:
+                _db_executor = ThreadPoolExecutor(
+                    max_workers=max(1, get_settings().db_pool_size), thread_name_prefix="db"
+                )
+    return _db_executor
+
+
+async def run_db(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """在 DB 线程中执行同步数据库函数，供 async 路由使用"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def shutdown_executor() -> None:
+    global _db_executor
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
 
 
 # --- 图谱 CRUD ---
@@ -81,13 +354,21 @@ def graph_create(name: str, description: str, working_dir: Optional[str] = None,
             "INSERT INTO graphs (name, description, working_dir, daily_limit, created_at) VALUES (?, ?, ?, ?, ?)",
             (name, description, working_dir, daily_limit, datetime.now(timezone.utc).isoformat())
         )
-        return cur.lastrowid
+    graph_catalog_invalidate()
+    return cur.lastrowid
+
+
+def graph_set_working_dir(graph_id: int, working_dir: str):
+    with get_db() as conn:
+        conn.execute("UPDATE graphs SET working_dir = ? WHERE id = ?", (working_dir, graph_id))
 
 
 def graph_list(include_private: bool = False) -> List[dict]:
     """列表。include_private=False 时只返回 name, description（前端展示）；True 时返回全部（管理端）"""
     with get_db() as conn:
-        rows = conn.execute("SELECT id, name, description, working_dir, daily_limit, created_at FROM graphs ORDER BY id").fetchall()
+        rows = conn.execute(
+            "SELECT id, name, description, working_dir, daily_limit, created_at, rerank_backend FROM graphs ORDER BY id"
+        ).fetchall()
     out = []
     for r in rows:
         d = dict(r)
@@ -99,7 +380,10 @@ def graph_list(include_private: bool = False) -> List[dict]:
 
 def graph_get(graph_id: int) -> Optional[dict]:
     with get_db() as conn:
-        row = conn.execute("SELECT id, name, description, working_dir, daily_limit, created_at FROM graphs WHERE id = ?", (graph_id,)).fetchone()
+        row = conn.execute(
+            "SELECT id, name, description, working_dir, daily_limit, created_at, rerank_backend FROM graphs WHERE id = ?",
+            (graph_id,),
+        ).fetchone()
     return dict(row) if row else None
 
 
@@ -111,11 +395,20 @@ def graph_update_meta(graph_id: int, name: Optional[str] = None, description: Op
             conn.execute("UPDATE graphs SET name = ? WHERE id = ?", (name, graph_id))
         if description is not None:
             conn.execute("UPDATE graphs SET description = ? WHERE id = ?", (description, graph_id))
+    graph_catalog_invalidate()
 
 
 def graph_set_daily_limit(graph_id: int, daily_limit: int):
     with get_db() as conn:
         conn.execute("UPDATE graphs SET daily_limit = ? WHERE id = ?", (daily_limit, graph_id))
+    graph_catalog_invalidate()
+
+
+def graph_set_rerank_backend(graph_id: int, rerank_backend: Optional[str]):
+    """图谱默认的 rerank 后端；None 表示沿用 RERANK_PROVIDER"""
+    with get_db() as conn:
+        conn.execute("UPDATE graphs SET rerank_backend = ? WHERE id = ?", (rerank_backend, graph_id))
+    graph_catalog_invalidate()
 
 
 def graph_delete(graph_id: int) -> Optional[str]:
@@ -125,41 +418,377 @@ def graph_delete(graph_id: int) -> Optional[str]:
         return None
     with get_db() as conn:
         conn.execute("DELETE FROM query_stats WHERE graph_id = ?", (graph_id,))
+        conn.execute("DELETE FROM batch_query_stats WHERE graph_id = ?", (graph_id,))
+        conn.execute("DELETE FROM context_query_stats WHERE graph_id = ?", (graph_id,))
         conn.execute("DELETE FROM graphs WHERE id = ?", (graph_id,))
+    stat_counters.drop(_STAT_GRAPH, graph_id)
+    stat_counters.drop(_STAT_BATCH, graph_id)
+    stat_counters.drop(_STAT_CONTEXT, graph_id)
+    graph_catalog_invalidate()
     return g["working_dir"]
 
 
 # --- 查询统计 ---
+#
+# query_stats / user_query_stats / batch_query_stats / context_query_stats 的计数在内存中累加（写回缓存），由后台任务每 QUERY_STATS_FLUSH_INTERVAL 秒
+# 以及进程退出时在一个事务里批量写入，查询不再各自提交一次。读取时合并本进程尚未写入的增量，本进程内数值精确；
+# 每次写入（无增量时也按间隔执行）同时重新读取已落库值，其他进程（多 worker、python -m app.batch）的计数
+# 最迟一个写入间隔后可见。多个服务进程共用 daily_limit 时，各自未写入的增量彼此不可见，合计可能略超限额
+# （不超过一个写入间隔内其他进程的预占数）。
+# 崩溃安全：
+# - 默认最多丢失最近一个写入间隔内的计数（间隔设为 0 则每次立即写入，与原先相同）；
+# - QUERY_STATS_JOURNAL=true 时每次增减先追加一行到 data/query_stats.journal*（write 后即进入内核缓冲，
+#   进程崩溃不丢，掉电可能丢最后几行），批量写入成功后删除对应日志段；启动时回放残留日志段。
+#   若恰好在提交成功与删除日志段之间崩溃，该段会被重复计入（只会多计，不会少计）。
+
+STATS_JOURNAL_PATH = DATA_DIR / "query_stats.journal"
+
+_STAT_GRAPH = "g"
+_STAT_USER = "u"
+_STAT_BATCH = "b"  # 不占 daily_limit 的批量查询（app.batch），单独计数
+_STAT_CONTEXT = "c"  # 只检索不生成回答的查询（/api/query/context），单独计数与限额
+_STAT_SQL = {
+    _STAT_GRAPH: (
+        "SELECT count FROM query_stats WHERE graph_id = ? AND stat_date = ?",
+        """INSERT INTO query_stats (graph_id, stat_date, count)
+        SELECT ?, ?, MAX(?, 0) WHERE EXISTS (SELECT 1 FROM graphs WHERE id = ?)
+        ON CONFLICT(graph_id, stat_date) DO UPDATE SET count = MAX(count + excluded.count, 0)""",
+    ),
+    _STAT_USER: (
+        "SELECT count FROM user_query_stats WHERE user_id = ? AND stat_date = ?",
+        """INSERT INTO user_query_stats (user_id, stat_date, count)
+        SELECT ?, ?, MAX(?, 0) WHERE EXISTS (SELECT 1 FROM users WHERE id = ?)
+        ON CONFLICT(user_id, stat_date) DO UPDATE SET count = MAX(count + excluded.count, 0)""",
+    ),
+    _STAT_BATCH: (
+        "SELECT count FROM batch_query_stats WHERE graph_id = ? AND stat_date = ?",
+        """INSERT INTO batch_query_stats (graph_id, stat_date, count)
+        SELECT ?, ?, MAX(?, 0) WHERE EXISTS (SELECT 1 FROM graphs WHERE id = ?)
+        ON CONFLICT(graph_id, stat_date) DO UPDATE SET count = MAX(count + excluded.count, 0)""",
+    ),
+    _STAT_CONTEXT: (
+        "SELECT count FROM context_query_stats WHERE graph_id = ? AND stat_date = ?",
+        """INSERT INTO context_query_stats (graph_id, stat_date, count)
+        SELECT ?, ?, MAX(?, 0) WHERE EXISTS (SELECT 1 FROM graphs WHERE id = ?)
+        ON CONFLICT(graph_id, stat_date) DO UPDATE SET count = MAX(count + excluded.count, 0)""",
+    ),
+}
+
+# 某天全部已落库计数，写入时用于刷新已加载的 base（见 _StatCounters.flush）
+_STAT_DAY_SQL = {
+    _STAT_GRAPH: "SELECT graph_id, count FROM query_stats WHERE stat_date = ?",
+    _STAT_USER: "SELECT user_id, count FROM user_query_stats WHERE stat_date = ?",
+    _STAT_BATCH: "SELECT graph_id, count FROM batch_query_stats WHERE stat_date = ?",
+    _STAT_CONTEXT: "SELECT graph_id, count FROM context_query_stats WHERE stat_date = ?",
+}
+
+
+class _StatCounters:
+    """按 (类型, 图谱或用户 id, 日期) 计数：base 为已落库值（按需加载），delta 为未写入的增量，
+    inflight 为正在写入的增量。所有方法线程安全，可在 def 路由、DB 线程与事件循环中调用。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._base: Dict[tuple, int] = {}
+        self._delta: Dict[tuple, int] = {}
+        self._inflight: Dict[tuple, int] = {}
+        self._user_ids: Dict[str, int] = {}
+        self._journal = None
+        self._segments: List[Path] = []
+        self.write_through = False
+        self.journal_enabled = False
+        # 与服务进程共用计数的独立进程（python -m app.batch）：逐次写入，预占在 SQLite 写事务中检查，
+        # 不写也不回放日志（日志段属于服务进程）
+        self.shared = False
+        self.flushes = 0
+        self.flushed_rows = 0
+        # 每次计数变化 +1，用于 /graphs_with_usage 的 ETag
+        self.generation = 0
+
+    def configure(self, settings) -> None:
+        self.write_through = self.shared or settings.query_stats_flush_interval <= 0
+        self.journal_enabled = settings.query_stats_journal and not self.shared
+
+    # --- 读 ---
+
+    def _pending(self, key: tuple) -> int:
+        return self._delta.get(key, 0) + self._inflight.get(key, 0)
+
+    def is_loaded(self, *keys: tuple) -> bool:
+        with self._lock:
+            return all(k in self._base for k in keys)
+
+    def load(self, *keys: tuple) -> None:
+        missing = [k for k in keys if k not in self._base]
+        if not missing:
+            return
+        with get_db() as conn:
+            values = {}
+            for k in missing:
+                row = conn.execute(_STAT_SQL[k[0]][0], (k[1], k[2])).fetchone()
+                values[k] = row[0] if row else 0
+        with self._lock:
+            for k, v in values.items():
+                # 读库期间可能有一次写入完成并已计入 base，以先到者为准
+                self._base.setdefault(k, v)
+
+    def prime(self, values: Dict[tuple, int]) -> None:
+        """用批量查询得到的已落库值填充（不覆盖已加载的键）"""
+        with self._lock:
+            for k, v in values.items():
+                self._base.setdefault(k, v)
+
+    def get(self, key: tuple) -> int:
+        self.load(key)
+        with self._lock:
+            # 加载后到加锁前图谱或用户可能已被删除（drop），此时按 0 计
+            return self._base.get(key, 0) + self._pending(key)
+
+    def pending(self, key: tuple) -> int:
+        with self._lock:
+            return self._pending(key)
+
+    def cached_user_id(self, username: str) -> Optional[int]:
+        return self._user_ids.get(username)
+
+    def user_id(self, username: str) -> Optional[int]:
+        uid = self._user_ids.get(username)
+        if uid is None:
+            with get_db() as conn:
+                row = conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone()
+            if row is None:
+                return None
+            uid = self._user_ids[username] = row[0]
+        return uid
+
+    # --- 写 ---
+
+    def _add_locked(self, key: tuple, n: int) -> None:
+        self._delta[key] = self._delta.get(key, 0) + n
+        self.generation += 1
+        if self.journal_enabled:
+            if self._journal is None:
+                STATS_JOURNAL_PATH.parent.mkdir(parents=True, exist_ok=True)
+                self._journal = open(STATS_JOURNAL_PATH, "a", encoding="ascii", buffering=1)
+            self._journal.write(f"{key[0]} {key[1]} {key[2]} {n}\n")
+
+    def add(self, key: tuple, n: int = 1) -> None:
+        with self._lock:
+            self._add_locked(key, n)
+        if self.write_through:
+            self.flush()
+
+    def reserve(self, graph_key: tuple, graph_limit: int, user_key: Optional[tuple], user_limit: int) -> dict:
+        """原子地检查并占用：图谱计数 < graph_limit 且（user_limit <= 0 或用户计数 < user_limit）时两者各 +1"""
+        keys = (graph_key,) if user_key is None else (graph_key, user_key)
+        if self.shared:
+            return self._reserve_stored(keys, graph_limit, user_limit)
+        self.load(*keys)
+        with self._lock:
+            # 同 get：键可能在加载后被 drop，按 0 计（图谱或用户已删除，增量也不会写回）
+            used = self._base.get(graph_key, 0) + self._pending(graph_key)
+            user_used = None if user_key is None else self._base.get(user_key, 0) + self._pending(user_key)
+            out = {"ok": False, "reason": None, "used": used, "user_used": user_used}
+            if used >= graph_limit:
+                out["reason"] = "graph"
+            elif user_key is not None and 0 < user_limit <= user_used:
+                out["reason"] = "user"
+            else:
+                self._add_locked(graph_key, 1)
+                out.update(ok=True, used=used + 1)
+                if user_key is not None:
+                    self._add_locked(user_key, 1)
+                    out["user_used"] = user_used + 1
+        if out["ok"] and self.write_through:
+            self.flush()
+        return out
+
+    def _reserve_stored(self, keys: tuple, graph_limit: int, user_limit: int) -> dict:
+        """共用计数时的预占：在一个写事务中读取已落库计数、检查并 +1（BEGIN IMMEDIATE 期间其他进程不能写入），
+        与服务进程已写入的计数一起不会越过限额"""
+        with get_db() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            stored = _read_stat_values(conn, keys)
+            with self._lock:
+                counts = [stored[k] + self._pending(k) for k in keys]
+            used, user_used = counts[0], (counts[1] if len(keys) > 1 else None)
+            out = {"ok": False, "reason": None, "used": used, "user_used": user_used}
+            if used >= graph_limit:
+                out["reason"] = "graph"
+            elif user_used is not None and 0 < user_limit <= user_used:
+                out["reason"] = "user"
+            else:
+                _apply_stat_deltas(conn, {k: 1 for k in keys})
+                out.update(ok=True, used=used + 1, user_used=None if user_used is None else user_used + 1)
+        with self._lock:
+            for k in keys:
+                self._base[k] = stored[k] + (1 if out["ok"] else 0)
+            if out["ok"]:
+                self.generation += 1
+        return out
+
+    def flush(self) -> int:
+        """把未写入的增量在一个事务中写入 SQLite，并在同一事务中重新读取已加载键的已落库值，
+        使其他进程（多 worker 部署、python -m app.batch）写入的计数在下一次写入后可见；返回写入的行数"""
+        with self._flush_lock:
+            today = date.today().isoformat()
+            with self._lock:
+                batch, self._delta = self._delta, {}
+                self._inflight = batch
+                if batch and self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                    segment = STATS_JOURNAL_PATH.with_name(f"{STATS_JOURNAL_PATH.name}.{time.time_ns()}")
+                    STATS_JOURNAL_PATH.rename(segment)
+                    self._segments.append(segment)
+                segments = list(self._segments)
+                refresh = {k for k in self._base if k[2] == today} | set(batch)
+            if not refresh:
+                return 0
+            try:
+                with get_db() as conn:
+                    if batch:
+                        _apply_stat_deltas(conn, batch)
+                    stored = _read_stat_values(conn, refresh)
+            except Exception:
+                # 写入失败：增量放回，日志段保留到下次成功写入
+                with self._lock:
+                    for k, n in batch.items():
+                        self._delta[k] = self._delta.get(k, 0) + n
+                    self._inflight = {}
+                raise
+            with self._lock:
+                # stored 已含本次写入的增量；已被 drop 的键（图谱或用户已删除）不再加回
+                for k, v in stored.items():
+                    if (k in self._base or k in self._inflight) and self._base.get(k) != v:
+                        self._base[k] = v
+                        self.generation += 1
+                self._inflight = {}
+                # 只保留今天的已落库值，避免跨天无限增长
+                for k in [k for k in self._base if k[2] != today and k not in self._delta]:
+                    del self._base[k]
+                self._segments = [s for s in self._segments if s not in segments]
+            for s in segments:
+                s.unlink(missing_ok=True)
+            if not batch:
+                return 0
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+            return len(batch)
+
+    def recover(self) -> None:
+        """启动时回放上次进程残留的日志段（未写入 SQLite 的计数）"""
+        if self.shared:
+            return
+        paths = sorted(STATS_JOURNAL_PATH.parent.glob(f"{STATS_JOURNAL_PATH.name}*"))
+        if not paths:
+            return
+        batch: Dict[tuple, int] = {}
+        for p in paths:
+            for line in p.read_text(encoding="ascii", errors="ignore").splitlines():
+                parts = line.split()
+                if len(parts) != 4 or parts[0] not in _STAT_SQL:
+                    continue  # 崩溃时写了一半的行
+                key = (parts[0], int(parts[1]), parts[2])
+                batch[key] = batch.get(key, 0) + int(parts[3])
+        with get_db() as conn:
+            _apply_stat_deltas(conn, batch)
+        for p in paths:
+            p.unlink(missing_ok=True)
+
+    def drop(self, kind: str, ident: int) -> None:
+        """图谱或用户被删除时丢弃其计数，避免之后写回"""
+        with self._lock:
+            for d in (self._base, self._delta, self._inflight):
+                for k in [k for k in d if k[0] == kind and k[1] == ident]:
+                    del d[k]
+            if kind == _STAT_USER:
+                for name in [n for n, uid in self._user_ids.items() if uid == ident]:
+                    del self._user_ids[name]
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "pending_keys": len(self._delta),
+                "pending_count": sum(self._delta.values()),
+                "loaded_keys": len(self._base),
+                "flushes": self.flushes,
+                "flushed_rows": self.flushed_rows,
+                "journal": self.journal_enabled,
+            }
+
+
+def _read_stat_values(conn: sqlite3.Connection, keys) -> Dict[tuple, int]:
+    """keys 的已落库值（没有记录的为 0），按 (类型, 日期) 各查询一次"""
+    groups = {(k[0], k[2]) for k in keys}
+    found: Dict[tuple, int] = {}
+    for kind, day in groups:
+        for ident, count in conn.execute(_STAT_DAY_SQL[kind], (day,)):
+            found[(kind, ident, day)] = count
+    return {k: found.get(k, 0) for k in keys}
+
+
+def _apply_stat_deltas(conn: sqlite3.Connection, batch: Dict[tuple, int]) -> None:
+    for kind, (_, upsert) in _STAT_SQL.items():
+        rows = [(k[1], k[2], n, k[1]) for k, n in batch.items() if k[0] == kind and n]
+        if rows:
+            conn.executemany(upsert, rows)
+
+
+stat_counters = _StatCounters()
+
+
+def _today() -> str:
+    return date.today().isoformat()
+
 
 def query_stat_inc(graph_id: int) -> bool:
-    """今日该图谱查询次数 +1。若未超限返回 True，超限返回 False（调用方需先检查）"""
-    today = date.today().isoformat()
-    with get_db() as conn:
-        conn.execute(
-            "INSERT INTO query_stats (graph_id, stat_date, count) VALUES (?, ?, 1) ON CONFLICT(graph_id, stat_date) DO UPDATE SET count = count + 1",
-            (graph_id, today)
-        )
+    """今日该图谱查询次数 +1（内存累加，定期写入）。不检查限额，需要限额时使用 quota_reserve"""
+    stat_counters.add((_STAT_GRAPH, graph_id, _today()))
     return True
 
 
+def batch_stat_inc(graph_id: int) -> None:
+    """今日该图谱批量查询次数 +1（不计入 query_stats，也不受 daily_limit 限制）"""
+    stat_counters.add((_STAT_BATCH, graph_id, _today()))
+
+
 def query_stat_get_today(graph_id: int) -> int:
-    today = date.today().isoformat()
-    with get_db() as conn:
-        row = conn.execute("SELECT count FROM query_stats WHERE graph_id = ? AND stat_date = ?", (graph_id, today)).fetchone()
-    return row[0] if row else 0
+    return stat_counters.get((_STAT_GRAPH, graph_id, _today()))
 
 
 def query_stat_get_today_all() -> List[dict]:
-    """所有图谱今日查询次数"""
-    today = date.today().isoformat()
+    """所有图谱今日查询次数（含尚未写入的增量）"""
+    today = _today()
     with get_db() as conn:
         rows = conn.execute("""
-            SELECT g.id, g.name, g.daily_limit, COALESCE(s.count, 0) AS today_count
+            SELECT g.id, g.name, g.daily_limit, COALESCE(s.count, 0) AS today_count,
+                   COALESCE(b.count, 0) AS batch_count, COALESCE(c.count, 0) AS context_count
             FROM graphs g
             LEFT JOIN query_stats s ON g.id = s.graph_id AND s.stat_date = ?
+            LEFT JOIN batch_query_stats b ON g.id = b.graph_id AND b.stat_date = ?
+            LEFT JOIN context_query_stats c ON g.id = c.graph_id AND c.stat_date = ?
             ORDER BY g.id
-        """, (today,)).fetchall()
-    return [dict(r) for r in rows]
+        """, (today, today, today)).fetchall()
+    out = [dict(r) for r in rows]
+    for r in out:
+        r["today_count"] += stat_counters.pending((_STAT_GRAPH, r["id"], today))
+        r["batch_count"] += stat_counters.pending((_STAT_BATCH, r["id"], today))
+        r["context_count"] += stat_counters.pending((_STAT_CONTEXT, r["id"], today))
+    return out
+
+
+def query_stat_flush() -> int:
+    """把内存中的计数写入 SQLite（后台定时与退出时调用）"""
+    return stat_counters.flush()
 
 
 def can_query_today(graph_id: int) -> tuple[bool, int, int]:
@@ -172,6 +801,149 @@ def can_query_today(graph_id: int) -> tuple[bool, int, int]:
     return used < limit, used, limit
 
 
+# --- 图谱目录缓存（/graphs 与 /graphs_with_usage）---
+#
+# 图谱列表与今日计数用一条 JOIN 查询加载后缓存在内存，图谱增删改时失效；今日用量取自内存计数（见上），
+# 不再逐个图谱查询。ETag 由目录内容摘要组成（/graphs_with_usage 另加启动标识、日期与计数代数），数据不变时
+# 客户端可用 If-None-Match 得到 304。
+# 多进程部署时其他进程的修改在 GRAPH_CATALOG_TTL 秒内生效。
+
+class _GraphCatalog:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch = uuid.uuid4().hex[:8]
+        self._version = ""
+        self._rows: Optional[List[dict]] = None
+        self._day = ""
+        self._loaded_at = 0.0
+        self._invalidations = 0
+        self.ttl = 60.0
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._rows = None
+            self._invalidations += 1
+
+    def rows(self) -> tuple:
+        """(版本, 图谱行列表, 日期)；缓存失效、过期或跨天时重新加载。
+        版本取自图谱行内容的摘要，按 TTL 重新加载而内容未变时保持不变（ETag 随之不变）"""
+        today = _today()
+        with self._lock:
+            fresh = self.ttl <= 0 or time.monotonic() - self._loaded_at < self.ttl
+            if self._rows is not None and fresh and self._day == today:
+                return self._version, self._rows, self._day
+            token = self._invalidations
+        with get_db() as conn:
+            rows = [dict(r) for r in conn.execute("""
+                SELECT g.id, g.name, g.description, g.daily_limit, COALESCE(s.count, 0) AS stored_count
+                FROM graphs g
+                LEFT JOIN query_stats s ON g.id = s.graph_id AND s.stat_date = ?
+                ORDER BY g.id
+            """, (today,)).fetchall()]
+        stat_counters.prime({(_STAT_GRAPH, r["id"], today): r.pop("stored_count") for r in rows})
+        digest = hashlib.sha1(repr(
+            [(r["id"], r["name"], r["description"], r["daily_limit"]) for r in rows]
+        ).encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            # 加载期间又有修改时不缓存这次结果
+            if token == self._invalidations:
+                self._version, self._rows, self._day, self._loaded_at = digest, rows, today, time.monotonic()
+            return digest, rows, today
+
+    def get(self, with_usage: bool) -> tuple:
+        generation = stat_counters.generation
+        version, rows, today = self.rows()
+        if not with_usage:
+            items = [{"id": r["id"], "name": r["name"], "description": r["description"]} for r in rows]
+            return items, f'W/"{version}"'
+        items = [
+            {
+                "id": r["id"],
+                "name": r["name"],
+                "description": r["description"],
+                "today_used": stat_counters.get((_STAT_GRAPH, r["id"], today)),
+                "daily_limit": r["daily_limit"],
+            }
+            for r in rows
+        ]
+        # 计数代数只在本进程内有效，另带进程标识；跨天时今日用量归零，另带日期
+        return items, f'W/"{self._epoch}-{version}-{today}-{generation}"'
+
+
+_graph_catalog = _GraphCatalog()
+
+
+def graph_catalog_invalidate() -> None:
+    _graph_catalog.invalidate()
+
+
+def graph_catalog(with_usage: bool = False) -> tuple:
+    """前端图谱列表（id、name、description；with_usage 时另含 today_used、daily_limit）及其 ETag"""
+    _graph_catalog.ttl = get_settings().graph_catalog_ttl
+    return _graph_catalog.get(with_usage)
+
+
+# --- 配额：预占 / 退还（见 app/quota.py）---
+
+def _quota_keys(graph_id: int, username: Optional[str], today: str):
+    user_id = stat_counters.user_id(username) if username else None
+    user_key = None if user_id is None else (_STAT_USER, user_id, today)
+    return (_STAT_GRAPH, graph_id, today), user_key, user_id
+
+
+def quota_is_cached(graph_id: int, username: Optional[str] = None) -> bool:
+    """预占所需的计数是否都已在内存中（是则 quota_reserve / quota_usage 为纯内存操作，可在事件循环中直接调用）"""
+    today = _today()
+    keys = [(_STAT_GRAPH, graph_id, today)]
+    if username:
+        uid = stat_counters.cached_user_id(username)
+        if uid is None:
+            return False
+        keys.append((_STAT_USER, uid, today))
+    return stat_counters.is_loaded(*keys)
+
+
+def quota_reserve(graph_id: int, graph_limit: int, username: Optional[str] = None, user_limit: int = 0) -> dict:
+    """原子预占今日一次查询：在内存计数上检查并 +1，并发请求不会越过限额。
+    图谱与用户（user_limit <= 0 表示用户不限次，仅计数）同时占用，任一超限则都不占用。
+    返回 {"ok", "reason": None/"graph"/"user", "stat_date", "used", "limit", "user_id", "user_used", "user_limit"}"""
+    today = _today()
+    graph_key, user_key, user_id = _quota_keys(graph_id, username, today)
+    out = stat_counters.reserve(graph_key, graph_limit, user_key, user_limit)
+    out.update(stat_date=today, limit=graph_limit, user_id=user_id, user_limit=user_limit)
+    return out
+
+
+def quota_refund(graph_id: int, stat_date: str, user_id: Optional[int] = None) -> None:
+    """退还一次预占（查询失败、客户端断开或无需计数时）"""
+    stat_counters.add((_STAT_GRAPH, graph_id, stat_date), -1)
+    if user_id is not None:
+        stat_counters.add((_STAT_USER, user_id, stat_date), -1)
+
+
+def quota_usage(graph_id: int, username: Optional[str] = None) -> dict:
+    """今日用量（不占用）：{"used", "user_id", "user_used"}；未登录或用户不存在时 user_id 为 None"""
+    today = _today()
+    graph_key, user_key, user_id = _quota_keys(graph_id, username, today)
+    return {
+        "used": stat_counters.get(graph_key),
+        "user_id": user_id,
+        "user_used": None if user_key is None else stat_counters.get(user_key),
+    }
+
+
+def context_quota_reserve(graph_id: int, limit: int) -> dict:
+    """预占今日一次只检索查询（与完整回答的 daily_limit 分开计数；limit <= 0 表示不限次，仅计数）。
+    返回 {"ok", "stat_date", "used", "limit"}"""
+    today = _today()
+    out = stat_counters.reserve((_STAT_CONTEXT, graph_id, today), limit if limit > 0 else sys.maxsize, None, 0)
+    return {"ok": out["ok"], "stat_date": today, "used": out["used"], "limit": limit}
+
+
+def context_quota_refund(graph_id: int, stat_date: str) -> None:
+    stat_counters.add((_STAT_CONTEXT, graph_id, stat_date), -1)
+
+
 # --- 用户 ---
 
 def user_create(username: str, password_hash: str) -> int:
@@ -219,13 +991,20 @@ def user_delete(user_id: int) -> bool:
     u = user_get(user_id)
     if not u:
         return False
+    history_writer.drop_user(user_id)
     with get_db() as conn:
         conn.execute("DELETE FROM query_history WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM user_query_stats WHERE user_id = ?", (user_id,))
         conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+    stat_counters.drop(_STAT_USER, user_id)
     return True
 
 
 # --- 查询记录（仅保留 7 天内）---
+#
+# 写入经内存队列批量提交（后台每 HISTORY_FLUSH_INTERVAL 秒或攒满 HISTORY_BATCH_SIZE 条一次），
+# 过期记录由后台任务分块删除，不再每次插入都扫描删除；读取前先提交队列，列表结果不变。
+# 超过 HISTORY_COMPRESS_MIN_BYTES 的回答以 zlib 压缩后的 BLOB 存入同一 answer 列，读取时按类型解压。
 
 HISTORY_DAYS = 7
 
@@ -234,18 +1013,113 @@ def _history_cutoff() -> str:
     return (datetime.now(timezone.utc) - timedelta(days=HISTORY_DAYS)).isoformat()
 
 
-def query_history_add(user_id: int, graph_id: int, query_text: str, answer: str):
-    with get_db() as conn:
-        conn.execute(
-            "INSERT INTO query_history (user_id, graph_id, query_text, answer, created_at) VALUES (?, ?, ?, ?, ?)",
-            (user_id, graph_id, query_text, answer, datetime.now(timezone.utc).isoformat())
+def _encode_answer(answer: str, min_bytes: int):
+    raw = answer.encode("utf-8")
+    if min_bytes <= 0 or len(raw) < min_bytes:
+        return answer
+    packed = zlib.compress(raw, 6)
+    return packed if len(packed) < len(raw) else answer
+
+
+def _decode_answer(value) -> str:
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+
+def _history_row(r: sqlite3.Row) -> dict:
+    d = dict(r)
+    d["answer"] = _decode_answer(d["answer"])
+    return d
+
+
+class _HistoryWriter:
+    """查询记录写入队列：add 只追加到内存，flush 在一个事务中批量插入"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self.batch_size = 100
+        self.compress_min_bytes = 1024
+        self.written = 0
+
+    def configure(self, settings) -> None:
+        self.batch_size = max(1, settings.history_batch_size)
+        self.compress_min_bytes = settings.history_compress_min_bytes
+
+    def add(self, user_id: int, graph_id: int, query_text: str, answer: str) -> bool:
+        """入队，返回队列是否已攒满一批（调用方应尽快 flush）"""
+        row = (
+            user_id, graph_id, query_text, _encode_answer(answer, self.compress_min_bytes),
+            datetime.now(timezone.utc).isoformat(), user_id,
         )
-        # 删除 7 天前的记录
-        conn.execute("DELETE FROM query_history WHERE created_at < ?", (_history_cutoff(),))
+        with self._lock:
+            self._pending.append(row)
+            return len(self._pending) >= self.batch_size
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            if not rows:
+                return 0
+            try:
+                with get_db() as conn:
+                    # 用户可能已在排队期间被删除
+                    conn.executemany(
+                        """INSERT INTO query_history (user_id, graph_id, query_text, answer, created_at)
+                        SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM users WHERE id = ?)""",
+                        rows
+                    )
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = rows
+                raise
+            self.written += len(rows)
+            return len(rows)
+
+    def drop_user(self, user_id: int) -> None:
+        with self._lock:
+            self._pending = [r for r in self._pending if r[0] != user_id]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"pending": len(self._pending), "written": self.written}
+
+
+history_writer = _HistoryWriter()
+
+
+def query_history_add(user_id: int, graph_id: int, query_text: str, answer: str) -> bool:
+    """加入写入队列（不直接写库）。返回 True 表示已攒满一批，应调用 query_history_flush"""
+    return history_writer.add(user_id, graph_id, query_text, answer)
+
+
+def query_history_flush() -> int:
+    """提交队列中的查询记录，返回写入条数"""
+    return history_writer.flush()
+
+
+def query_history_purge(chunk_size: int = 500) -> int:
+    """分块删除 7 天前的记录，每块一个短事务，避免长时间持有写锁；返回删除条数"""
+    cutoff = _history_cutoff()
+    total = 0
+    while True:
+        with get_db() as conn:
+            cur = conn.execute(
+                """DELETE FROM query_history WHERE id IN (
+                    SELECT id FROM query_history WHERE created_at < ? LIMIT ?)""",
+                (cutoff, chunk_size)
+            )
+        total += cur.rowcount
+        if cur.rowcount < chunk_size:
+            return total
 
 
 def query_history_list(user_id: int, graph_id: int) -> List[dict]:
     """某用户在某图谱下、7 天内的查询记录，按时间倒序。"""
+    history_writer.flush()
     cutoff = _history_cutoff()
     with get_db() as conn:
         rows = conn.execute(
@@ -255,11 +1129,12 @@ def query_history_list(user_id: int, graph_id: int) -> List[dict]:
                ORDER BY created_at DESC""",
             (user_id, graph_id, cutoff)
         ).fetchall()
-    return [dict(r) for r in rows]
+    return [_history_row(r) for r in rows]
 
 
 def query_history_list_by_user(user_id: int) -> List[dict]:
     """某用户全部 7 天内记录，按时间倒序（管理端用）。"""
+    history_writer.flush()
     cutoff = _history_cutoff()
     with get_db() as conn:
         rows = conn.execute(
@@ -270,7 +1145,133 @@ def query_history_list_by_user(user_id: int) -> List[dict]:
                ORDER BY h.created_at DESC""",
             (user_id, cutoff)
         ).fetchall()
-    return [dict(r) for r in rows]
+    return [_history_row(r) for r in rows]
+
+
+# --- 查询记录分页（键集分页：按 (created_at, id) 倒序，游标为上一页最后一条的键）---
+
+HISTORY_SUMMARY_CHARS = 120
+
+
+def _encode_cursor(created_at: str, history_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at}|{history_id}".encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        created_at, history_id = raw.rsplit("|", 1)
+        return created_at, int(history_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("无效的分页游标")
+
+
+def parse_history_time(value: Optional[str], end: bool = False) -> Optional[str]:
+    """把 since / until 参数（日期或 ISO 时间，无时区按 UTC）转为与 created_at 可比较的字符串。
+    end=True 且只给日期时取次日零点（该日整天包含在内）。格式错误抛 ValueError"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        if len(value) == 10:
+            dt = datetime.combine(date.fromisoformat(value), datetime.min.time(), tzinfo=timezone.utc)
+            if end:
+                dt += timedelta(days=1)
+        else:
+            dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            if dt.tzinfo is None:
+                dt = dt.replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise ValueError(f"无效的时间: {value}")
+    return dt.astimezone(timezone.utc).isoformat()
+
+
+def _summarize_answer(value, chars: int) -> tuple:
+    """(截断后的回答, 是否截断)；压缩存储的回答只解压开头一段"""
+    if isinstance(value, bytes):
+        d = zlib.decompressobj()
+        head = d.decompress(value, chars * 4).decode("utf-8", errors="ignore")
+        more = bool(d.unconsumed_tail) or not d.eof
+        return head[:chars], more or len(head) > chars
+    return value[:chars], len(value) > chars
+
+
+def query_history_page(
+    user_id: int,
+    graph_id: Optional[int] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = 20,
+    summary: bool = False,
+) -> dict:
+    """分页读取某用户 7 天内的记录，可按图谱与时间范围 [since, until) 过滤，按时间倒序。
+    summary=True 时回答截断为 HISTORY_SUMMARY_CHARS 字并附 truncated 标记，完整内容用 query_history_get 获取。
+    返回 {"items": [...], "next_cursor": str 或 None}"""
+    history_writer.flush()
+    cutoff = _history_cutoff()
+    where = ["h.user_id = ?", "h.created_at >= ?"]
+    params: List[Any] = [user_id, max(cutoff, since) if since else cutoff]
+    if graph_id is not None:
+        where.append("h.graph_id = ?")
+        params.append(graph_id)
+    if until:
+        where.append("h.created_at < ?")
+        params.append(until)
+    if cursor:
+        where.append("(h.created_at, h.id) < (?, ?)")
+        params.extend(_decode_cursor(cursor))
+    if summary:
+        # 未压缩的长回答在 SQL 中截断，不读出整段
+        answer_col = (
+            "CASE WHEN typeof(h.answer) = 'blob' THEN h.answer ELSE substr(h.answer, 1, ?) END AS answer, "
+            "CASE WHEN typeof(h.answer) = 'blob' THEN NULL ELSE length(h.answer) > ? END AS truncated"
+        )
+        params[:0] = [HISTORY_SUMMARY_CHARS, HISTORY_SUMMARY_CHARS]
+    else:
+        answer_col = "h.answer"
+    with get_db() as conn:
+        rows = conn.execute(
+            f"""SELECT h.id, h.user_id, h.graph_id, h.query_text, {answer_col}, h.created_at, g.name AS graph_name
+                FROM query_history h
+                LEFT JOIN graphs g ON g.id = h.graph_id
+                WHERE {" AND ".join(where)}
+                ORDER BY h.created_at DESC, h.id DESC
+                LIMIT ?""",
+            (*params, limit + 1)
+        ).fetchall()
+    items = []
+    for r in rows[:limit]:
+        d = dict(r)
+        if summary:
+            if isinstance(d["answer"], bytes):
+                d["answer"], d["truncated"] = _summarize_answer(d["answer"], HISTORY_SUMMARY_CHARS)
+            else:
+                d["truncated"] = bool(d["truncated"])
+        else:
+            d["answer"] = _decode_answer(d["answer"])
+        items.append(d)
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = _encode_cursor(last["created_at"], last["id"])
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def query_history_get(history_id: int, user_id: Optional[int] = None) -> Optional[dict]:
+    """单条完整记录（7 天内）；给出 user_id 时只返回该用户的记录"""
+    history_writer.flush()
+    sql = """SELECT h.id, h.user_id, h.graph_id, h.query_text, h.answer, h.created_at, g.name AS graph_name
+             FROM query_history h
+             LEFT JOIN graphs g ON g.id = h.graph_id
+             WHERE h.id = ? AND h.created_at >= ?"""
+    params: List[Any] = [history_id, _history_cutoff()]
+    if user_id is not None:
+        sql += " AND h.user_id = ?"
+        params.append(user_id)
+    with get_db() as conn:
+        row = conn.execute(sql, params).fetchone()
+    return _history_row(row) if row else None
 
 
 def query_history_delete(user_id: int, history_id: int) -> bool:
@@ -280,3 +1281,108 @@ def query_history_delete(user_id: int, history_id: int) -> bool:
             (history_id, user_id)
         )
     return cur.rowcount > 0
+
+
+# --- 后台导入任务 ---
+#
+# 多个进程（多 worker 部署）共用 jobs 表：任务由 job_claim 原子领取，领取者记入 owner 并定期续约 heartbeat_at；
+# 超过 JOB_LEASE_SECONDS 未续约的运行中任务视为持有进程已退出，可被其他进程接管。
+
+JOB_KINDS = ("create", "update")
+# queued -> running -> succeeded / failed / cancelled
+JOB_FINISHED = ("succeeded", "failed", "cancelled")
+JOB_LEASE_SECONDS = 60
+_JOB_FIELDS = ("status", "docs_total", "docs_done", "chunks", "entities", "errors", "error")
+_JOB_COLUMNS = "id, kind, graph_id, working_dir, status, docs_total, docs_done, chunks, entities, errors, error, created_at, updated_at"
+
+
+def job_create(kind: str, graph_id: int, working_dir: str, docs_total: int) -> int:
+    now = datetime.now(timezone.utc).isoformat()
+    with get_db() as conn:
+        cur = conn.execute(
+            "INSERT INTO jobs (kind, graph_id, working_dir, status, docs_total, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+            (kind, graph_id, working_dir, docs_total, now, now)
+        )
+        return cur.lastrowid
+
+
+def job_get(job_id: int) -> Optional[dict]:
+    with get_db() as conn:
+        row = conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def job_list(graph_id: Optional[int] = None, limit: int = 50) -> List[dict]:
+    """最近的任务，按 id 倒序；可按图谱过滤"""
+    with get_db() as conn:
+        if graph_id is not None:
+            rows = conn.execute(
+                f"SELECT {_JOB_COLUMNS} FROM jobs WHERE graph_id = ? ORDER BY id DESC LIMIT ?", (graph_id, limit)
+            ).fetchall()
+        else:
+            rows = conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def job_list_unfinished() -> List[dict]:
+    """未结束的任务（进程重启后恢复用），按提交顺序"""
+    with get_db() as conn:
+        rows = conn.execute(
+            f"SELECT {_JOB_COLUMNS} FROM jobs WHERE status IN ('queued', 'running') ORDER BY id"
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+
+def job_claim(job_id: int, owner: str) -> Optional[dict]:
+    """原子地领取任务并置为 running：排队中的任务，或持有进程租约已过期的运行中任务；
+    同一 working_dir 上有其他仍在续约的运行中任务时不领取。成功返回任务记录，否则返回 None"""
+    now = time.time()
+    with get_db() as conn:
+        cur = conn.execute(
+            """UPDATE jobs SET status = 'running', owner = ?, heartbeat_at = ?, updated_at = ?
+            WHERE id = ?
+              AND (status = 'queued' OR (status = 'running' AND (heartbeat_at IS NULL OR heartbeat_at < ?)))
+              AND NOT EXISTS (
+                  SELECT 1 FROM jobs o WHERE o.working_dir = jobs.working_dir AND o.id != jobs.id
+                  AND o.status = 'running' AND o.heartbeat_at >= ?
+              )""",
+            (owner, now, datetime.now(timezone.utc).isoformat(), job_id, now - JOB_LEASE_SECONDS, now - JOB_LEASE_SECONDS),
+        )
+        if cur.rowcount == 0:
+            return None
+        row = conn.execute(f"SELECT {_JOB_COLUMNS} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row)
+
+
+def job_heartbeat(owner: str, job_ids: List[int]) -> List[int]:
+    """续约本进程运行中的任务，返回其中已被（其他进程）取消的任务 id"""
+    if not job_ids:
+        return []
+    marks = ", ".join("?" * len(job_ids))
+    with get_db() as conn:
+        conn.execute(
+            f"UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = 'running' AND id IN ({marks})",
+            (time.time(), owner, *job_ids),
+        )
+        rows = conn.execute(f"SELECT id FROM jobs WHERE status = 'cancelled' AND id IN ({marks})", job_ids).fetchall()
+    return [r[0] for r in rows]
+
+
+def job_release(owner: str) -> None:
+    """进程退出时把本进程运行中的任务放回队列，其他进程或重启后的本进程可立即接管"""
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', owner = NULL, heartbeat_at = NULL WHERE owner = ? AND status = 'running'",
+            (owner,),
+        )
+
+
+def job_update(job_id: int, **fields) -> None:
+    """更新任务进度或状态，只接受 _JOB_FIELDS 中的字段"""
+    fields = {k: v for k, v in fields.items() if k in _JOB_FIELDS}
+    if not fields:
+        return
+    fields["updated_at"] = datetime.now(timezone.utc).isoformat()
+    sets = ", ".join(f"{k} = ?" for k in fields)
+    with get_db() as conn:
+        conn.execute(f"UPDATE jobs SET {sets} WHERE id = ?", (*fields.values(), job_id))
@@ -0,0 +1,77 @@
+"""app.database 的异步版本：函数名与参数一致，在专用 DB 线程中执行。
+
+async 路由中使用 `from app import database_async as db` 后 `await db.graph_get(...)`，
+数据库读写（含 fsync）不再阻塞事件循环；def 路由继续直接调用 app.database 的同步函数。
+"""
+import functools
+from typing import Any, Awaitable, Callable
+
+from app import database as _db
+from app.database import run_db
+
+
+def _async(fn: Callable[..., Any]) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        return await run_db(fn, *args, **kwargs)
+    return wrapper
+
+
+# --- 图谱 ---
+graph_create = _async(_db.graph_create)
+graph_set_working_dir = _async(_db.graph_set_working_dir)
+graph_list = _async(_db.graph_list)
+graph_get = _async(_db.graph_get)
+graph_update_meta = _async(_db.graph_update_meta)
+graph_set_daily_limit = _async(_db.graph_set_daily_limit)
+graph_delete = _async(_db.graph_delete)
+
+# --- 查询统计 ---
+query_stat_inc = _async(_db.query_stat_inc)
+batch_stat_inc = _async(_db.batch_stat_inc)
+query_stat_get_today = _async(_db.query_stat_get_today)
+query_stat_get_today_all = _async(_db.query_stat_get_today_all)
+query_stat_flush = _async(_db.query_stat_flush)
+can_query_today = _async(_db.can_query_today)
+quota_reserve = _async(_db.quota_reserve)
+quota_refund = _async(_db.quota_refund)
+context_quota_reserve = _async(_db.context_quota_reserve)
+context_quota_refund = _async(_db.context_quota_refund)
+quota_usage = _async(_db.quota_usage)
+
+# --- 用户 ---
+user_create = _async(_db.user_create)
+user_get_by_username = _async(_db.user_get_by_username)
+user_list = _async(_db.user_list)
+user_update_password = _async(_db.user_update_password)
+user_get = _async(_db.user_get)
+user_delete = _async(_db.user_delete)
+
+# --- 查询记录 ---
+query_history_flush = _async(_db.query_history_flush)
+query_history_purge = _async(_db.query_history_purge)
+
+
+async def query_history_add(user_id: int, graph_id: int, query_text: str, answer: str) -> bool:
+    """入队是纯内存操作，直接在事件循环中执行；攒满一批时到 DB 线程提交"""
+    full = _db.query_history_add(user_id, graph_id, query_text, answer)
+    if full:
+        await run_db(_db.query_history_flush)
+    return full
+
+
+query_history_list = _async(_db.query_history_list)
+query_history_page = _async(_db.query_history_page)
+query_history_get = _async(_db.query_history_get)
+query_history_list_by_user = _async(_db.query_history_list_by_user)
+query_history_delete = _async(_db.query_history_delete)
+
+# --- 后台导入任务 ---
+job_create = _async(_db.job_create)
+job_get = _async(_db.job_get)
+job_list = _async(_db.job_list)
+job_list_unfinished = _async(_db.job_list_unfinished)
+job_update = _async(_db.job_update)
+job_claim = _async(_db.job_claim)
+job_heartbeat = _async(_db.job_heartbeat)
+job_release = _async(_db.job_release)
@@ -0,0 +1,301 @@
+"""Embedding 服务层：合批、并发上限与按内容哈希的向量缓存
+
+- 合批：并发到达的请求在 wait 窗口内合并，每批最多 batch_size 条；
+- 并发：同时在途的上游请求数受信号量限制；
+- 缓存：每个模型一个目录（data/embedding_cache/<model>/），vectors.f32 顺序追加 float32 向量并以 memmap 读取，
+  keys.txt 每行记录文本的 sha1 与其向量所在行号。重复导入或重复查询相同文本不再请求上游；
+- 写入在文件锁（lock）内进行，行号取自 vectors.f32 的实际长度，多个 worker 进程可共用同一缓存；
+  进程在写向量与写 key 之间中断留下的多余向量，在下次加载时截掉。文件读写在线程中执行，不阻塞事件循环。
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows：单进程开发时不加文件锁
+    fcntl = None
+
+from app.config import DATA_DIR
+
+EMBEDDING_CACHE_DIR = DATA_DIR / "embedding_cache"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """单个模型的向量缓存：追加写文件，memmap 读。
+    keys.txt 每行 "<sha1> <行号>"（早期版本只有 sha1，行号即该行的序号）"""
+
+    def __init__(self, directory: Path):
+        self.dir = directory
+        self.vec_path = directory / "vectors.f32"
+        self.key_path = directory / "keys.txt"
+        self.dim_path = directory / "dim"
+        self.lock_path = directory / "lock"
+        self.dim: Optional[int] = None
+        self._index: Dict[str, int] = {}
+        self._keys_offset = 0  # keys.txt 已读到的字节位置
+        self._keys_lines = 0
+        self._keys_inode: Optional[int] = None
+        self._mmap: Optional[np.memmap] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """跨进程互斥：写入与修复都在锁内，锁外看到的 key 对应的向量一定已写完"""
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _read_dim(self) -> None:
+        if self.dim is None and self.dim_path.exists():
+            self.dim = int(self.dim_path.read_text().strip())
+
+    def _read_keys(self) -> None:
+        """读入 keys.txt 中上次之后追加的完整行（含其他进程写入的）；文件被修复重写过则从头读"""
+        try:
+            with open(self.key_path, "rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._keys_inode:
+                    self._keys_inode = inode
+                    self._index, self._keys_offset, self._keys_lines = {}, 0, 0
+                f.seek(self._keys_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1  # 不完整的最后一行留到下次
+        for line in data[:end].decode("ascii").splitlines():
+            parts = line.split()
+            if parts:
+                self._index[parts[0]] = int(parts[1]) if len(parts) > 1 else self._keys_lines
+            self._keys_lines += 1
+        self._keys_offset += end
+
+    def _load(self) -> None:
+        self._loaded = True
+        if not self.key_path.exists() and not self.vec_path.exists():
+            return
+        with self._file_lock():
+            self._read_dim()
+            self._read_keys()
+            self._repair()
+
+    def _repair(self) -> None:
+        """（持锁）截掉没有 key 指向的尾部向量与不完整的行，去掉指向文件之外的 key 与不完整的 key 行"""
+        if self.dim is None:
+            return
+        row_bytes = 4 * self.dim
+        size = self.vec_path.stat().st_size if self.vec_path.exists() else 0
+        rows = size // row_bytes
+        valid = {k: r for k, r in self._index.items() if r < rows}
+        used = max(valid.values()) + 1 if valid else 0
+        if size != used * row_bytes:
+            os.truncate(self.vec_path, used * row_bytes)
+        keys_size = self.key_path.stat().st_size if self.key_path.exists() else 0
+        if len(valid) != len(self._index) or keys_size != self._keys_offset:
+            tmp = self.key_path.with_suffix(".tmp")
+            tmp.write_text("".join(f"{k} {r}\n" for k, r in valid.items()), encoding="ascii")
+            os.replace(tmp, self.key_path)
+            self._keys_inode = None
+            self._read_keys()
+
+    def _rows(self, need: int) -> np.ndarray:
+        if self._mmap is None or self._mmap.shape[0] < need:
+            rows = self.vec_path.stat().st_size // (4 * self.dim)
+            if not rows:
+                return np.zeros((0, self.dim), dtype=np.float32)
+            self._mmap = np.memmap(self.vec_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._mmap
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if any(k not in self._index for k in keys):
+                self._read_keys()  # 其他进程可能已写入
+                self._read_dim()
+            hits = {k: self._index[k] for k in keys if k in self._index}
+            if not hits:
+                return {}
+            rows = self._rows(max(hits.values()) + 1)
+            return {k: np.array(rows[i]) for k, i in hits.items() if i < rows.shape[0]}
+
+    def put_many(self, items: List[Tuple[str, np.ndarray]]) -> None:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            items = [(k, v) for k, v in items if k not in self._index]
+            if not items:
+                return
+            dim = int(np.asarray(items[0][1]).shape[-1])
+            with self._file_lock():
+                self._read_dim()
+                self._read_keys()
+                if self.dim is None:
+                    self.dim_path.write_text(str(dim))
+                    self.dim = dim
+                elif dim != self.dim:
+                    return
+                items = [(k, v) for k, v in dict(items).items() if k not in self._index]
+                if not items:
+                    return
+                block = np.stack([np.asarray(v, dtype=np.float32) for _, v in items])
+                row_bytes = 4 * self.dim
+                with open(self.vec_path, "ab") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size % row_bytes:
+                        f.truncate(size - size % row_bytes)
+                    base = size // row_bytes
+                    f.write(block.tobytes())
+                with open(self.key_path, "a", encoding="ascii") as f:
+                    f.write("".join(f"{k} {base + i}\n" for i, (k, _) in enumerate(items)))
+                self._read_keys()
+
+    def __len__(self) -> int:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return len(self._index)
+
+
+class EmbeddingService:
+    def __init__(self):
+        self.batch_size = 32
+        self.wait_ms = 10
+        self.concurrency = 4
+        self.cache_enabled = True
+        self._stores: Dict[str, EmbeddingStore] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._pending: List[Tuple[str, str, asyncio.Future]] = []
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._embed_func: Optional[Callable[[List[str]], Awaitable[np.ndarray]]] = None
+        self._model = ""
+        self.cache_hits = 0
+        self.upstream_texts = 0
+        self.upstream_batches = 0
+
+    def configure(self, settings) -> None:
+        self.batch_size = max(1, settings.embedding_batch_size)
+        self.wait_ms = settings.embedding_batch_wait_ms
+        self.cache_enabled = settings.embedding_cache_enabled
+        if settings.embedding_concurrency != self.concurrency:
+            self.concurrency = settings.embedding_concurrency
+            self._sem = None
+
+    def _bind_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._sem = None
+            self._pending = []
+            self._inflight = {}
+            self._timer = None
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(max(1, self.concurrency))
+
+    def _store(self, model: str) -> EmbeddingStore:
+        s = self._stores.get(model)
+        if s is None:
+            slug = re.sub(r"[^A-Za-z0-9._-]", "_", model)
+            s = self._stores[model] = EmbeddingStore(EMBEDDING_CACHE_DIR / slug)
+        return s
+
+    async def embed(
+        self,
+        texts: List[str],
+        model: str,
+        embed_func: Callable[[List[str]], Awaitable[np.ndarray]],
+    ) -> np.ndarray:
+        """返回 (len(texts), dim) 的 float32 矩阵；命中缓存的文本不请求上游"""
+        self._bind_loop()
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        keys = [text_hash(t) for t in texts]
+        store = self._store(model) if self.cache_enabled else None
+        found: Dict[str, np.ndarray] = await asyncio.to_thread(store.get_many, keys) if store is not None else {}
+        self.cache_hits += sum(1 for k in keys if k in found)
+
+        missing: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found:
+                missing.setdefault(k, t)
+        if missing:
+            futures = {k: self._submit(model, k, t, embed_func) for k, t in missing.items()}
+            # _inflight 中的 future 由等待同一文本的所有请求共用：逐个 shield，某个请求被取消时
+            # 只取消它自己的等待，不取消共用的 future（否则其他请求会收到 CancelledError）
+            results = await asyncio.gather(*(asyncio.shield(f) for f in futures.values()))
+            fresh = list(zip(futures.keys(), results))
+            found.update(fresh)
+            if store is not None:
+                await asyncio.to_thread(store.put_many, fresh)
+        return np.stack([found[k] for k in keys]).astype(np.float32, copy=False)
+
+    def _submit(self, model: str, key: str, text: str, embed_func) -> asyncio.Future:
+        inflight = self._inflight.get((model, key))
+        if inflight is not None:
+            return inflight
+        fut = self._loop.create_future()
+        self._inflight[(model, key)] = fut
+        fut.add_done_callback(lambda _: self._inflight.pop((model, key), None))
+        # 不同模型的请求不能合进同一批：模型切换时先把已排队的发出去
+        # 绑定方法每次取值都是新对象，用 != 比较（同一对象的同一方法相等）
+        if self._pending and (model != self._model or embed_func != self._embed_func):
+            self._flush()
+        self._model = model
+        self._embed_func = embed_func
+        self._pending.append((key, text, fut))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.wait_ms / 1000.0, self._flush)
+        return fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        for i in range(0, len(pending), self.batch_size):
+            self._loop.create_task(self._send(self._embed_func, pending[i:i + self.batch_size]))
+
+    async def _send(self, embed_func, batch: List[Tuple[str, str, asyncio.Future]]) -> None:
+        async with self._sem:
+            try:
+                vecs = await embed_func([t for _, t, _ in batch])
+            except Exception as e:
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                return
+        self.upstream_batches += 1
+        self.upstream_texts += len(batch)
+        for (_, _, fut), vec in zip(batch, vecs):
+            if not fut.done():
+                fut.set_result(np.asarray(vec, dtype=np.float32))
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "cache_enabled": self.cache_enabled,
+            "cached_vectors": {m: len(s) for m, s in self._stores.items()},
+            "cache_hits": self.cache_hits,
+            "upstream_texts": self.upstream_texts,
+            "upstream_batches": self.upstream_batches,
+        }
+
+
+embedding_service = EmbeddingService()
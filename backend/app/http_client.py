@@ -0,0 +1,264 @@
+"""上游 HTTP 客户端：每个上游（DeepSeek、硅基流动，以及单独配置了地址的 embedding / rerank 服务）一个连接池化的 aiohttp.ClientSession
+
+- 在 FastAPI 启动时创建、关闭时释放；脚本场景（asyncio.run）下按需创建；
+- 连接数上限与 keep-alive 由 Settings 配置，连接在请求间复用，省去 DNS / TCP / TLS 建连；
+- 连接池参数变化时（reset）新请求改用新会话，旧会话延后关闭；
+- 单次请求可单独指定超时；
+- 遇到 429 / 5xx 或连接错误时按指数退避 + 随机抖动重试，优先遵循 Retry-After；
+  每次 429 通知 on_throttle 注册的回调（app.llm_scheduler 据此收窄 DeepSeek 并发）；
+- 每次尝试的耗时与状态码、重试次数计入 app.tracing 的上游指标。
+"""
+import asyncio
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from app.tracing import UPSTREAM_RETRIES, UPSTREAM_SECONDS
+
+UPSTREAM_DEEPSEEK = "deepseek"
+UPSTREAM_SILICONFLOW = "siliconflow"
+UPSTREAM_EMBEDDING = "embedding"  # 单独配置 EMBEDDING_API_BASE 时（见 app.providers）
+UPSTREAM_RERANK = "rerank"  # 单独配置 RERANK_API_BASE 时
+UPSTREAMS = (UPSTREAM_DEEPSEEK, UPSTREAM_SILICONFLOW)  # 启动时预先创建会话的上游，其余按需创建
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETIRED_SESSION_GRACE = 600  # 秒，配置变化后旧会话保留多久再关闭，让进行中的请求（含流式）完成
+
+
+def _retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Retry-After 的秒数形式；缺失或为 HTTP 日期时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class UpstreamError(RuntimeError):
+    """上游返回非 2xx（重试用尽后）"""
+
+    def __init__(self, upstream: str, status: int, body: str):
+        super().__init__(f"{upstream} 请求失败 {status}: {body}")
+        self.upstream = upstream
+        self.status = status
+        self.body = body
+
+
+class HttpClients:
+    def __init__(self):
+        self.limit = 100
+        self.limit_per_host = 32
+        self.keepalive_timeout = 60.0
+        self.connect_timeout = 10.0
+        self.request_timeout = 120.0
+        self.max_retries = 3
+        self.backoff_base = 0.5
+        self.backoff_max = 8.0
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._retired: List[aiohttp.ClientSession] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._generation = 0
+        self._session_generation = 0
+        self._throttle_listeners: Dict[str, List[Callable[[Optional[float]], None]]] = {}
+
+    def configure(self, settings) -> None:
+        self.limit = settings.http_pool_limit
+        self.limit_per_host = settings.http_pool_limit_per_host
+        self.keepalive_timeout = settings.http_keepalive_timeout
+        self.connect_timeout = settings.http_connect_timeout
+        self.request_timeout = settings.http_request_timeout
+        self.max_retries = settings.http_max_retries
+        self.backoff_base = settings.http_retry_backoff
+        self.backoff_max = settings.http_retry_backoff_max
+
+    def on_throttle(self, upstream: str, fn: Callable[[Optional[float]], None]) -> None:
+        """注册上游返回 429 时的回调 fn(Retry-After 秒数或 None)，在事件循环中同步调用"""
+        self._throttle_listeners.setdefault(upstream, []).append(fn)
+
+    def reset(self) -> None:
+        """连接池参数变化后调用：之后的请求使用按新配置创建的会话，旧会话延后关闭。可在任意线程中调用"""
+        self._generation += 1
+
+    async def start(self) -> None:
+        for name in UPSTREAMS:
+            self.session(name)
+
+    async def close(self) -> None:
+        sessions = list(self._sessions.values()) + self._retired
+        self._sessions.clear()
+        self._retired = []
+        for s in sessions:
+            if not s.closed:
+                await s.close()
+
+    def session(self, upstream: str) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 会话绑定在创建时的事件循环上，换循环后旧会话不可再用
+            self._sessions.clear()
+            self._retired = []
+            self._loop = loop
+        if self._session_generation != self._generation:
+            self._session_generation = self._generation
+            old = list(self._sessions.values())
+            self._sessions.clear()
+            self._retired.extend(old)
+            loop.call_later(RETIRED_SESSION_GRACE, lambda: loop.create_task(self._close_retired(old)))
+        s = self._sessions.get(upstream)
+        if s is None or s.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300,
+            )
+            s = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout, connect=self.connect_timeout),
+            )
+            self._sessions[upstream] = s
+        return s
+
+    async def _close_retired(self, sessions: List[aiohttp.ClientSession]) -> None:
+        for s in sessions:
+            if s in self._retired:
+                self._retired.remove(s)
+                if not s.closed:
+                    await s.close()
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _request(
+        self,
+        upstream: str,
+        url: str,
+        payload: Dict[str, Any],
+        headers: Dict[str, str],
+        timeout: Optional[float],
+        retries: Optional[int],
+        stream: bool = False,
+    ) -> aiohttp.ClientResponse:
+        """发起 POST 并返回状态为 2xx 的响应（调用方负责 release）；可重试的失败按退避重试。
+        stream=True 时不限总时长，timeout 作为两次读取之间的最长间隔。"""
+        max_retries = self.max_retries if retries is None else retries
+        if stream:
+            client_timeout = aiohttp.ClientTimeout(
+                total=None, connect=self.connect_timeout, sock_read=timeout or self.request_timeout
+            )
+        elif timeout:
+            client_timeout = aiohttp.ClientTimeout(total=timeout, connect=self.connect_timeout)
+        else:
+            client_timeout = None
+        endpoint = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                resp = await self.session(upstream).post(url, json=payload, headers=headers, timeout=client_timeout)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream, endpoint=endpoint, status=reason)
+                if attempt >= max_retries:
+                    raise
+                UPSTREAM_RETRIES.inc(upstream=upstream, endpoint=endpoint, reason=reason)
+                await asyncio.sleep(self._backoff(attempt, None))
+                attempt += 1
+                continue
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, upstream=upstream, endpoint=endpoint, status=resp.status)
+            if 200 <= resp.status < 300:
+                return resp
+            body = await resp.text()
+            resp.release()
+            retry_after = _retry_after_seconds(resp.headers.get("Retry-After"))
+            if resp.status == 429:
+                for fn in self._throttle_listeners.get(upstream, ()):
+                    fn(retry_after)
+            if resp.status in RETRY_STATUS and attempt < max_retries:
+                UPSTREAM_RETRIES.inc(upstream=upstream, endpoint=endpoint, reason=resp.status)
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+                attempt += 1
+                continue
+            raise UpstreamError(upstream, resp.status, body)
+
+    async def post_json(
+        self,
+        upstream: str,
+        url: str,
+        payload: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        resp = await self._request(upstream, url, payload, headers or {}, timeout, retries)
+        try:
+            return await resp.json(content_type=None)
+        finally:
+            resp.release()
+
+    async def post_sse(
+        self,
+        upstream: str,
+        url: str,
+        payload: Dict[str, Any],
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+    ) -> "SseEvents":
+        """发起流式请求：建连与状态码检查（含重试）在返回前完成，之后逐条产出 SSE data 的 JSON（SseEvents）"""
+        resp = await self._request(upstream, url, payload, headers or {}, timeout, retries, stream=True)
+        return SseEvents(resp)
+
+
+class SseEvents:
+    """流式响应中逐条 SSE data 的 JSON。读完则归还连接；中途 aclose（含尚未开始迭代时）断开连接，让上游停止生成"""
+
+    def __init__(self, resp: aiohttp.ClientResponse):
+        self._resp = resp
+        self._done = False
+
+    def __aiter__(self) -> "SseEvents":
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        if self._done:
+            raise StopAsyncIteration
+        try:
+            while True:
+                raw = await self._resp.content.readline()
+                if not raw:
+                    break
+                line = raw.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                return json.loads(data)
+        except BaseException:
+            self._finish(completed=False)
+            raise
+        self._finish(completed=True)
+        raise StopAsyncIteration
+
+    async def aclose(self) -> None:
+        self._finish(completed=False)
+
+    def _finish(self, completed: bool) -> None:
+        if self._done:
+            return
+        self._done = True
+        if completed:
+            self._resp.release()
+        else:
+            self._resp.close()
+
+
+http_clients = HttpClients()
@@ -0,0 +1,293 @@
+"""后台导入任务：创建图谱与增量更新的 LightRAG 插入在后台工作协程中执行
+
+- 任务记录在 jobs 表，输入文档（上传原文件）保存在 data/jobs/job_<id>/，进程重启后未完成的任务自动恢复；
+- 工作协程数量有上限（INGEST_WORKERS），同一 working_dir 的任务串行执行；
+- 多进程部署时任务经 jobs 表原子领取并定期续约（见 app.database 后台导入任务），同一任务只由一个进程执行，
+  同一 working_dir 不会被两个进程同时写入；持有进程退出后任务由其他进程接管；
+- 每 INGEST_BATCH_DOCS 篇文档一起交给 LightRAG（由其流水线按 MAX_PARALLEL_INSERT 并行处理），每批后更新进度
+  （文档数、文本块数、实体数、失败数），可随时取消；
+- 插入中的 LLM 调用按后台优先级经 app.llm_scheduler 调度。
+"""
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from app.config import DATA_DIR, get_settings
+from app import database_async as db
+from app.database import JOB_FINISHED, JOB_LEASE_SECONDS
+from app.llm_scheduler import background
+from app.rag_service import insert_async, invalidate_graph, graph_counts
+from app.uploads import read_text, sweep_staging
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = DATA_DIR / "jobs"
+JOB_HEARTBEAT_INTERVAL = 15  # 秒，续约运行中任务的间隔（须明显小于 JOB_LEASE_SECONDS）
+
+
+def job_input_dir(job_id: int) -> Path:
+    return JOBS_DIR / f"job_{job_id}"
+
+
+def _input_files(job_id: int) -> List[Path]:
+    d = job_input_dir(job_id)
+    if not d.exists():
+        return []
+    return sorted(p for p in d.iterdir() if p.is_file())
+
+
+class JobManager:
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._running: Dict[int, asyncio.Task] = {}
+        self._cancelled: Set[int] = set()
+        self._graph_locks: Dict[str, asyncio.Lock] = {}
+        self._changed: Optional[asyncio.Condition] = None
+        self._queued: Set[int] = set()
+        # 本进程在 jobs.owner 中的标识
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._changed = asyncio.Condition()
+        # 只清理中断残留：其他进程可能正在上传或执行任务，不能整体删除临时目录与任务输入目录
+        await asyncio.to_thread(sweep_staging)
+        await self._sweep_inputs()
+        for _ in range(max(1, get_settings().ingest_workers)):
+            self._workers.append(asyncio.create_task(self._worker()))
+        self._workers.append(asyncio.create_task(self._keepalive()))
+        await self._recover()
+
+    def _enqueue(self, job_id: int) -> None:
+        if job_id not in self._queued:
+            self._queued.add(job_id)
+            self._queue.put_nowait(job_id)
+
+    async def _recover(self) -> None:
+        """排队所有未结束的任务；其中由其他存活进程持有的任务领取不到，会被跳过。
+        LightRAG 按内容去重，接管中断的任务时已插入的文档不会重复处理"""
+        for job in await db.job_list_unfinished():
+            if job["id"] not in self._running:
+                self._enqueue(job["id"])
+
+    async def _keepalive(self) -> None:
+        """定期续约本进程运行中的任务，响应其他进程的取消；每个租约周期重新排队未结束的任务，
+        接管已退出进程遗留的任务"""
+        last_recover = asyncio.get_running_loop().time()
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+            try:
+                for job_id in await db.job_heartbeat(self.owner, list(self._running)):
+                    task = self._running.get(job_id)
+                    if task is not None and job_id not in self._cancelled:
+                        self._cancelled.add(job_id)
+                        task.cancel()
+                now = asyncio.get_running_loop().time()
+                if now - last_recover >= JOB_LEASE_SECONDS:
+                    last_recover = now
+                    await self._recover()
+            except Exception:
+                logger.exception("导入任务续约失败，将在下次重试")
+
+    async def _sweep_inputs(self) -> None:
+        """删除已结束或已不存在的任务遗留的输入目录；未结束的任务（含其他进程刚提交的）保留以便恢复"""
+        if not JOBS_DIR.exists():
+            return
+        for d in JOBS_DIR.iterdir():
+            name = d.name
+            if not (d.is_dir() and name.startswith("job_") and name[4:].isdigit()):
+                continue
+            job = await db.job_get(int(name[4:]))
+            if job is None or job["status"] in JOB_FINISHED:
+                await asyncio.to_thread(shutil.rmtree, d, True)
+
+    async def stop(self) -> None:
+        for t in self._workers:
+            t.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+        # 被中断的任务放回队列，由其他进程或下次启动时恢复
+        await db.job_release(self.owner)
+
+    async def submit(self, kind: str, graph_id: int, working_dir: str, staged_dir: Path) -> int:
+        """接管已落盘的输入目录（每个文件一篇文档，见 app.uploads）并入队，立即返回任务 id"""
+        docs_total = sum(1 for p in staged_dir.iterdir() if p.is_file())
+        job_id = await db.job_create(kind, graph_id, working_dir, docs_total=docs_total)
+        JOBS_DIR.mkdir(parents=True, exist_ok=True)
+        staged_dir.rename(job_input_dir(job_id))
+        self._enqueue(job_id)
+        return job_id
+
+    async def cancel(self, job_id: int) -> bool:
+        """取消排队中或运行中的任务；已结束的任务返回 False"""
+        job = await db.job_get(job_id)
+        if not job or job["status"] in JOB_FINISHED:
+            return False
+        self._cancelled.add(job_id)
+        task = self._running.get(job_id)
+        if task is not None:
+            task.cancel()
+        else:
+            await self._finish_cancelled(job)
+        return True
+
+    async def cancel_graph(self, graph_id: int) -> None:
+        for job in await db.job_list_unfinished():
+            if job["graph_id"] == graph_id:
+                await self.cancel(job["id"])
+
+    async def watch(self, job_id: int, heartbeat: float = 15.0) -> AsyncIterator[Optional[Dict[str, Any]]]:
+        """任务每次变化时产出最新记录，结束后停止；超过 heartbeat 秒无变化时产出 None（用于保活）"""
+        last = None
+        while True:
+            job = await db.job_get(job_id)
+            if job is None:
+                return
+            if job != last:
+                yield job
+                last = job
+            if job["status"] in JOB_FINISHED:
+                return
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=heartbeat)
+                except asyncio.TimeoutError:
+                    yield None
+
+    async def _notify(self) -> None:
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def _update(self, job_id: int, **fields) -> None:
+        await db.job_update(job_id, **fields)
+        await self._notify()
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            self._queued.discard(job_id)
+            try:
+                job = await db.job_get(job_id)
+                if not job or job["status"] in JOB_FINISHED:
+                    continue
+                lock = self._graph_locks.setdefault(job["working_dir"], asyncio.Lock())
+                async with lock:
+                    # 等锁期间可能已被取消或被其他进程领取；同一 working_dir 正由其他进程写入时也领取不到，
+                    # 由 _keepalive 定期重新排队
+                    job = await db.job_claim(job_id, self.owner)
+                    if job is None:
+                        continue
+                    # 导入中的 LLM 调用按后台优先级调度，不挤占在线查询（任务创建时复制 contextvars）
+                    with background():
+                        task = asyncio.create_task(self._run(job))
+                    self._running[job_id] = task
+                    try:
+                        await task
+                    except asyncio.CancelledError:
+                        if task.cancelled() and job_id in self._cancelled:
+                            await self._finish_cancelled(job)
+                        else:
+                            raise
+                    finally:
+                        self._running.pop(job_id, None)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("导入任务 %s 异常", job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id, working_dir = job["id"], job["working_dir"]
+        files = _input_files(job_id)
+        done = job["docs_done"] or 0
+        errors = job["errors"] or 0
+        last_error = job["error"] or ""
+        await self._update(job_id, docs_total=len(files))
+        batch_size = max(1, get_settings().ingest_batch_docs)
+        for start in range(done, len(files), batch_size):
+            paths = files[start:start + batch_size]
+            # 逐批读取，内存中同时只有一批文档
+            docs: List[Tuple[str, str]] = []
+            failures: List[str] = []
+            for path in paths:
+                try:
+                    docs.append((path.name, await asyncio.to_thread(read_text, path)))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    failures.append(f"{path.name}: {e}")
+            failures += await self._insert(job, docs)
+            for msg in failures:
+                logger.warning("导入任务 %s 文档失败: %s", job_id, msg)
+            errors += len(failures)
+            if failures:
+                last_error = failures[-1]
+            done += len(paths)
+            progress: Dict[str, Any] = {"docs_done": done, "errors": errors, "error": last_error}
+            try:
+                progress.update(await graph_counts(working_dir))
+            except Exception:
+                pass
+            await self._update(job_id, **progress)
+
+        if files and errors >= len(files):
+            await self._fail(job, last_error)
+            return
+        await self._update(job_id, status="succeeded")
+        shutil.rmtree(job_input_dir(job_id), ignore_errors=True)
+
+    async def _insert(self, job: Dict[str, Any], docs: List[Tuple[str, str]]) -> List[str]:
+        """插入一批 (文件名, 文本)，返回失败信息。整批失败时逐篇重试，只把失败的文档计入错误
+        （LightRAG 按内容去重，批内已插入的文档不会重复处理）"""
+        if not docs:
+            return []
+        is_first_time = job["kind"] == "create"
+        try:
+            await insert_async(job["working_dir"], [text for _, text in docs], is_first_time=is_first_time)
+            return []
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if len(docs) == 1:
+                return [f"{docs[0][0]}: {e}"]
+        failures = []
+        for name, text in docs:
+            try:
+                await insert_async(job["working_dir"], [text], is_first_time=is_first_time)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures.append(f"{name}: {e}")
+        return failures
+
+    async def _fail(self, job: Dict[str, Any], error: str) -> None:
+        await invalidate_graph(job["working_dir"])
+        if job["kind"] == "create":
+            await self._drop_graph(job)
+        await self._update(job["id"], status="failed", error=error)
+        shutil.rmtree(job_input_dir(job["id"]), ignore_errors=True)
+
+    async def _finish_cancelled(self, job: Dict[str, Any]) -> None:
+        # 中途取消时实例内存状态可能不完整，丢弃后由下次查询重新加载；新建的图谱整体删除
+        self._cancelled.discard(job["id"])
+        await invalidate_graph(job["working_dir"])
+        if job["kind"] == "create":
+            await self._drop_graph(job)
+        await self._update(job["id"], status="cancelled")
+        shutil.rmtree(job_input_dir(job["id"]), ignore_errors=True)
+
+    async def _drop_graph(self, job: Dict[str, Any]) -> None:
+        await db.graph_delete(job["graph_id"])
+        p = Path(job["working_dir"])
+        if p.exists():
+            shutil.rmtree(p, ignore_errors=True)
+
+
+job_manager = JobManager()
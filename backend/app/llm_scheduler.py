@@ -0,0 +1,249 @@
+"""LLM 调用调度：进程内所有 LightRAG 实例共用的 DeepSeek 并发与速率控制
+
+- 优先级：interactive（在线查询，默认）与 background（导入任务、批量查询，用 background() 标记，
+  随 contextvars 进入 LightRAG 派生的任务）。有在线查询排队时后台调用不出队；后台同时在途数另受
+  LLM_BACKGROUND_MAX_CONCURRENCY 限制（且不超过当前窗口减一），始终给在线查询留出余量；
+- 令牌桶：LLM_RPM 限制每分钟请求数，LLM_TPM 限制每分钟 token 数。发出前按文本长度估算 token，
+  完成后按上游返回的 usage 多退少补；
+- AIMD：DeepSeek 返回 429（app.http_client 回调 throttled）时并发窗口乘以 LLM_AIMD_DECREASE，并按 Retry-After
+  暂停出队；之后每次成功调用窗口加 1/窗口，逐步恢复到 LLM_MAX_CONCURRENCY；
+- 排队耗时计入 rag_llm_queue_wait_seconds{priority}，429 次数计入 rag_llm_throttled_total，
+  排队长度、在途数与窗口等即时状态见 stats()（/api/admin/metrics）。
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from app.tracing import LLM_QUEUE_SECONDS, LLM_THROTTLES
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND)  # 出队顺序
+
+OUTPUT_TOKEN_ESTIMATE = 512  # 发出前为回答预留的 token 数（完成后按实际用量校正）
+THROTTLE_PAUSE = 1.0  # 秒，429 未带 Retry-After 时暂停出队的时长
+DECREASE_INTERVAL = 1.0  # 秒，同一波 429 只收窄一次窗口
+
+_priority: ContextVar[str] = ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def background() -> Iterator[None]:
+    """代码块内（含其中派生的任务）的 LLM 调用按后台优先级调度"""
+    token = _priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_tokens(messages: List[Dict[str, Any]]) -> int:
+    """按 UTF-8 字节数粗估：中文约 1 字 1 token（3 字节），英文约 3~4 字符 1 token，宁多勿少"""
+    size = sum(len(str(m.get("content") or "").encode("utf-8")) for m in messages)
+    return size // 3 + OUTPUT_TOKEN_ESTIMATE
+
+
+class TokenBucket:
+    """每分钟额度的令牌桶，按秒匀速补充；额度为 0 表示不限制。允许透支（按实际用量补扣时）"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(0, per_minute))
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """取出 amount 还需等待的秒数；超过桶容量的请求在桶满时放行"""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill(now)
+        need = min(amount, self.capacity)
+        return 0.0 if self.level >= need else (need - self.level) * 60 / self.capacity
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.level
+
+    def take(self, amount: float) -> None:
+        """取出 amount；为负时归还（不超过容量）"""
+        if self.capacity > 0:
+            self.level = min(self.capacity, self.level - amount)
+
+
+class Slot:
+    """一次已放行的 LLM 调用；release 只生效一次"""
+
+    def __init__(self, scheduler: "LlmScheduler", priority: str, tokens: int):
+        self.priority = priority
+        self.tokens = tokens
+        self._scheduler = scheduler
+        self._loop = scheduler._loop
+        self._released = False
+
+    def release(self, usage: Optional[Dict[str, Any]] = None, ok: bool = True) -> None:
+        """调用结束：usage 为上游返回的 token 用量（用于校正 TPM），ok=False 时不扩大窗口"""
+        if self._released:
+            return
+        self._released = True
+        if self._scheduler._loop is self._loop and not self._loop.is_closed():
+            self._scheduler._release(self, usage, ok)
+
+
+class _Waiter:
+    __slots__ = ("priority", "tokens", "future", "slot")
+
+    def __init__(self, priority: str, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.tokens = tokens
+        self.future = future
+        self.slot: Optional[Slot] = None
+
+
+class LlmScheduler:
+    def __init__(self):
+        self.max_concurrency = 16
+        self.background_max_concurrency = 8
+        self.decrease = 0.5
+        self.window = float(self.max_concurrency)
+        self.throttles = 0
+        self._rpm = TokenBucket(0)
+        self._tpm = TokenBucket(0)
+        self._queues: Dict[str, Deque[_Waiter]] = {p: deque() for p in PRIORITIES}
+        self._inflight: Dict[str, int] = {p: 0 for p in PRIORITIES}
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def configure(self, settings) -> None:
+        max_concurrency = max(1, settings.llm_max_concurrency)
+        if max_concurrency != self.max_concurrency:
+            # 窗口已恢复到上限时随上限变化，否则继续按 AIMD 增长
+            at_max = self.window >= self.max_concurrency
+            self.max_concurrency = max_concurrency
+            self.window = float(max_concurrency) if at_max else min(self.window, max_concurrency)
+        self.background_max_concurrency = max(1, settings.llm_background_max_concurrency)
+        self.decrease = min(0.95, max(0.05, settings.llm_aimd_decrease))
+        if settings.llm_rpm != self._rpm.capacity:
+            self._rpm = TokenBucket(settings.llm_rpm)
+        if settings.llm_tpm != self._tpm.capacity:
+            self._tpm = TokenBucket(settings.llm_tpm)
+
+    def _bind_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queues = {p: deque() for p in PRIORITIES}
+            self._inflight = {p: 0 for p in PRIORITIES}
+            self._timer = None
+
+    async def acquire(self, messages: List[Dict[str, Any]]) -> Slot:
+        """按当前优先级排队，放行后返回 Slot；调用结束（含失败）须 release"""
+        self._bind_loop()
+        waiter = _Waiter(_priority.get(), estimate_tokens(messages), self._loop.create_future())
+        self._queues[waiter.priority].append(waiter)
+        started = time.perf_counter()
+        self._pump()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.slot is not None:
+                waiter.slot.release(ok=False)
+            else:
+                try:
+                    self._queues[waiter.priority].remove(waiter)
+                except ValueError:
+                    pass
+            raise
+        LLM_QUEUE_SECONDS.observe(time.perf_counter() - started, priority=waiter.priority)
+        return waiter.slot
+
+    def _next(self) -> Optional[_Waiter]:
+        for priority in PRIORITIES:
+            queue = self._queues[priority]
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if queue:
+                # 后台最多占到窗口减一，窗口收窄后也给在线查询留一个位置
+                limit = min(self.background_max_concurrency, max(1, int(self.window) - 1))
+                if priority == PRIORITY_BACKGROUND and self._inflight[priority] >= limit:
+                    return None
+                return queue[0]
+        return None
+
+    def _pump(self) -> None:
+        """按优先级放行排队的调用，直到窗口占满、令牌不足（定时重试）或队列为空"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while True:
+            waiter = self._next()
+            if waiter is None or sum(self._inflight.values()) >= max(1, int(self.window)):
+                return
+            now = time.monotonic()
+            delay = max(
+                self._paused_until - now, self._rpm.wait_time(1, now), self._tpm.wait_time(waiter.tokens, now)
+            )
+            if delay > 0:
+                self._timer = self._loop.call_later(delay, self._pump)
+                return
+            self._queues[waiter.priority].popleft()
+            self._rpm.take(1)
+            self._tpm.take(waiter.tokens)
+            self._inflight[waiter.priority] += 1
+            waiter.slot = Slot(self, waiter.priority, waiter.tokens)
+            waiter.future.set_result(None)
+
+    def _release(self, slot: Slot, usage: Optional[Dict[str, Any]], ok: bool) -> None:
+        self._inflight[slot.priority] = max(0, self._inflight[slot.priority] - 1)
+        used = _usage_tokens(usage)
+        if used is not None:
+            self._tpm.take(used - slot.tokens)
+        if ok:
+            self.window = min(float(self.max_concurrency), self.window + 1 / max(1.0, self.window))
+        self._pump()
+
+    def throttled(self, retry_after: Optional[float]) -> None:
+        """上游返回 429：收窄并发窗口并暂停出队（由 app.http_client 在每次 429 时调用）"""
+        self.throttles += 1
+        LLM_THROTTLES.inc()
+        now = time.monotonic()
+        if now - self._last_decrease >= DECREASE_INTERVAL:
+            self._last_decrease = now
+            self.window = max(1.0, self.window * self.decrease)
+        pause = retry_after if retry_after is not None else THROTTLE_PAUSE
+        self._paused_until = max(self._paused_until, now + pause)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "queued": {p: sum(1 for w in q if not w.future.done()) for p, q in self._queues.items()},
+            "inflight": dict(self._inflight),
+            "window": round(self.window, 2),
+            "max_concurrency": self.max_concurrency,
+            "rpm_available": round(self._rpm.available(now), 1) if self._rpm.capacity else None,
+            "tpm_available": round(self._tpm.available(now)) if self._tpm.capacity else None,
+            "paused_seconds": round(max(0.0, self._paused_until - now), 3),
+            "throttles": self.throttles,
+        }
+
+
+def _usage_tokens(usage: Optional[Dict[str, Any]]) -> Optional[int]:
+    if not isinstance(usage, dict):
+        return None
+    total = usage.get("total_tokens")
+    if isinstance(total, (int, float)):
+        return int(total)
+    parts = [usage.get(k) for k in ("prompt_tokens", "completion_tokens")]
+    if any(isinstance(n, (int, float)) for n in parts):
+        return int(sum(n for n in parts if isinstance(n, (int, float))))
+    return None
+
+
+llm_scheduler = LlmScheduler()
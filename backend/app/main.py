@@ -1,17 +1,124 @@
 """FastAPI 主应用"""
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import Callable
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.config import get_settings, ensure_dirs
-from app.database import init_db
+from app.config import SETTINGS_POLL_INTERVAL, get_settings, ensure_dirs, reload_settings
+from app.database import (
+    init_db,
+    close_pool,
+    shutdown_executor,
+    run_db,
+    query_stat_flush,
+    query_history_flush,
+    query_history_purge,
+    stat_counters,
+)
+from app.http_client import http_clients
+from app.jobs import job_manager
+from app.rag_service import check_graph_dims, rag_pool
 from app.routers import api, admin
+from app.uploads import UploadLimitMiddleware
+
+logger = logging.getLogger(__name__)
 
 ensure_dirs()
 init_db()
 
-app = FastAPI(title="LightRAG Web API", version="1.0.0")
+POOL_SWEEP_INTERVAL = 60  # 秒
+
+
+async def _pool_sweeper():
+    while True:
+        await asyncio.sleep(POOL_SWEEP_INTERVAL)
+        await rag_pool.sweep()
+
+
+async def _settings_watcher():
+    """.env 的 mtime 变化时重新加载配置（手工编辑 .env 也能生效）"""
+    while True:
+        await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+        try:
+            await asyncio.to_thread(reload_settings, False)
+        except Exception:
+            logger.exception("重新加载配置失败")
+
+
+async def _periodic(interval: Callable[[], float], fn, what: str):
+    """每 interval() 秒在 DB 线程中执行一次 fn，失败记录日志后继续。
+    间隔每轮按当前配置重新计算，热加载后即生效；interval() <= 0 时暂停，恢复为正数后继续执行"""
+    last = time.monotonic()
+    while True:
+        seconds = interval()
+        if seconds <= 0:
+            await asyncio.sleep(SETTINGS_POLL_INTERVAL)
+            last = time.monotonic()
+            continue
+        remaining = last + seconds - time.monotonic()
+        if remaining > 0:
+            # 分段等待，间隔被调小时不必等完旧的间隔
+            await asyncio.sleep(min(remaining, SETTINGS_POLL_INTERVAL))
+            continue
+        last = time.monotonic()
+        try:
+            await run_db(fn)
+        except Exception:
+            logger.exception("%s失败，将在下次重试", what)
+
+
+def _stats_flush_interval() -> float:
+    # 直写模式（QUERY_STATS_FLUSH_INTERVAL<=0）下计数在记录时即写入，仍定期补写切换前尚未写入的增量
+    interval = get_settings().query_stats_flush_interval
+    return interval if interval > 0 else SETTINGS_POLL_INTERVAL
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    http_clients.configure(get_settings())
+    await http_clients.start()
+    await job_manager.start()
+    settings = get_settings()
+    # 配置的向量维度与已有图谱不一致时，这些图谱在加载时会被拒绝（见 rag_service._make_rag）
+    for g in await run_db(check_graph_dims):
+        logger.error(
+            "图谱 %s（%s）的向量维度为 %s，与 EMBEDDING_DIM=%s 不一致，查询与增量导入将失败",
+            g["id"], g["name"], g["dim"], settings.embedding_dim,
+        )
+    background = [asyncio.create_task(_pool_sweeper()), asyncio.create_task(_settings_watcher())]
+    if settings.history_purge_interval > 0:
+        await run_db(query_history_purge)
+    background += [
+        asyncio.create_task(_periodic(_stats_flush_interval, query_stat_flush, "查询计数写入")),
+        asyncio.create_task(_periodic(
+            lambda: max(0.05, get_settings().history_flush_interval), query_history_flush, "查询记录写入"
+        )),
+        asyncio.create_task(_periodic(
+            lambda: get_settings().history_purge_interval, query_history_purge, "过期查询记录清理"
+        )),
+    ]
+    try:
+        yield
+    finally:
+        for t in background:
+            t.cancel()
+        await job_manager.stop()
+        await rag_pool.close_all()
+        await http_clients.close()
+        # 退出前写入内存中的查询计数与查询记录
+        stat_counters.close()
+        query_history_flush()
+        close_pool()
+        shutdown_executor()
+
+
+app = FastAPI(title="LightRAG Web API", version="1.0.0", lifespan=lifespan)
 
+app.add_middleware(UploadLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
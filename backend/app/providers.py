@@ -0,0 +1,379 @@
+"""上游模型提供方：embedding 与 rerank 分别配置地址、密钥、模型、维度、批大小与并发
+
+- http：OpenAI 兼容接口（硅基流动，或集群内自建的 TEI / Infinity / vLLM 等服务）的 /embeddings 与 /rerank。
+  未单独配置 EMBEDDING_API_BASE / RERANK_API_BASE 时沿用 SILICONCLOUD_API_BASE、SILICONCLOUD_API_KEY
+  与硅基流动的连接池；单独配置时使用独立连接池（指标中 upstream 为 embedding / rerank），密钥可留空；
+- local：在本进程内用 sentence-transformers 加载模型（可选依赖：pip install sentence-transformers），
+  推理在线程中执行，不经网络。模型名沿用 SILICONCLOUD_EMBEDDING_MODEL / SILICONCLOUD_RERANK_MODEL
+  （Hugging Face 模型名或本地路径）；
+- embedding 的合批与并发由 app.embedding_service 控制（EMBEDDING_BATCH_SIZE / EMBEDDING_CONCURRENCY），
+  返回向量的维度须等于 EMBEDDING_DIM；
+- rerank 文档数超过 RERANK_BATCH_SIZE 时拆成多次调用，并发数受 RERANK_CONCURRENCY 限制，按分数合并后取 top_n。
+
+Rerank 后端（RERANKERS）：http（上述接口）、local（CrossEncoder）、bm25（对候选文本现算 BM25，纯 numpy，无网络与模型）。
+默认用 RERANK_PROVIDER，图谱或单次请求可另选（use_reranker）；所选后端超过 RERANK_BUDGET_MS 或出错时
+改用 RERANK_FALLBACK。实际使用的后端、是否降级与分数记入 app.tracing。
+"""
+import asyncio
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app import tracing
+from app.http_client import UPSTREAM_EMBEDDING, UPSTREAM_RERANK, UPSTREAM_SILICONFLOW, http_clients
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_HTTP = "http"
+PROVIDER_LOCAL = "local"
+PROVIDER_BM25 = "bm25"
+PROVIDERS = (PROVIDER_HTTP, PROVIDER_LOCAL)  # embedding 可选
+RERANKERS = (PROVIDER_HTTP, PROVIDER_LOCAL, PROVIDER_BM25)  # rerank 可选
+
+# 当前请求选用的 rerank 后端（None 表示 RERANK_PROVIDER）；LightRAG 派生的任务会复制 contextvars
+_selected_reranker: ContextVar[Optional[str]] = ContextVar("rag_reranker", default=None)
+
+# 已加载的本地模型按 (类型, 模型, 设备) 复用，配置变化但模型不变时不重新加载
+_local_models: Dict[Tuple[str, str, str], Any] = {}
+_local_lock = threading.Lock()
+
+
+def _auth_headers(api_key: str) -> Dict[str, str]:
+    headers = {"Content-Type": "application/json"}
+    if api_key:
+        headers["Authorization"] = f"Bearer {api_key}"
+    return headers
+
+
+def _load_local(kind: str, model: str, device: str):
+    """加载 sentence-transformers 模型（SentenceTransformer 或 CrossEncoder），未安装时抛出明确错误"""
+    key = (kind, model, device)
+    with _local_lock:
+        m = _local_models.get(key)
+        if m is None:
+            try:
+                import sentence_transformers
+            except ImportError as e:
+                raise ValueError(
+                    f"本地模型需要 sentence-transformers（{e}），请执行: pip install sentence-transformers"
+                )
+            cls = sentence_transformers.SentenceTransformer if kind == "embedding" else sentence_transformers.CrossEncoder
+            m = _local_models[key] = cls(model, device=device)
+        return m
+
+
+class HttpEmbedding:
+    """OpenAI 兼容 /embeddings 接口"""
+
+    kind = PROVIDER_HTTP
+
+    def __init__(self, api_base: str, api_key: str, model: str, dim: int, timeout: float, upstream: str):
+        self.url = f"{api_base.rstrip('/')}/embeddings"
+        self.api_key = api_key
+        self.model = model
+        self.dim = dim
+        self.timeout = timeout
+        self.upstream = upstream
+        # 向量缓存按模型区分：同一模型换用其他地址的服务时缓存仍然有效
+        self.cache_key = model
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        data = await http_clients.post_json(
+            self.upstream,
+            self.url,
+            {"model": self.model, "input": texts, "encoding_format": "float"},
+            headers=_auth_headers(self.api_key),
+            timeout=self.timeout,
+        )
+        tracing.count_tokens(self.upstream, data.get("usage"))
+        items = sorted(data.get("data") or [], key=lambda d: d.get("index", 0))
+        vecs = np.array([d["embedding"] for d in items], dtype=np.float32)
+        _check_vectors(vecs, len(texts), self.dim)
+        return vecs
+
+
+class LocalEmbedding:
+    """本进程内的 sentence-transformers 向量模型"""
+
+    kind = PROVIDER_LOCAL
+
+    def __init__(self, model: str, dim: int, device: str):
+        self.model = model
+        self.dim = dim
+        self.device = device
+        self.cache_key = f"local:{model}"
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        m = _load_local("embedding", self.model, self.device)
+        vecs = m.encode(texts, batch_size=len(texts), normalize_embeddings=True, convert_to_numpy=True)
+        return np.asarray(vecs, dtype=np.float32)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        vecs = await asyncio.to_thread(self._encode, texts)
+        _check_vectors(vecs, len(texts), self.dim)
+        return vecs
+
+
+def _check_vectors(vecs: np.ndarray, n: int, dim: int) -> None:
+    if vecs.ndim != 2 or vecs.shape[0] != n:
+        raise ValueError(f"embedding 返回 {vecs.shape[0] if vecs.ndim else 0} 条向量，请求 {n} 条")
+    if vecs.shape[1] != dim:
+        raise ValueError(f"embedding 返回的向量维度为 {vecs.shape[1]}，与配置 EMBEDDING_DIM={dim} 不一致")
+
+
+class HttpRerank:
+    """OpenAI 兼容风格的 /rerank 接口（硅基流动、TEI、Infinity 等）"""
+
+    kind = PROVIDER_HTTP
+
+    def __init__(self, api_base: str, api_key: str, model: str, timeout: float, upstream: str):
+        self.url = f"{api_base.rstrip('/')}/rerank"
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.upstream = upstream
+
+    async def rerank(self, query: str, documents: List[str], top_n: Optional[int]) -> List[Dict[str, Any]]:
+        payload: Dict[str, Any] = {"model": self.model, "query": query, "documents": documents}
+        if top_n is not None:
+            payload["top_n"] = top_n
+        data = await http_clients.post_json(
+            self.upstream, self.url, payload, headers=_auth_headers(self.api_key), timeout=self.timeout
+        )
+        results = data.get("results") or []
+        out = []
+        for i, r in enumerate(results):
+            idx = r.get("index", i)
+            score = r.get("relevance_score") or r.get("score", 0.0)
+            out.append({"index": idx, "relevance_score": float(score)})
+        return out
+
+
+class LocalRerank:
+    """本进程内的 sentence-transformers CrossEncoder"""
+
+    kind = PROVIDER_LOCAL
+
+    def __init__(self, model: str, device: str):
+        self.model = model
+        self.device = device
+
+    def _predict(self, query: str, documents: List[str]) -> List[float]:
+        m = _load_local("rerank", self.model, self.device)
+        return [float(s) for s in m.predict([(query, d) for d in documents])]
+
+    async def rerank(self, query: str, documents: List[str], top_n: Optional[int]) -> List[Dict[str, Any]]:
+        scores = await asyncio.to_thread(self._predict, query, documents)
+        out = sorted(({"index": i, "relevance_score": s} for i, s in enumerate(scores)), key=lambda r: -r["relevance_score"])
+        return out[:top_n] if top_n is not None else out
+
+
+# BM25：英文数字按词，中文按单字并补相邻二字组（近似分词）
+_TERM_RE = re.compile(r"[A-Za-z0-9_]+|[\u3400-\u9fff]")
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def bm25_terms(text: str) -> List[str]:
+    tokens = [t.lower() for t in _TERM_RE.findall(text)]
+    bigrams = [a + b for a, b in zip(tokens, tokens[1:]) if a >= "\u3400" and b >= "\u3400"]
+    return tokens + bigrams
+
+
+def bm25_scores(query: str, documents: List[str]) -> np.ndarray:
+    """以候选文本本身为语料计算 BM25，按最高分归一化到 [0, 1]（与 rerank 模型的分数范围一致）"""
+    q_terms = list(dict.fromkeys(bm25_terms(query)))
+    n = len(documents)
+    if not q_terms or not n:
+        return np.zeros(n, dtype=np.float32)
+    vocab = {t: j for j, t in enumerate(q_terms)}
+    tf = np.zeros((n, len(q_terms)), dtype=np.float32)
+    lengths = np.empty(n, dtype=np.float32)
+    for i, doc in enumerate(documents):
+        terms = bm25_terms(doc)
+        lengths[i] = len(terms)
+        for t in terms:
+            j = vocab.get(t)
+            if j is not None:
+                tf[i, j] += 1
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((n - df + 0.5) / (df + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / (lengths.mean() or 1.0))
+    scores = (idf * tf * (BM25_K1 + 1) / (tf + norm[:, None])).sum(axis=1)
+    top = float(scores.max())
+    return scores / top if top > 0 else scores
+
+
+class Bm25Rerank:
+    """本地词法打分，不依赖网络与模型"""
+
+    kind = PROVIDER_BM25
+
+    async def rerank(self, query: str, documents: List[str], top_n: Optional[int]) -> List[Dict[str, Any]]:
+        scores = bm25_scores(query, documents)
+        order = np.argsort(-scores, kind="stable")
+        if top_n is not None:
+            order = order[:top_n]
+        return [{"index": int(i), "relevance_score": float(scores[i])} for i in order]
+
+
+@contextmanager
+def use_reranker(name: Optional[str]) -> Iterator[None]:
+    """在代码块内（含其中派生的任务）使用指定的 rerank 后端；None 表示默认（RERANK_PROVIDER）"""
+    token = _selected_reranker.set(name)
+    try:
+        yield
+    finally:
+        try:
+            _selected_reranker.reset(token)
+        except ValueError:
+            # 异步生成器在其他上下文中被关闭
+            _selected_reranker.set(None)
+
+
+class Providers:
+    """按 Settings 创建 embedding 提供方与各 rerank 后端；配置不变时复用同一对象"""
+
+    def __init__(self):
+        self.rerank_default = PROVIDER_HTTP
+        self.rerank_fallback = PROVIDER_BM25
+        self.rerank_budget = 0.0  # 秒
+        self.rerank_batch_size = 0
+        self.rerank_concurrency = 4
+        self._embedding = None
+        self._embedding_spec: Optional[tuple] = None
+        self._rerankers: Dict[str, Any] = {PROVIDER_BM25: Bm25Rerank()}
+        self._rerank_spec: Optional[tuple] = None
+        self._missing_key: List[str] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sem: Optional[asyncio.Semaphore] = None
+
+    def configure(self, settings) -> None:
+        embedding_provider = settings.embedding_provider.strip().lower()
+        rerank_provider = settings.rerank_provider.strip().lower()
+        rerank_fallback = settings.rerank_fallback.strip().lower()
+        if embedding_provider not in PROVIDERS:
+            raise ValueError(f"EMBEDDING_PROVIDER 无效：{settings.embedding_provider}（可选 {' / '.join(PROVIDERS)}）")
+        if rerank_provider not in RERANKERS:
+            raise ValueError(f"RERANK_PROVIDER 无效：{settings.rerank_provider}（可选 {' / '.join(RERANKERS)}）")
+        if rerank_fallback and rerank_fallback not in RERANKERS:
+            raise ValueError(f"RERANK_FALLBACK 无效：{settings.rerank_fallback}（可选 {' / '.join(RERANKERS)}，或留空）")
+        missing = []
+
+        embedding_base = settings.embedding_api_base or settings.siliconcloud_api_base
+        embedding_key = settings.embedding_api_key or settings.siliconcloud_api_key
+        spec = (embedding_provider, embedding_base, embedding_key, settings.siliconcloud_embedding_model,
+                settings.embedding_dim, settings.embedding_timeout, settings.local_model_device)
+        if spec != self._embedding_spec:
+            self._embedding_spec = spec
+            if embedding_provider == PROVIDER_LOCAL:
+                self._embedding = LocalEmbedding(
+                    settings.siliconcloud_embedding_model, settings.embedding_dim, settings.local_model_device
+                )
+            else:
+                self._embedding = HttpEmbedding(
+                    embedding_base, embedding_key, settings.siliconcloud_embedding_model, settings.embedding_dim,
+                    settings.embedding_timeout,
+                    UPSTREAM_EMBEDDING if settings.embedding_api_base else UPSTREAM_SILICONFLOW,
+                )
+        if embedding_provider == PROVIDER_HTTP and not settings.embedding_api_base and not embedding_key:
+            missing.append("embedding")
+
+        rerank_base = settings.rerank_api_base or settings.siliconcloud_api_base
+        rerank_key = settings.rerank_api_key or settings.siliconcloud_api_key
+        spec = (rerank_base, rerank_key, settings.siliconcloud_rerank_model, settings.rerank_timeout,
+                settings.local_model_device)
+        if spec != self._rerank_spec:
+            self._rerank_spec = spec
+            self._rerankers[PROVIDER_HTTP] = HttpRerank(
+                rerank_base, rerank_key, settings.siliconcloud_rerank_model, settings.rerank_timeout,
+                UPSTREAM_RERANK if settings.rerank_api_base else UPSTREAM_SILICONFLOW,
+            )
+            self._rerankers[PROVIDER_LOCAL] = LocalRerank(settings.siliconcloud_rerank_model, settings.local_model_device)
+        if rerank_provider == PROVIDER_HTTP and not settings.rerank_api_base and not rerank_key:
+            missing.append("rerank")
+        self._missing_key = missing
+
+        self.rerank_default = rerank_provider
+        self.rerank_fallback = rerank_fallback
+        self.rerank_budget = max(0, settings.rerank_budget_ms) / 1000
+        self.rerank_batch_size = max(0, settings.rerank_batch_size)
+        if settings.rerank_concurrency != self.rerank_concurrency:
+            self.rerank_concurrency = settings.rerank_concurrency
+            self._sem = None
+
+    def check(self) -> None:
+        """硅基流动的 embedding / rerank 需要密钥；单独配置了地址的服务与本地模型不需要"""
+        if self._missing_key:
+            raise ValueError(
+                "请在 .env 中配置 SILICONCLOUD_API_KEY"
+                f"（或为 {' / '.join(self._missing_key)} 单独配置 EMBEDDING_API_BASE / RERANK_API_BASE，或使用本地模型）"
+            )
+
+    def embedding(self):
+        return self._embedding
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._sem is None:
+            self._loop = loop
+            self._sem = asyncio.Semaphore(max(1, self.rerank_concurrency))
+        return self._sem
+
+    async def _rerank_with(self, backend, query: str, documents: List[str], top_n: Optional[int]) -> List[Dict[str, Any]]:
+        """用一个后端打分；文档较多时分批并发调用后合并（bm25 不分批）"""
+        if backend.kind == PROVIDER_BM25:
+            return await backend.rerank(query, documents, top_n)
+        size = self.rerank_batch_size or len(documents)
+        if size >= len(documents):
+            async with self._semaphore():
+                return await backend.rerank(query, documents, top_n)
+
+        async def one(offset: int) -> List[Dict[str, Any]]:
+            batch = documents[offset:offset + size]
+            # 全局前 top_n 必然在各批各自的前 top_n 中
+            n = min(top_n, len(batch)) if top_n is not None else None
+            async with self._semaphore():
+                ranked = await backend.rerank(query, batch, n)
+            return [{"index": r["index"] + offset, "relevance_score": r["relevance_score"]}
+                    for r in ranked if 0 <= r["index"] < len(batch)]
+
+        parts = await asyncio.gather(*(one(i) for i in range(0, len(documents), size)))
+        merged = sorted((r for part in parts for r in part), key=lambda r: -r["relevance_score"])
+        return merged[:top_n] if top_n is not None else merged
+
+    async def rerank(self, query: str, documents: List[str], top_n: Optional[int] = None) -> List[Dict[str, Any]]:
+        """返回按分数降序的 [{"index", "relevance_score"}]。使用当前选定的后端（use_reranker，默认 RERANK_PROVIDER），
+        超过 RERANK_BUDGET_MS 或出错时改用 RERANK_FALLBACK"""
+        if not documents:
+            return []
+        name = _selected_reranker.get() or self.rerank_default
+        fallback = self.rerank_fallback if self.rerank_fallback != name else ""
+        started = time.perf_counter()
+        try:
+            call = self._rerank_with(self._rerankers[name], query, documents, top_n)
+            if fallback and self.rerank_budget > 0:
+                ranked = await asyncio.wait_for(call, self.rerank_budget)
+            else:
+                ranked = await call
+        except Exception as e:
+            if not fallback:
+                tracing.rerank_result(name, None, None, len(documents), [], time.perf_counter() - started, ok=False)
+                raise
+            reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+            if reason == "error":
+                logger.warning("rerank 后端 %s 出错，改用 %s: %s", name, fallback, e)
+            ranked = await self._rerank_with(self._rerankers[fallback], query, documents, top_n)
+            tracing.rerank_result(fallback, name, reason, len(documents), ranked, time.perf_counter() - started)
+            return ranked
+        tracing.rerank_result(name, None, None, len(documents), ranked, time.perf_counter() - started)
+        return ranked
+
+
+providers = Providers()
@@ -0,0 +1,101 @@
+"""每日查询配额：查询前原子预占、失败时退还
+
+- 计数保存在内存（见 app.database 查询统计，定期批量写入 SQLite），检查与 +1 在同一把锁内完成，
+  并发请求不会越过 daily_limit；计数已加载时预占是纯内存操作，不经过 DB 线程；
+- 图谱限额来自 graphs.daily_limit，登录用户另有 USER_DAILY_LIMIT（0 表示不限次，仍计数）；
+- 查询失败、流式中途断开、或按配置不计数时退还预占；
+- 剩余次数直接由计数得出，不需要额外查询；
+- 只检索不生成回答的查询（/api/query/context）单独计数，上限为 CONTEXT_DAILY_LIMIT，不占 daily_limit。
+"""
+import asyncio
+from typing import Any, Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+from app import database as _db
+from app.config import get_settings
+from app.database import run_db, stat_counters
+
+
+async def _call(graph_id: int, username: Optional[str], fn: Callable[..., Any], *args: Any) -> Any:
+    # 计数已在内存中且不是逐次写入模式时直接调用，否则在 DB 线程中执行（可能要读库或写库）
+    if not stat_counters.write_through and _db.quota_is_cached(graph_id, username):
+        return fn(*args)
+    return await run_db(fn, *args)
+
+
+class Reservation:
+    """一次查询占用的今日次数；charged=False 表示未占用（仅携带用量供展示）"""
+
+    def __init__(self, graph_id: int, info: Dict[str, Any], charged: bool):
+        self.graph_id = graph_id
+        self.stat_date: Optional[str] = info.get("stat_date")
+        self.used: int = info["used"]
+        self.limit: int = info["limit"]
+        self.user_id: Optional[int] = info["user_id"]
+        self.user_used: Optional[int] = info["user_used"]
+        self.user_limit: int = info["user_limit"]
+        self.charged = charged
+
+    def usage(self) -> Dict[str, Any]:
+        return {
+            "today_used": self.used,
+            "daily_limit": self.limit,
+            "remaining": max(0, self.limit - self.used),
+            "user_used": self.user_used,
+            "user_daily_limit": self.user_limit or None,
+            "user_remaining": max(0, self.user_limit - self.user_used)
+            if self.user_limit > 0 and self.user_used is not None else None,
+        }
+
+
+async def reserve(graph: Dict[str, Any], username: Optional[str]) -> Reservation:
+    """预占一次；图谱或用户今日次数已满时返回 429"""
+    user_limit = get_settings().user_daily_limit
+    info = await _call(graph["id"], username, _db.quota_reserve, graph["id"], graph["daily_limit"], username, user_limit)
+    if not info["ok"]:
+        if info["reason"] == "user":
+            detail = f"您今日的查询次数已达上限（{user_limit} 次），请明日再试。"
+        else:
+            detail = f"今日查询次数已达上限（{graph['daily_limit']} 次），请明日再试。"
+        raise HTTPException(status_code=429, detail=detail)
+    return Reservation(graph["id"], info, charged=True)
+
+
+async def peek(graph: Dict[str, Any], username: Optional[str]) -> Reservation:
+    """不占用次数，仅读取今日用量（命中缓存且不计数时使用）"""
+    info = await _call(graph["id"], username, _db.quota_usage, graph["id"], username)
+    info.update(limit=graph["daily_limit"], user_limit=get_settings().user_daily_limit)
+    return Reservation(graph["id"], info, charged=False)
+
+
+async def refund(res: Reservation) -> None:
+    """退还预占；重复调用无副作用"""
+    if not res.charged:
+        return
+    res.charged = False
+    res.used -= 1
+    if res.user_used is not None:
+        res.user_used -= 1
+    if stat_counters.write_through:
+        await asyncio.shield(run_db(_db.quota_refund, res.graph_id, res.stat_date, res.user_id))
+    else:
+        _db.quota_refund(res.graph_id, res.stat_date, res.user_id)
+
+
+async def usage(graph: Dict[str, Any], username: Optional[str]) -> Dict[str, Any]:
+    """图谱及当前用户的今日用量与剩余次数"""
+    return (await peek(graph, username)).usage()
+
+
+async def reserve_context(graph: Dict[str, Any]) -> Dict[str, Any]:
+    """预占一次只检索查询，返回 {"stat_date", "used", "limit"}；今日次数已满时返回 429"""
+    info = await run_db(_db.context_quota_reserve, graph["id"], get_settings().context_daily_limit)
+    if not info["ok"]:
+        raise HTTPException(status_code=429, detail=f"今日检索次数已达上限（{info['limit']} 次），请明日再试。")
+    return info
+
+
+async def refund_context(graph: Dict[str, Any], info: Dict[str, Any]) -> None:
+    info["used"] -= 1
+    await asyncio.shield(run_db(_db.context_quota_refund, graph["id"], info["stat_date"]))
@@ -0,0 +1,175 @@
+"""LightRAG 实例池：按 working_dir 复用已初始化的实例，避免每次查询重建并重新加载存储
+
+淘汰策略：
+- LRU：实例数超过 max_instances 时淘汰最久未使用的；
+- 空闲超时：超过 idle_ttl 秒未使用的实例由 sweep() 回收；
+- 内存预算：以 working_dir 下存储文件大小估算常驻内存，总和超过预算时按 LRU 淘汰。
+被淘汰或失效的实例若仍有请求在使用，会等最后一个使用者释放后再 finalize_storages。
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _dir_size(working_dir: str) -> int:
+    """working_dir 顶层存储文件（kv / vdb / graphml）的总字节数，用作内存占用估算"""
+    total = 0
+    try:
+        with os.scandir(working_dir) as it:
+            for e in it:
+                if e.is_file(follow_symlinks=False):
+                    total += e.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return total
+
+
+class _PoolEntry:
+    __slots__ = ("working_dir", "rag", "size_bytes", "last_used", "refs", "retired", "generation")
+
+    def __init__(self, working_dir: str, rag: Any, generation: int = 0):
+        self.working_dir = working_dir
+        self.generation = generation
+        self.rag = rag
+        self.size_bytes = _dir_size(working_dir)
+        self.last_used = time.monotonic()
+        self.refs = 0
+        self.retired = False
+
+
+class RagPool:
+    """进程级 LightRAG 实例注册表（仅在同一个事件循环内复用）"""
+
+    def __init__(self, max_instances: int = 8, idle_ttl: float = 1800, memory_budget_bytes: int = 0):
+        self.max_instances = max_instances
+        self.idle_ttl = idle_ttl
+        self.memory_budget_bytes = memory_budget_bytes
+        self._entries: "OrderedDict[str, _PoolEntry]" = OrderedDict()
+        self._key_locks: Dict[str, asyncio.Lock] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._generation = 0
+
+    def configure(self, max_instances: int, idle_ttl: float, memory_budget_bytes: int) -> None:
+        self.max_instances = max_instances
+        self.idle_ttl = idle_ttl
+        self.memory_budget_bytes = memory_budget_bytes
+
+    def expire_all(self) -> None:
+        """让现有实例全部过期（如 API Key、模型变化）：之后的 acquire 重新创建，旧实例在空闲时 finalize。
+        只修改计数，可在任意线程中调用"""
+        self._generation += 1
+
+    def _bind_loop(self) -> None:
+        """实例内部的锁与连接绑定在创建时的事件循环上；换了循环（如 asyncio.run）则丢弃旧实例"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._entries.clear()
+            self._key_locks.clear()
+            self._loop = loop
+
+    @asynccontextmanager
+    async def acquire(self, working_dir: str, factory: Callable[[str], Awaitable[Any]]):
+        """取出（必要时创建并初始化）working_dir 对应的实例，使用期间不会被 finalize"""
+        self._bind_loop()
+        key = os.path.normpath(working_dir)
+        entry = self._entries.get(key)
+        if entry is not None and entry.generation != self._generation:
+            self._entries.pop(key, None)
+            await self._retire(entry)
+            entry = None
+        if entry is None:
+            lock = self._key_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    generation = self._generation
+                    rag = await factory(working_dir)
+                    entry = _PoolEntry(key, rag, generation)
+                    self._entries[key] = entry
+        self._entries.move_to_end(key)
+        entry.refs += 1
+        entry.last_used = time.monotonic()
+        try:
+            # 在 try 内：等待淘汰其他实例时被取消或出错也要释放引用，否则该实例永远不会被 finalize
+            await self._enforce_limits(keep=key)
+            yield entry.rag
+        finally:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            if entry.retired:
+                if entry.refs == 0:
+                    await self._finalize(entry)
+            else:
+                # 插入后存储文件会变大，释放时刷新估算
+                entry.size_bytes = _dir_size(entry.working_dir)
+
+    async def invalidate(self, working_dir: str) -> None:
+        """图谱数据在池外被修改或删除时调用：移出池并 finalize（使用中则延后）"""
+        if self._loop is not None and self._loop is not asyncio.get_running_loop():
+            return
+        entry = self._entries.pop(os.path.normpath(working_dir), None)
+        if entry is not None:
+            await self._retire(entry)
+
+    async def sweep(self) -> None:
+        """回收空闲超时或已过期（expire_all）的实例"""
+        if self._loop is None or self._loop is not asyncio.get_running_loop():
+            return
+        now = time.monotonic()
+        expired = [
+            e for e in self._entries.values()
+            if e.refs == 0 and (
+                (self.idle_ttl > 0 and now - e.last_used > self.idle_ttl) or e.generation != self._generation
+            )
+        ]
+        for e in expired:
+            self._entries.pop(e.working_dir, None)
+            await self._retire(e)
+
+    async def close_all(self) -> None:
+        if self._loop is None or self._loop is not asyncio.get_running_loop():
+            return
+        entries = list(self._entries.values())
+        self._entries.clear()
+        for e in entries:
+            await self._retire(e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "instances": len(self._entries),
+            "max_instances": self.max_instances,
+            "memory_bytes": sum(e.size_bytes for e in self._entries.values()),
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "working_dirs": list(self._entries.keys()),
+        }
+
+    async def _enforce_limits(self, keep: str) -> None:
+        def over() -> bool:
+            if self.max_instances > 0 and len(self._entries) > self.max_instances:
+                return True
+            if self.memory_budget_bytes > 0:
+                return sum(e.size_bytes for e in self._entries.values()) > self.memory_budget_bytes
+            return False
+
+        while over():
+            victim = next((k for k in self._entries if k != keep), None)
+            if victim is None:
+                break
+            await self._retire(self._entries.pop(victim))
+
+    async def _retire(self, entry: _PoolEntry) -> None:
+        entry.retired = True
+        if entry.refs == 0:
+            await self._finalize(entry)
+
+    async def _finalize(self, entry: _PoolEntry) -> None:
+        try:
+            await entry.rag.finalize_storages()
+        except Exception:
+            logger.exception("finalize_storages 失败: %s", entry.working_dir)
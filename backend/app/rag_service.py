@@ -1,154 +1,311 @@
 """LightRAG 封装：按 working_dir 初始化、查询、插入"""
 import asyncio
+import hashlib
+import logging
+import os
+import re
 import sys
+import time
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Dict, Any, Tuple
 
 import numpy as np
-import aiohttp
 
 # 确保可导入 lightrag（项目根或已安装 lightrag-hku）
 _project_root = Path(__file__).resolve().parent.parent.parent
 if str(_project_root) not in sys.path:
     sys.path.insert(0, str(_project_root))
 
-# 兼容不同版本 lightrag-hku：1.4.9.11 中 lightrag.llm 为空，LLM/Embedding 在 lightrag.llm.openai
-# 硅基流动使用 OpenAI 兼容接口，用 openai_embed + base_url 实现，不依赖 siliconcloud_embedding
+# 兼容不同版本 lightrag-hku：只依赖 LightRAG / QueryParam / EmbeddingFunc。
+# DeepSeek 与 embedding / rerank 提供方（app.providers）的 HTTP 调用走 app.http_client 的池化会话，不经 lightrag.llm.openai
 LightRAG = None
 QueryParam = None
 EmbeddingFunc = None
-openai_complete_if_cache = None
-openai_embed = None  # 用于硅基流动：openai_embed(texts, model=..., api_key=..., base_url=硅基流动)
 _import_error = None
 
-SILICONFLOW_EMBED_BASE = "https://api.siliconflow.cn/v1"  # 硅基流动 OpenAI 兼容 embedding 地址
-SILICONFLOW_RERANK_URL = "https://api.siliconflow.cn/v1/rerank"  # 硅基流动 rerank 接口
 
 def _load_lightrag_llm():
-    global LightRAG, QueryParam, EmbeddingFunc, openai_complete_if_cache, openai_embed, _import_error
+    global LightRAG, QueryParam, EmbeddingFunc, _import_error
     try:
         from lightrag import LightRAG, QueryParam
         from lightrag.utils import EmbeddingFunc
-        from lightrag.llm.openai import openai_complete_if_cache, openai_embed
     except ImportError as e2:
         _import_error = e2
         LightRAG = None
         QueryParam = None
         EmbeddingFunc = None
-        openai_complete_if_cache = None
-        openai_embed = None
 
 _load_lightrag_llm()
 
-from app.config import get_settings
+from app.config import get_settings, on_settings_change
+from app.database import graph_list, run_db
+from app.http_client import http_clients, UPSTREAM_DEEPSEEK
+from app.embedding_service import embedding_service
+from app.llm_scheduler import llm_scheduler
+from app.providers import providers
+from app.rag_pool import RagPool
+from app.singleflight import SingleFlight
+from app.answer_cache import answer_cache, normalize_query
+from app.semantic_cache import semantic_cache
+from app import tracing
+
+logger = logging.getLogger(__name__)
 
 VALID_MODES = ("naive", "local", "global", "hybrid")
 
+# 进程级实例池：查询与插入复用已初始化的 LightRAG，参数在 _get_pool() 时按 Settings 刷新
+rag_pool = RagPool()
+# 相同问题的并发查询合并为一次
+query_flight = SingleFlight()
+# DeepSeek 返回 429 时收窄进程级 LLM 并发窗口（所有图谱共用，见 app.llm_scheduler）
+http_clients.on_throttle(UPSTREAM_DEEPSEEK, llm_scheduler.throttled)
+
+# LightRAG 实例创建时捕获（向量维度）或已存向量依赖的配置：变化后让池中实例全部重建
+_RAG_SETTINGS = {
+    "deepseek_api_key",
+    "deepseek_api_base",
+    "deepseek_model",
+    "siliconcloud_api_key",
+    "siliconcloud_api_base",
+    "siliconcloud_embedding_model",
+    "siliconcloud_rerank_model",
+    "embedding_provider",
+    "embedding_api_base",
+    "embedding_dim",
+    "embedding_max_token_size",
+}
+# 问题向量依赖的配置：变化后语义缓存中的旧向量不可比
+_EMBEDDING_SETTINGS = {"siliconcloud_embedding_model", "embedding_provider", "embedding_dim"}
+
+
+@on_settings_change
+def _on_settings_change(old, new, changed) -> None:
+    if any(k.startswith("http_") for k in changed):
+        http_clients.configure(new)
+        http_clients.reset()
+    if changed & _RAG_SETTINGS:
+        rag_pool.expire_all()
+    if changed & _EMBEDDING_SETTINGS:
+        semantic_cache.clear()
+
 
 def _check_rag_deps():
     """校验 LightRAG 依赖是否可用，不可用时抛出明确错误"""
     if _import_error is not None:
         raise ValueError(
             f"LightRAG 或依赖未正确安装（{_import_error}）。"
-            "请执行: pip install lightrag-hku，并确保能执行: from lightrag.llm.openai import openai_complete_if_cache, openai_embed"
+            "请执行: pip install lightrag-hku，并确保能执行: from lightrag import LightRAG, QueryParam"
         )
     if LightRAG is None or not callable(LightRAG):
         raise ValueError("LightRAG 未正确安装，请执行: pip install lightrag-hku")
-    if openai_complete_if_cache is None or not callable(openai_complete_if_cache):
-        raise ValueError(
-            "lightrag.llm.openai.openai_complete_if_cache 不可用。请确认已安装 lightrag-hku。"
-        )
-    if openai_embed is None:
-        raise ValueError(
-            "lightrag.llm.openai.openai_embed 不可用。硅基流动将通过 openai_embed + base_url 实现。"
-        )
     if EmbeddingFunc is None:
         raise ValueError("lightrag.utils.EmbeddingFunc 不可用，请重新安装 lightrag-hku")
 
 
-async def _siliconflow_rerank(
-    query: str,
-    documents: List[str],
-    top_n: Optional[int] = None,
-    api_key: str = "",
-    model: str = "BAAI/bge-reranker-v2-m3",
-) -> List[Dict[str, Any]]:
-    """硅基流动 rerank，返回 [{"index": int, "relevance_score": float}, ...]"""
+def _get_http_clients():
+    http_clients.configure(get_settings())
+    return http_clients
+
+
+def _auth_headers(api_key: str) -> Dict[str, str]:
+    return {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+
+
+def _get_providers():
+    providers.configure(get_settings())
+    return providers
+
+
+def _get_llm_scheduler():
+    llm_scheduler.configure(get_settings())
+    return llm_scheduler
+
+
+async def rerank(query: str, documents: List[str], top_n: Optional[int] = None) -> List[Dict[str, Any]]:
+    """经 rerank 后端打分（use_reranker 选定的后端，默认 RERANK_PROVIDER；超时或出错时降级），
+    返回按分数降序的 [{"index": int, "relevance_score": float}, ...]"""
     if not documents:
         return []
-    payload: Dict[str, Any] = {
-        "model": model,
-        "query": query,
-        "documents": documents,
-    }
-    if top_n is not None:
-        payload["top_n"] = top_n
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(SILICONFLOW_RERANK_URL, headers=headers, json=payload) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                raise RuntimeError(f"硅基流动 rerank 请求失败 {resp.status}: {text}")
-            data = await resp.json()
-    results = data.get("results") or []
+    with tracing.span("rerank"):
+        return await _get_providers().rerank(query, documents, top_n)
+
+
+async def embed_texts(texts: List[str]) -> np.ndarray:
+    """经 embedding 服务层（合批、并发上限、按内容哈希缓存）计算向量，LightRAG 与语义缓存共用"""
+    settings = get_settings()
+    embedding_service.configure(settings)
+    provider = _get_providers().embedding()
+    with tracing.span("embedding"):
+        return await embedding_service.embed(texts, provider.cache_key, provider.embed)
+
+
+# LightRAG（NanoVectorDB）的向量库文件，文件开头为 {"embedding_dim": N, ...}
+_VECTOR_STORE_FILES = ("vdb_chunks.json", "vdb_entities.json", "vdb_relationships.json")
+_EMBEDDING_DIM_RE = re.compile(rb'^\{\s*"embedding_dim"\s*:\s*(\d+)')
+
+
+def stored_embedding_dim(working_dir: str) -> Optional[int]:
+    """图谱已有向量库的维度（只读文件开头）；尚无向量库时返回 None"""
+    for name in _VECTOR_STORE_FILES:
+        try:
+            with open(os.path.join(working_dir, name), "rb") as fp:
+                head = fp.read(128)
+        except OSError:
+            continue
+        m = _EMBEDDING_DIM_RE.match(head)
+        if m:
+            return int(m.group(1))
+    return None
+
+
+def _check_embedding_dim(working_dir: str, dim: int) -> None:
+    stored = stored_embedding_dim(working_dir)
+    if stored is not None and stored != dim:
+        raise ValueError(
+            f"图谱向量维度为 {stored}，与当前配置 EMBEDDING_DIM={dim} 不一致"
+            "（请改回原来的 embedding 模型与维度，或重新导入该图谱）"
+        )
+
+
+def check_graph_dims() -> List[Dict[str, Any]]:
+    """启动时检查所有图谱的向量维度，返回不一致的 [{"id", "name", "dim"}]（同步，在 DB 线程中调用）"""
+    dim = get_settings().embedding_dim
     out = []
-    for i, r in enumerate(results):
-        idx = r.get("index", i)
-        score = r.get("relevance_score") or r.get("score", 0.0)
-        out.append({"index": idx, "relevance_score": float(score)})
+    for g in graph_list(include_private=True):
+        stored = stored_embedding_dim(g["working_dir"]) if g.get("working_dir") else None
+        if stored is not None and stored != dim:
+            out.append({"id": g["id"], "name": g["name"], "dim": stored})
     return out
 
 
+class _LlmStream:
+    """DeepSeek 流式回答的逐段文本。读完、出错或被 aclose（含尚未开始迭代时）都会关闭上游响应并归还调度名额"""
+
+    def __init__(self, events: AsyncIterator[Dict[str, Any]], slot):
+        self._events = events
+        self._slot = slot
+        self._usage: Optional[Dict[str, Any]] = None
+        self._closed = False
+
+    def __aiter__(self) -> "_LlmStream":
+        return self
+
+    async def __anext__(self) -> str:
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            while True:
+                ev = await self._events.__anext__()
+                if ev.get("usage"):
+                    self._usage = ev["usage"]
+                tracing.count_tokens(UPSTREAM_DEEPSEEK, ev.get("usage"))
+                text = "".join((c.get("delta") or {}).get("content") or "" for c in ev.get("choices") or [])
+                if text:
+                    return text
+        except StopAsyncIteration:
+            await self._close(ok=True)
+            raise
+        except BaseException:
+            await self._close(ok=False)
+            raise
+
+    async def aclose(self) -> None:
+        await self._close(ok=False)
+
+    async def _close(self, ok: bool) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        self._slot.release(self._usage, ok=ok)
+        await self._events.aclose()
+
+
+async def _deepseek_complete(
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    history_messages: Optional[List[Dict[str, Any]]] = None,
+    stream: bool = False,
+):
+    """DeepSeek chat/completions。stream=False 返回完整文本；stream=True 返回逐段文本的异步迭代器。
+    不传 response_format（DeepSeek 不支持 LightRAG 关键词抽取用的 GPTKeywordExtractionFormat）。
+    每次调用先经 llm_scheduler 排队（优先级、RPM / TPM、并发窗口），流式调用占用的名额到流结束才归还"""
+    settings = get_settings()
+    messages: List[Dict[str, Any]] = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.extend(history_messages or [])
+    messages.append({"role": "user", "content": prompt})
+    url = f"{settings.deepseek_api_base.rstrip('/')}/chat/completions"
+    payload: Dict[str, Any] = {"model": settings.deepseek_model, "messages": messages}
+    headers = _auth_headers(settings.deepseek_api_key)
+    clients = _get_http_clients()
+    with tracing.span("llm_queue"):
+        slot = await _get_llm_scheduler().acquire(messages)
+    if not stream:
+        try:
+            data = await clients.post_json(UPSTREAM_DEEPSEEK, url, payload, headers=headers, timeout=settings.llm_timeout)
+        except BaseException:
+            slot.release(ok=False)
+            raise
+        slot.release(data.get("usage"))
+        tracing.count_tokens(UPSTREAM_DEEPSEEK, data.get("usage"))
+        choices = data.get("choices") or []
+        if not choices:
+            return None
+        return (choices[0].get("message") or {}).get("content")
+
+    payload["stream"] = True
+    # 最后一个事件附带 usage（OpenAI 兼容的 stream_options），用于 token 计数
+    payload["stream_options"] = {"include_usage": True}
+    try:
+        events = await clients.post_sse(UPSTREAM_DEEPSEEK, url, payload, headers=headers, timeout=settings.llm_timeout)
+    except BaseException:
+        slot.release(ok=False)
+        raise
+
+    return _LlmStream(events, slot)
+
+
 def _make_rag(working_dir: str):
     """创建 LightRAG 实例（同步包装异步初始化）"""
     _check_rag_deps()
     settings = get_settings()
-    if not settings.deepseek_api_key or not settings.siliconcloud_api_key:
-        raise ValueError("请在 .env 中配置 DEEPSEEK_API_KEY 和 SILICONCLOUD_API_KEY")
-
-    # DeepSeek 不支持 response_format（GPTKeywordExtractionFormat），用底层 .func 只传必要参数
-    _complete_func = getattr(openai_complete_if_cache, "func", openai_complete_if_cache)
+    if not settings.deepseek_api_key:
+        raise ValueError("请在 .env 中配置 DEEPSEEK_API_KEY")
+    _get_providers().check()
+    _check_embedding_dim(working_dir, settings.embedding_dim)
 
     async def llm_model_func(prompt, system_prompt=None, history_messages=None, **kwargs) -> str:
-        history_messages = history_messages or []
-        # 只传必要参数，不传 response_format（DeepSeek 不支持该参数，传 None 会报 Unsupported response_format type）
-        return await _complete_func(
-            model=settings.deepseek_model,
-            prompt=prompt,
-            system_prompt=system_prompt,
-            history_messages=history_messages,
-            api_key=settings.deepseek_api_key,
-            base_url=settings.deepseek_api_base,
-        )
-
-    # 硅基流动为 OpenAI 兼容接口，用 openai_embed + base_url 实现（与 examples/insert_txt 等效）
-    _embed_func = getattr(openai_embed, "func", openai_embed)
+        # 只透传 stream：QueryParam(stream=True) 时返回逐段文本的异步迭代器；其余 LightRAG 参数（如 keyword_extraction）忽略
+        # 查询时只有关键词抽取带 response_format（旧版 LightRAG 为 keyword_extraction=True）
+        if kwargs.get("keyword_extraction") or kwargs.get("response_format"):
+            stage = "keyword_extraction"
+        else:
+            # 查询中非关键词抽取的 LLM 调用即生成回答，检索阶段到此结束
+            tracing.end("retrieval")
+            stage = "llm"
+        with tracing.span(stage):
+            return await _deepseek_complete(
+                prompt,
+                system_prompt=system_prompt,
+                history_messages=history_messages,
+                stream=bool(kwargs.get("stream")),
+            )
 
     async def embedding_func(texts: List[str]) -> np.ndarray:
-        return await _embed_func(
-            texts,
-            model=settings.siliconcloud_embedding_model,
-            api_key=settings.siliconcloud_api_key,
-            base_url=SILICONFLOW_EMBED_BASE,
-            max_token_size=8192,
-        )
+        return await embed_texts(texts)
 
-    # 硅基流动 BAAI/bge-reranker-v2-m3 作为 rerank 模型，与 embedding 共用 api_key（参数名需与 LightRAG 调用一致：query, documents, top_n）
+    # rerank 提供方在调用时按当前配置选择（参数名需与 LightRAG 调用一致：query, documents, top_n）
     async def rerank_func(query: str, documents: List[str], top_n: Optional[int] = None, **kwargs: Any) -> List[Dict[str, Any]]:
-        return await _siliconflow_rerank(
-            query=query,
-            documents=documents,
-            top_n=top_n,
-            api_key=settings.siliconcloud_api_key,
-            model=settings.siliconcloud_rerank_model,
-        )
+        return await rerank(query, documents, top_n)
 
     rag = LightRAG(
         working_dir=working_dir,
         llm_model_func=llm_model_func,
         embedding_func=EmbeddingFunc(
-            embedding_dim=1024,
-            max_token_size=8192,
+            embedding_dim=settings.embedding_dim,
+            max_token_size=settings.embedding_max_token_size,
             func=embedding_func
         ),
         rerank_model_func=rerank_func,
@@ -156,21 +313,357 @@ def _make_rag(working_dir: str):
     return rag
 
 
+async def _init_rag(working_dir: str):
+    """实例池的工厂：创建并初始化存储"""
+    with tracing.span("rag_make"):
+        rag = _make_rag(working_dir)
+    with tracing.span("initialize_storages"):
+        await rag.initialize_storages()
+    return rag
+
+
+def _get_pool() -> RagPool:
+    settings = get_settings()
+    rag_pool.configure(
+        max_instances=settings.rag_pool_max_instances,
+        idle_ttl=settings.rag_pool_idle_ttl,
+        memory_budget_bytes=settings.rag_pool_memory_budget_mb * 1024 * 1024,
+    )
+    return rag_pool
+
+
+async def invalidate_graph(working_dir: str) -> None:
+    """图谱数据被池外修改（文件夹导入、删除、创建失败清理）后调用，丢弃已加载的实例"""
+    if working_dir:
+        _forget_graph_version(working_dir)
+        await rag_pool.invalidate(working_dir)
+
+
+# 查询时 LightRAG 会写入 LLM 响应缓存，这些文件不代表图谱数据变化
+_VERSION_EXCLUDE = {"kv_store_llm_response_cache.json"}
+
+
+def graph_version(working_dir: str) -> str:
+    """图谱数据版本：working_dir 下存储文件 (名称, 大小, mtime) 的摘要。
+    insert_async 或文件夹导入写入新数据后版本即变化，依赖它的缓存随之失效。"""
+    h = hashlib.sha1()
+    try:
+        with os.scandir(working_dir) as it:
+            entries = sorted(
+                (e.name, e.stat().st_size, e.stat().st_mtime_ns)
+                for e in it
+                if e.is_file() and e.name not in _VERSION_EXCLUDE
+            )
+    except OSError:
+        return ""
+    for name, size, mtime in entries:
+        h.update(f"{name}:{size}:{mtime};".encode("utf-8"))
+    return h.hexdigest()
+
+
+# graph_version 要遍历目录并逐个 stat，查询路径上改用内存中的版本：本进程写入（insert_async、
+# invalidate_graph）后立即重新计算，其他进程的写入最迟 GRAPH_VERSION_TTL 秒后生效
+GRAPH_VERSION_TTL = 5.0
+_graph_versions: Dict[str, Tuple[str, float]] = {}
+_graph_version_epoch = 0
+
+
+def _forget_graph_version(working_dir: str) -> None:
+    global _graph_version_epoch
+    _graph_version_epoch += 1
+    _graph_versions.pop(os.path.normpath(working_dir), None)
+
+
+async def current_graph_version(working_dir: str) -> str:
+    """graph_version 的缓存版本，目录扫描在线程中执行，不阻塞事件循环"""
+    key = os.path.normpath(working_dir)
+    now = time.monotonic()
+    hit = _graph_versions.get(key)
+    if hit is not None and now - hit[1] < GRAPH_VERSION_TTL:
+        return hit[0]
+    epoch = _graph_version_epoch
+    version = await asyncio.to_thread(graph_version, working_dir)
+    # 计算期间有写入时不缓存（结果可能是写入前的版本）
+    if epoch == _graph_version_epoch:
+        _graph_versions[key] = (version, now)
+    return version
+
+
+def _get_answer_cache():
+    settings = get_settings()
+    answer_cache.configure(
+        max_entries=settings.answer_cache_max_entries,
+        ttl=settings.answer_cache_ttl,
+        persistent=settings.answer_cache_persistent,
+    )
+    return answer_cache
+
+
+def _get_semantic_cache():
+    settings = get_settings()
+    semantic_cache.configure(
+        capacity=settings.semantic_cache_capacity,
+        threshold=settings.semantic_cache_threshold,
+    )
+    return semantic_cache
+
+
+# 语义缓存未命中时暂存问题向量，待回答生成后写入缓存，避免同一问题嵌入两次
+_pending_vectors: Dict[Tuple[int, str, str], np.ndarray] = {}
+_PENDING_VECTORS_MAX = 256
+
+
+async def lookup_cached_answer(graph_id: int, working_dir: str, query_text: str, mode: str = "hybrid") -> Tuple[Optional[str], Optional[str]]:
+    """依次查精确缓存与语义缓存，返回 (回答, 命中的缓存层 "exact" / "semantic")；未命中返回 (None, None)"""
+    if mode not in VALID_MODES:
+        mode = "hybrid"
+    settings = get_settings()
+    version = await current_graph_version(working_dir)
+    if settings.answer_cache_max_entries > 0:
+        cache = _get_answer_cache()
+        if cache.persistent:
+            answer = await run_db(cache.get, graph_id, mode, query_text, version)
+        else:
+            answer = cache.get(graph_id, mode, query_text, version)
+        if answer is not None:
+            return answer, "exact"
+    if settings.semantic_cache_enabled:
+        try:
+            vec = (await embed_texts([query_text]))[0]
+        except Exception:
+            # 缓存层出错不影响正常查询
+            return None, None
+        hit = _get_semantic_cache().lookup(graph_id, version, mode, vec)
+        if hit is not None:
+            return hit[0], "semantic"
+        if len(_pending_vectors) >= _PENDING_VECTORS_MAX:
+            _pending_vectors.pop(next(iter(_pending_vectors)))
+        _pending_vectors[(graph_id, mode, normalize_query(query_text))] = vec
+    return None, None
+
+
+async def store_answer(graph_id: int, working_dir: str, query_text: str, mode: str, answer: str) -> None:
+    """把新生成的回答写入缓存（持久层写入在 DB 线程中执行）"""
+    if mode not in VALID_MODES:
+        mode = "hybrid"
+    if not answer:
+        return
+    settings = get_settings()
+    version = await current_graph_version(working_dir)
+    if settings.answer_cache_max_entries > 0:
+        cache = _get_answer_cache()
+        if cache.persistent:
+            await run_db(cache.put, graph_id, mode, query_text, version, answer)
+        else:
+            cache.put(graph_id, mode, query_text, version, answer)
+    vec = _pending_vectors.pop((graph_id, mode, normalize_query(query_text)), None)
+    if settings.semantic_cache_enabled and vec is not None:
+        _get_semantic_cache().add(graph_id, version, mode, vec, answer)
+
+
+async def answer_query(graph_id: int, working_dir: str, query_text: str, mode: str = "hybrid") -> Tuple[Optional[str], bool]:
+    """执行完整查询并缓存结果（调用方应先 lookup_cached_answer）。
+    相同 (图谱, 模式, 规范化问题) 的并发请求只执行一次，返回 (回答, 是否复用了进行中的查询)"""
+    if mode not in VALID_MODES:
+        mode = "hybrid"
+
+    async def run() -> Optional[str]:
+        answer = await query_async(working_dir, query_text, mode=mode)
+        if answer:
+            with tracing.span("cache_store"):
+                await store_answer(graph_id, working_dir, query_text, mode, answer)
+        return answer
+
+    return await query_flight.do((graph_id, mode, normalize_query(query_text)), run)
+
+
 async def query_async(working_dir: str, query_text: str, mode: str = "hybrid") -> str:
     """异步查询。mode: naive | local | global | hybrid"""
     if mode not in VALID_MODES:
         mode = "hybrid"
-    rag = _make_rag(working_dir)
-    await rag.initialize_storages()
-    param = QueryParam(mode=mode)
-    return await rag.aquery(query_text, param=param)
+    async with _get_pool().acquire(working_dir, _init_rag) as rag:
+        param = QueryParam(mode=mode)
+        tracing.begin("retrieval")
+        try:
+            return await rag.aquery(query_text, param=param)
+        finally:
+            tracing.end("retrieval")
+
+
+@asynccontextmanager
+async def query_session(working_dir: str) -> AsyncIterator[Callable[[str, str], Awaitable[str]]]:
+    """整段期间占用同一个已加载实例（不会被池回收），产出 ask(query_text, mode) -> 回答。
+    供批量查询使用：不经过回答缓存与并发合并，每个问题都真实执行一次"""
+    async with _get_pool().acquire(working_dir, _init_rag) as rag:
+        async def ask(query_text: str, mode: str = "hybrid") -> str:
+            if mode not in VALID_MODES:
+                mode = "hybrid"
+            tracing.begin("retrieval")
+            try:
+                return await rag.aquery(query_text, param=QueryParam(mode=mode))
+            finally:
+                tracing.end("retrieval")
+
+        yield ask
+
+
+async def query_stream_async(working_dir: str, query_text: str, mode: str = "hybrid") -> AsyncIterator[Dict[str, Any]]:
+    """流式查询，依次产出事件：{"type": "retrieval"}（检索完成、开始生成）、{"type": "token", "text": ...}。
+    调用方停止迭代（如客户端断开）时会关闭上游 LLM 流，取消生成。"""
+    if mode not in VALID_MODES:
+        mode = "hybrid"
+    async with _get_pool().acquire(working_dir, _init_rag) as rag:
+        param = QueryParam(mode=mode, stream=True)
+        tracing.begin("retrieval")
+        try:
+            response = await rag.aquery(query_text, param=param)
+        finally:
+            tracing.end("retrieval")
+        # 命中 LLM 缓存或无可用上下文时 LightRAG 直接返回完整字符串
+        if response is None or isinstance(response, str):
+            yield {"type": "retrieval"}
+            if response:
+                yield {"type": "token", "text": response}
+            return
+        try:
+            yield {"type": "retrieval"}
+            with tracing.span("generation"):
+                async for chunk in response:
+                    if chunk:
+                        yield {"type": "token", "text": chunk}
+        finally:
+            aclose = getattr(response, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+async def retrieve_async(working_dir: str, query_text: str, mode: str = "hybrid", **param_fields: Any) -> Dict[str, Any]:
+    """只检索不生成回答：返回 LightRAG aquery_data 的 data（entities / relationships / chunks / references）。
+    param_fields 透传给 QueryParam（如 top_k、chunk_top_k）"""
+    if mode not in VALID_MODES:
+        mode = "hybrid"
+    async with _get_pool().acquire(working_dir, _init_rag) as rag:
+        with tracing.span("retrieval"):
+            result = await rag.aquery_data(query_text, param=QueryParam(mode=mode, **param_fields))
+    if not isinstance(result, dict) or result.get("status") != "success":
+        message = result.get("message") if isinstance(result, dict) else None
+        raise RuntimeError(message or "检索失败")
+    return result.get("data") or {}
+
+
+# 多图谱合并回答：每段资料的最大字数
+PASSAGE_MAX_CHARS = 2000
+
+SYNTHESIS_SYSTEM_PROMPT = (
+    "你是知识库问答助手。下面的资料检索自多个知识图谱，每段前标注了来源图谱。"
+    "请只依据这些资料回答问题，综合不同来源并在必要时指明出处；资料不足以回答时直接说明。"
+)
+
+
+def context_passages(label: str, data: Dict[str, Any]) -> List[str]:
+    """把一次检索结果展开为带来源标注的文本段（文本块、实体、关系各为一段）"""
+    out = []
+    for c in data.get("chunks") or []:
+        if c.get("content"):
+            out.append(f"[{label}] {c['content']}")
+    for e in data.get("entities") or []:
+        if e.get("description"):
+            out.append(f"[{label}] 实体「{e.get('entity_name', '')}」（{e.get('entity_type', '')}）：{e['description']}")
+    for r in data.get("relationships") or []:
+        if r.get("description"):
+            out.append(f"[{label}] 关系「{r.get('src_id', '')}」—「{r.get('tgt_id', '')}」：{r['description']}")
+    return [p[:PASSAGE_MAX_CHARS] for p in out]
+
+
+_CONTEXT_KINDS = ("entities", "relationships", "chunks")
+
+
+def _context_text(kind: str, item: Dict[str, Any]) -> str:
+    if kind == "entities":
+        text = f"{item.get('entity_name', '')}（{item.get('entity_type', '')}）：{item.get('description', '')}"
+    elif kind == "relationships":
+        text = f"{item.get('src_id', '')} — {item.get('tgt_id', '')}（{item.get('keywords', '')}）：{item.get('description', '')}"
+    else:
+        text = item.get("content") or ""
+    return text[:PASSAGE_MAX_CHARS]
+
+
+async def score_context(query_text: str, data: Dict[str, Any]) -> bool:
+    """对一次检索结果（retrieve_async 的返回值）统一 rerank 一次：实体、关系、文本块各加上 score 并按其降序排列。
+    rerank 失败时保持检索顺序、score 为 None，返回 False"""
+    refs = [(kind, item) for kind in _CONTEXT_KINDS for item in data.get(kind) or []]
+    for _, item in refs:
+        item["score"] = None
+    if not refs:
+        return False
+    try:
+        ranked = await rerank(query_text, [_context_text(kind, item) for kind, item in refs])
+    except Exception as e:
+        logger.warning("检索结果 rerank 失败，保持原顺序: %s", e)
+        return False
+    for r in ranked:
+        if 0 <= r["index"] < len(refs):
+            refs[r["index"]][1]["score"] = r["relevance_score"]
+    for kind in _CONTEXT_KINDS:
+        if data.get(kind):
+            # 稳定排序：未返回分数的条目排在最后，且保持原有先后
+            data[kind].sort(key=lambda item: -item["score"] if item["score"] is not None else float("inf"))
+    return True
+
+
+async def synthesize_answer(query_text: str, contexts: List[Tuple[str, Dict[str, Any]]], top_n: int) -> Optional[str]:
+    """合并多个图谱的检索结果：统一 rerank 取前 top_n 段，再调用一次 LLM 生成回答。
+    rerank 失败时按原顺序截取，不影响回答"""
+    passages: List[str] = []
+    for label, data in contexts:
+        passages.extend(context_passages(label, data))
+    if not passages:
+        return None
+    if len(passages) > top_n:
+        try:
+            ranked = await rerank(query_text, passages, top_n)
+            passages = [passages[r["index"]] for r in ranked[:top_n] if 0 <= r["index"] < len(passages)]
+        except Exception:
+            logger.warning("合并回答的 rerank 失败，按原顺序截取", exc_info=True)
+            passages = passages[:top_n]
+    material = "\n\n".join(f"资料 {i + 1}：{p}" for i, p in enumerate(passages))
+    prompt = f"{material}\n\n问题：{query_text}"
+    with tracing.span("llm"):
+        return await _deepseek_complete(prompt, system_prompt=SYNTHESIS_SYSTEM_PROMPT)
 
 
 async def insert_async(working_dir: str, contents: List[str], is_first_time: bool = True) -> None:
-    """异步插入内容。is_first_time=True 表示新建图谱；False 表示增量更新"""
-    rag = _make_rag(working_dir)
-    await rag.initialize_storages()
-    await rag.ainsert(contents)
+    """异步插入内容。is_first_time=True 表示新建图谱；False 表示增量更新。
+    通过池中的同一实例写入，插入完成后已加载的查询实例即为最新数据，无需重新加载。"""
+    try:
+        async with _get_pool().acquire(working_dir, _init_rag) as rag:
+            await rag.ainsert(contents)
+    finally:
+        # 部分写入也会改变数据，依赖版本的回答缓存随之失效
+        _forget_graph_version(working_dir)
+
+
+def _storage_size(storage) -> Optional[int]:
+    """尽力统计存储中的条目数（不同 lightrag-hku 版本内部结构不同，取不到返回 None）"""
+    graph = getattr(storage, "_graph", None)
+    if graph is not None and hasattr(graph, "number_of_nodes"):
+        return graph.number_of_nodes()
+    data = getattr(storage, "_data", None)
+    if data is not None:
+        try:
+            return len(data)
+        except TypeError:
+            return None
+    return None
+
+
+async def graph_counts(working_dir: str) -> Dict[str, Optional[int]]:
+    """图谱当前的文本块数与实体数，用于导入任务的进度展示"""
+    async with _get_pool().acquire(working_dir, _init_rag) as rag:
+        return {
+            "chunks": _storage_size(getattr(rag, "text_chunks", None)),
+            "entities": _storage_size(getattr(rag, "chunk_entity_relation_graph", None)),
+        }
 
 
 def query_sync(working_dir: str, query_text: str, mode: str = "hybrid") -> str:
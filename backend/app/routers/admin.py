@@ -1,28 +1,49 @@
-"""管理员 API：登录、图谱 CRUD、统计、限额、环境变量"""
+"""管理员 API：登录、图谱 CRUD、导入任务、批量查询、统计、限额、环境变量"""
+import asyncio
+import json
 import shutil
 import re
 from pathlib import Path
 from typing import List, Optional, Dict, Any
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 
-from app.config import GRAPHS_DIR, PROJECT_ROOT, ensure_dirs
+from app.config import GRAPHS_DIR, PROJECT_ROOT, ensure_dirs, reload_settings
 from app.database import (
     graph_list,
     graph_get,
-    graph_create,
     graph_update_meta,
     graph_set_daily_limit,
-    graph_delete as db_graph_delete,
+    graph_set_rerank_backend,
     query_stat_get_today_all,
+    db_pool_stats,
+    stat_counters,
+    history_writer,
     user_list,
     user_get,
     user_delete as db_user_delete,
     query_history_list_by_user,
+    query_history_page,
+    query_history_get,
+    parse_history_time,
     user_update_password,
+    job_get,
+    job_list,
+    run_db,
 )
+from app import database_async as db
 from app.auth import verify_admin, create_access_token, get_current_admin, hash_password
-from app.rag_service import insert_async
+from app.providers import RERANKERS
+from app.llm_scheduler import llm_scheduler
+from app.rag_service import VALID_MODES, invalidate_graph, rag_pool
+from app import tracing
+from app.batch import BatchInputError, StoredBatch, load_completed, read_items, run_batch
+from app.jobs import job_manager
+from app.uploads import UploadBudget, save_upload, stage_txt_uploads
+from app.answer_cache import answer_cache
+from app.semantic_cache import semantic_cache
+from app.embedding_service import embedding_service
 
 router = APIRouter()
 
@@ -59,20 +80,6 @@ class CreateGraphRequest(BaseModel):
     daily_limit: int = 100
 
 
-def _read_txt_file(content: bytes, filename: str) -> str:
-    """解码单个 txt 文件内容，支持 UTF-8 / GBK"""
-    try:
-        return content.decode("utf-8")
-    except UnicodeDecodeError:
-        try:
-            return content.decode("gbk")
-        except Exception:
-            raise HTTPException(
-                status_code=400,
-                detail=f"文件「{filename}」编码不支持，请使用 UTF-8 或 GBK",
-            )
-
-
 @router.post("/graphs")
 async def create_graph(
     name: str = Form(...),
@@ -81,39 +88,30 @@ async def create_graph(
     files: List[UploadFile] = File(..., description="一个或多个 .txt 文件"),
     admin: str = Depends(get_current_admin),
 ):
-    """上传一个或多个 txt 文件，创建新图谱。"""
+    """上传一个或多个 txt 文件，创建新图谱。图谱记录立即创建，构建在后台任务中进行，返回 job_id 供查询进度。"""
     ensure_dirs()
     if not files:
         raise HTTPException(status_code=400, detail="请至少上传一个 .txt 文件")
-    texts: List[str] = []
-    for f in files:
-        if not f.filename or not f.filename.lower().endswith(".txt"):
-            raise HTTPException(status_code=400, detail=f"请上传 .txt 文件，当前文件: {f.filename or '未知'}")
-        content = await f.read()
-        text = _read_txt_file(content, f.filename)
-        if text.strip():
-            texts.append(text)
-    if not texts:
-        raise HTTPException(status_code=400, detail="所有文件内容均为空，请上传有内容的 .txt 文件")
+    # 逐个文件分块落盘，不在内存中保留文件内容
+    staged = await stage_txt_uploads(files, "所有文件内容均为空，请上传有内容的 .txt 文件")
 
     working_dir = ""
     graph_id = None
     try:
-        graph_id = graph_create(name=name.strip(), description=description.strip(), working_dir=None, daily_limit=daily_limit)
+        graph_id = await db.graph_create(name=name.strip(), description=description.strip(), working_dir=None, daily_limit=daily_limit)
         working_dir = str(GRAPHS_DIR / f"graph_{graph_id}")
         Path(working_dir).mkdir(parents=True, exist_ok=True)
-        from app.database import get_db
-        with get_db() as conn:
-            conn.execute("UPDATE graphs SET working_dir = ? WHERE id = ?", (working_dir, graph_id))
-        await insert_async(working_dir, texts, is_first_time=True)
+        await db.graph_set_working_dir(graph_id, working_dir)
+        job_id = await job_manager.submit("create", graph_id, working_dir, staged)
     except Exception as e:
+        shutil.rmtree(staged, ignore_errors=True)
         if graph_id:
-            db_graph_delete(graph_id)
+            await db.graph_delete(graph_id)
             p = Path(working_dir)
             if p.exists():
                 shutil.rmtree(p, ignore_errors=True)
         raise HTTPException(status_code=500, detail=f"创建图谱失败: {str(e)}")
-    return {"id": graph_id, "name": name, "description": description, "working_dir": working_dir}
+    return {"id": graph_id, "name": name, "description": description, "working_dir": working_dir, "job_id": job_id}
 
 
 def _safe_relative_path(parts: List[str], root: Path, base: Path) -> Optional[Path]:
@@ -149,16 +147,15 @@ async def create_graph_from_folder(
     working_dir = ""
     graph_id = None
     try:
-        graph_id = graph_create(name=name.strip(), description=description.strip(), working_dir=None, daily_limit=daily_limit)
+        graph_id = await db.graph_create(name=name.strip(), description=description.strip(), working_dir=None, daily_limit=daily_limit)
         working_dir = str(GRAPHS_DIR / f"graph_{graph_id}")
         root_path = Path(working_dir)
         root_path.mkdir(parents=True, exist_ok=True)
-        from app.database import get_db
-        with get_db() as conn:
-            conn.execute("UPDATE graphs SET working_dir = ? WHERE id = ?", (working_dir, graph_id))
-        # 解析所有文件的相对路径，去掉首层文件夹名（用户选择的文件夹名）以保留内部结构
+        await db.graph_set_working_dir(graph_id, working_dir)
+        # 解析所有文件的相对路径，去掉首层文件夹名（用户选择的文件夹名）以保留内部结构；
+        # 每个文件分块直接写入目标位置，不在内存中保留内容
         seen_first_prefix = None
-        to_write: List[tuple] = []
+        budget = UploadBudget()
         for f in files:
             fn = (f.filename or "").strip().replace("\\", "/").strip("/")
             if not fn:
@@ -172,22 +169,22 @@ async def create_graph_from_folder(
                 rel_parts = parts
             if not rel_parts:
                 rel_parts = [parts[0]] if parts else []
-            content = await f.read()
-            to_write.append((rel_parts, content))
-        for rel_parts, content in to_write:
             target = _safe_relative_path(rel_parts, root_path, root_path)
             if target is None:
                 continue
-            target.parent.mkdir(parents=True, exist_ok=True)
-            target.write_bytes(content)
-    except HTTPException:
-        raise
+            await save_upload(f, target, budget)
+        # 存储文件是直接写入的，丢弃可能已加载的旧实例
+        await invalidate_graph(working_dir)
     except Exception as e:
         if graph_id:
-            db_graph_delete(graph_id)
+            await db.graph_delete(graph_id)
+            await invalidate_graph(working_dir)
             p = Path(working_dir)
             if p.exists():
                 shutil.rmtree(p, ignore_errors=True)
+        # 超出上传大小上限等校验错误原样返回
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=500, detail=f"导入文件夹失败: {str(e)}")
     return {"id": graph_id, "name": name, "description": description, "working_dir": working_dir}
 
@@ -198,32 +195,32 @@ async def incremental_update(
     files: List[UploadFile] = File(..., description="一个或多个 .txt 文件"),
     admin: str = Depends(get_current_admin),
 ):
-    """对已有图谱增量更新：上传一个或多个 txt 文件。"""
-    g = graph_get(graph_id)
+    """对已有图谱增量更新：上传一个或多个 txt 文件。插入在后台任务中进行，返回 job_id 供查询进度。"""
+    g = await db.graph_get(graph_id)
     if not g:
         raise HTTPException(status_code=404, detail="图谱不存在")
     if not files:
         raise HTTPException(status_code=400, detail="请至少上传一个 .txt 文件")
-    texts: List[str] = []
-    for f in files:
-        if not f.filename or not f.filename.lower().endswith(".txt"):
-            raise HTTPException(status_code=400, detail=f"请上传 .txt 文件，当前文件: {f.filename or '未知'}")
-        content = await f.read()
-        text = _read_txt_file(content, f.filename)
-        if text.strip():
-            texts.append(text)
-    if not texts:
-        raise HTTPException(status_code=400, detail="所有文件内容均为空")
+    staged = await stage_txt_uploads(files, "所有文件内容均为空")
     try:
-        await insert_async(g["working_dir"], texts, is_first_time=False)
+        job_id = await job_manager.submit("update", graph_id, g["working_dir"], staged)
     except Exception as e:
+        shutil.rmtree(staged, ignore_errors=True)
         raise HTTPException(status_code=500, detail=f"增量更新失败: {str(e)}")
-    return {"message": "增量更新成功"}
+    return {"message": "已提交增量更新任务", "job_id": job_id}
 
 
 @router.delete("/graphs/{graph_id}")
-def delete_graph(graph_id: int, admin: str = Depends(get_current_admin)):
-    working_dir = db_graph_delete(graph_id)
+async def delete_graph(graph_id: int, admin: str = Depends(get_current_admin)):
+    await job_manager.cancel_graph(graph_id)
+    working_dir = await db.graph_delete(graph_id)
+    # 先关闭池中已加载的实例，避免其在目录删除后再写回文件
+    if working_dir:
+        await invalidate_graph(working_dir)
+    await invalidate_graph(str(GRAPHS_DIR / f"graph_{graph_id}"))
+    # 持久层的删除在 DB 线程中执行
+    await run_db(answer_cache.invalidate_graph, graph_id)
+    semantic_cache.invalidate_graph(graph_id)
     # 删除数据库记录对应的目录（若存在）
     if working_dir:
         p = Path(working_dir)
@@ -254,6 +251,135 @@ def update_graph_meta(
     return {"message": "已更新"}
 
 
+# --- 后台导入任务 ---
+@router.get("/jobs")
+def admin_list_jobs(
+    graph_id: Optional[int] = None,
+    limit: int = 50,
+    admin: str = Depends(get_current_admin),
+):
+    """最近的导入任务，可按图谱过滤"""
+    return job_list(graph_id=graph_id, limit=max(1, min(limit, 500)))
+
+
+@router.get("/jobs/{job_id}")
+def admin_get_job(job_id: int, admin: str = Depends(get_current_admin)):
+    """任务状态与进度：status 为 queued / running / succeeded / failed / cancelled"""
+    job = job_get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return job
+
+
+@router.get("/jobs/{job_id}/events")
+async def admin_job_events(job_id: int, admin: str = Depends(get_current_admin)):
+    """以 Server-Sent Events 推送任务进度，任务结束后关闭连接"""
+    if not await db.job_get(job_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    async def events():
+        async for job in job_manager.watch(job_id):
+            if job is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: progress\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def admin_cancel_job(job_id: int, admin: str = Depends(get_current_admin)):
+    if not await db.job_get(job_id):
+        raise HTTPException(status_code=404, detail="任务不存在")
+    if not await job_manager.cancel(job_id):
+        raise HTTPException(status_code=400, detail="任务已结束，无法取消")
+    return {"message": "已取消"}
+
+
+# --- 批量查询（评测集）---
+@router.post("/graphs/{graph_id}/batch_query")
+async def admin_batch_query(
+    graph_id: int,
+    file: Optional[UploadFile] = File(None, description="JSONL 问题文件，每行 {\"id\", \"query\", \"mode\"}；续跑时可省略"),
+    batch_id: Optional[str] = Form(None),
+    mode: Optional[str] = Form(None),
+    concurrency: Optional[int] = Form(None),
+    bypass_limit: bool = Form(False),
+    admin: str = Depends(get_current_admin),
+):
+    """对图谱批量执行问题文件，以 JSONL（application/x-ndjson）按完成顺序流式返回每条结果（含 mode 与 latency_ms）。
+    响应头 X-Batch-Id 为批次 ID；中断后带上 batch_id 再次调用即续跑，只执行此前未成功的条目。
+    bypass_limit=true 时不占图谱 daily_limit，单独计入批量查询次数；否则与普通查询一样预占限额"""
+    g = await db.graph_get(graph_id)
+    if not g:
+        raise HTTPException(status_code=404, detail="图谱不存在")
+    if mode is not None and mode.strip().lower() not in VALID_MODES:
+        raise HTTPException(status_code=400, detail=f"mode 无效，可选 {' / '.join(VALID_MODES)}")
+    if concurrency is not None and concurrency < 1:
+        raise HTTPException(status_code=400, detail="concurrency 至少为 1")
+    if batch_id:
+        batch = StoredBatch.open(batch_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail="批次不存在")
+        if batch.meta["graph_id"] != graph_id:
+            raise HTTPException(status_code=400, detail="该批次属于其他图谱")
+        if file is None and not batch.input_path.exists():
+            raise HTTPException(status_code=400, detail="请上传 JSONL 问题文件")
+    else:
+        if file is None:
+            raise HTTPException(status_code=400, detail="请上传 JSONL 问题文件")
+        batch = StoredBatch.create(graph_id, (mode or "hybrid").strip().lower())
+    if not batch.claim():
+        raise HTTPException(status_code=409, detail="该批次正在执行")
+    try:
+        if file is not None:
+            await save_upload(file, batch.input_path, UploadBudget())
+        items = await asyncio.to_thread(read_items, batch.input_path, (mode or batch.meta["mode"]).strip().lower())
+        skip = await asyncio.to_thread(load_completed, batch.results_path)
+    except BaseException as e:
+        batch.release()
+        if not batch_id:
+            shutil.rmtree(batch.dir, ignore_errors=True)
+        if isinstance(e, BatchInputError):
+            raise HTTPException(status_code=400, detail=str(e))
+        raise
+
+    async def lines():
+        try:
+            async for rec in run_batch(g, items, concurrency, bypass_limit, batch.results_path, skip):
+                yield json.dumps(rec, ensure_ascii=False) + "\n"
+        finally:
+            batch.release()
+
+    done = len(skip & {str(it["id"]) for it in items})
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={
+            "X-Batch-Id": batch.id,
+            "X-Batch-Total": str(len(items)),
+            "X-Batch-Skipped": str(done),
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@router.get("/batches/{batch_id}/results")
+def admin_batch_results(batch_id: str, admin: str = Depends(get_current_admin)):
+    """下载批次目前为止的全部结果（JSONL；续跑前失败的条目会被新结果替换）"""
+    batch = StoredBatch.open(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="批次不存在")
+    if not batch.results_path.exists():
+        return StreamingResponse(iter(()), media_type="application/x-ndjson")
+    return FileResponse(batch.results_path, media_type="application/x-ndjson", filename=f"batch_{batch.id}.jsonl")
+
+
 # --- 统计与限额 ---
 @router.get("/stats")
 def get_today_stats(admin: str = Depends(get_current_admin)):
@@ -261,6 +387,51 @@ def get_today_stats(admin: str = Depends(get_current_admin)):
     return query_stat_get_today_all()
 
 
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics(admin: str = Depends(get_current_admin)):
+    """Prometheus 文本格式指标：查询端到端与各阶段耗时（按图谱、模式、状态码）、上游请求耗时与 token 用量，
+    以及实例池、SQLite 连接池与写锁等待、写回队列与 LLM 调度队列的即时状态"""
+    pool = rag_pool.stats()
+    db_pool = db_pool_stats()
+    llm = llm_scheduler.stats()
+    gauges = {
+        "rag_pool_instances": ("已加载的 LightRAG 实例数", pool["instances"]),
+        "rag_pool_memory_bytes": ("已加载实例估算内存", pool["memory_bytes"]),
+        "db_pool_connections": ("SQLite 连接池已打开连接数", db_pool["open"]),
+        "db_pool_checkout_waits": ("等待 SQLite 连接的累计次数", db_pool["checkout_waits"]),
+        "db_pool_checkout_wait_seconds": ("等待 SQLite 连接的累计秒数", db_pool["checkout_wait_seconds"]),
+        "db_lock_waits": ("等待 SQLite 写锁（database is locked）的累计次数", db_pool["lock_waits"]),
+        "db_lock_wait_seconds": ("等待 SQLite 写锁的累计秒数", db_pool["lock_wait_seconds"]),
+        "query_stats_pending": ("尚未写入 SQLite 的查询计数增量", stat_counters.stats()["pending_count"]),
+        "query_history_pending": ("尚未写入 SQLite 的查询记录条数", history_writer.stats()["pending"]),
+        "llm_queue_interactive": ("排队中的在线查询 LLM 调用数", llm["queued"]["interactive"]),
+        "llm_queue_background": ("排队中的后台（导入、批量查询）LLM 调用数", llm["queued"]["background"]),
+        "llm_inflight_interactive": ("在途的在线查询 LLM 调用数", llm["inflight"]["interactive"]),
+        "llm_inflight_background": ("在途的后台 LLM 调用数", llm["inflight"]["background"]),
+        "llm_concurrency_window": ("当前 LLM 并发窗口（429 后收窄，逐步恢复到 LLM_MAX_CONCURRENCY）", llm["window"]),
+    }
+    return PlainTextResponse(tracing.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@router.get("/answer_cache")
+def get_answer_cache_stats(admin: str = Depends(get_current_admin)):
+    """问答缓存命中统计（自进程启动以来）：exact 为精确缓存，semantic 为语义缓存"""
+    return {"exact": answer_cache.stats(), "semantic": semantic_cache.stats()}
+
+
+@router.get("/embedding_cache")
+def get_embedding_cache_stats(admin: str = Depends(get_current_admin)):
+    """Embedding 缓存命中与上游请求统计（自进程启动以来）"""
+    return embedding_service.stats()
+
+
+@router.delete("/answer_cache")
+def clear_answer_cache(admin: str = Depends(get_current_admin)):
+    answer_cache.clear()
+    semantic_cache.clear()
+    return {"message": "已清空"}
+
+
 class SetLimitRequest(BaseModel):
     daily_limit: int
 
@@ -281,17 +452,41 @@ def set_daily_limit(
     return {"message": "已更新", "daily_limit": daily_limit}
 
 
+class SetRerankRequest(BaseModel):
+    rerank_backend: Optional[str] = None  # http / local / bm25；空表示沿用 RERANK_PROVIDER
+
+
+@router.patch("/graphs/{graph_id}/rerank")
+def set_rerank_backend(
+    graph_id: int,
+    body: SetRerankRequest,
+    admin: str = Depends(get_current_admin),
+):
+    """设置图谱默认的 rerank 后端（单次查询仍可用 rerank_backend 另选）"""
+    backend = (body.rerank_backend or "").strip().lower() or None
+    if backend is not None and backend not in RERANKERS:
+        raise HTTPException(status_code=400, detail=f"rerank_backend 无效（可选 {' / '.join(RERANKERS)}）")
+    g = graph_get(graph_id)
+    if not g:
+        raise HTTPException(status_code=404, detail="图谱不存在")
+    graph_set_rerank_backend(graph_id, backend)
+    return {"message": "已更新", "rerank_backend": backend}
+
+
 # --- 环境变量（仅允许修改，敏感项不返回原值）---
 # 允许在管理界面编辑的 .env 键（与 config.Settings 对应的大写形式）
 ENV_KEYS_ALLOWED = [
     "DEEPSEEK_API_KEY", "DEEPSEEK_API_BASE", "DEEPSEEK_MODEL",
-    "SILICONCLOUD_API_KEY", "SILICONCLOUD_EMBEDDING_MODEL", "SILICONCLOUD_RERANK_MODEL",
+    "SILICONCLOUD_API_KEY", "SILICONCLOUD_EMBEDDING_MODEL", "SILICONCLOUD_RERANK_MODEL", "SILICONCLOUD_API_BASE",
+    "EMBEDDING_PROVIDER", "EMBEDDING_API_BASE", "EMBEDDING_API_KEY", "EMBEDDING_DIM",
+    "RERANK_PROVIDER", "RERANK_API_BASE", "RERANK_API_KEY",
+    "LLM_MAX_CONCURRENCY", "LLM_RPM", "LLM_TPM",
     "ADMIN_USERNAME", "ADMIN_PASSWORD", "SECRET_KEY",
     "DATABASE_URL",
 ]
 # 敏感键：接口不返回真实值，只显示“已设置”占位
 ENV_KEYS_SENSITIVE = {
-    "DEEPSEEK_API_KEY", "SILICONCLOUD_API_KEY", "ADMIN_PASSWORD", "SECRET_KEY",
+    "DEEPSEEK_API_KEY", "SILICONCLOUD_API_KEY", "EMBEDDING_API_KEY", "RERANK_API_KEY", "ADMIN_PASSWORD", "SECRET_KEY",
 }
 
 
@@ -388,7 +583,9 @@ def patch_env(body: EnvUpdateRequest, admin: str = Depends(get_current_admin)):
     if not updates:
         return {"message": "无有效更新"}
     _write_env_file(updates)
-    return {"message": "已更新"}
+    # 立即重新加载配置，依赖的客户端与图谱实例随之重建，无需重启
+    changed = reload_settings()
+    return {"message": "已更新", "reloaded": sorted(k.upper() for k in changed)}
 
 
 # --- 账号管理（仅管理员）---
@@ -424,13 +621,46 @@ def admin_update_user_password(
 @router.get("/users/{user_id}/history")
 def admin_get_user_history(
     user_id: int,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    summary: bool = False,
+    graph_id: Optional[int] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
     admin: str = Depends(get_current_admin),
 ):
-    """某用户 7 天内全部查询记录。"""
+    """某用户 7 天内查询记录。不传 limit 时返回全部记录列表；传 limit 时分页返回 {"items", "next_cursor"}，
+    可按 graph_id、since / until 过滤，summary=true 时回答截断（完整内容见 /users/{user_id}/history/{id}）。"""
     u = user_get(user_id)
     if not u:
         raise HTTPException(status_code=404, detail="用户不存在")
-    return query_history_list_by_user(user_id)
+    if limit is None:
+        return query_history_list_by_user(user_id)
+    try:
+        return query_history_page(
+            user_id,
+            graph_id=graph_id,
+            since=parse_history_time(since),
+            until=parse_history_time(until, end=True),
+            cursor=cursor,
+            limit=max(1, min(limit, 200)),
+            summary=summary,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/users/{user_id}/history/{history_id}")
+def admin_get_user_history_item(
+    user_id: int,
+    history_id: int,
+    admin: str = Depends(get_current_admin),
+):
+    """某用户的单条完整查询记录"""
+    item = query_history_get(history_id, user_id=user_id)
+    if not item:
+        raise HTTPException(status_code=404, detail="记录不存在")
+    return item
 
 
 @router.delete("/users/{user_id}")
@@ -1,22 +1,38 @@
 """公开 API：图谱列表、查询、用户注册/登录、查询记录"""
-from fastapi import APIRouter, HTTPException, Depends
+import asyncio
+import json
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 from app.database import (
-    graph_list,
-    graph_get,
-    can_query_today,
-    query_stat_inc,
-    query_stat_get_today,
+    graph_catalog,
     user_create,
     user_get_by_username,
     user_update_password,
     user_delete,
-    query_history_add,
     query_history_list,
+    query_history_page,
+    query_history_get,
     query_history_delete,
+    parse_history_time,
+)
+from app import database_async as db
+from app import quota, tracing
+from app.config import get_settings
+from app.providers import RERANKERS, use_reranker
+from app.rag_service import (
+    lookup_cached_answer,
+    answer_query,
+    store_answer,
+    query_stream_async,
+    retrieve_async,
+    score_context,
+    synthesize_answer,
+    VALID_MODES,
 )
-from app.rag_service import query_async, VALID_MODES
 from app.auth import hash_password, verify_password, create_access_token, get_current_user_optional
 
 router = APIRouter()
@@ -26,12 +42,17 @@ class QueryRequest(BaseModel):
     graph_id: int
     query: str
     mode: str = "hybrid"
+    rerank_backend: Optional[str] = None  # http / local / bm25，默认用图谱设置或 RERANK_PROVIDER（命中回答缓存时不重新检索）
 
 
 class QueryResponse(BaseModel):
     answer: str
     today_used: int
     daily_limit: int
+    user_used: Optional[int] = None  # 登录用户今日已用次数（跨图谱合计）
+    user_daily_limit: Optional[int] = None  # 登录用户每日限额，未设置为 None
+    cache: Optional[str] = None  # 命中的缓存层："exact" / "semantic"，未命中为 None
+    shared: bool = False  # 是否与同时到达的相同问题共用了一次查询
 
 
 class RegisterRequest(BaseModel):
@@ -65,27 +86,34 @@ class ChangePasswordRequest(BaseModel):
     new_password: str
 
 
+def _catalog_response(request: Request, with_usage: bool):
+    """图谱目录带 ETag 返回；If-None-Match 匹配时返回 304，不重新序列化"""
+    items, etag = graph_catalog(with_usage=with_usage)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(items, headers=headers)
+
+
 @router.get("/graphs")
-def list_graphs():
+def list_graphs(request: Request):
     """前端主界面：获取所有图谱（仅名字和简介）"""
-    return graph_list(include_private=False)
+    return _catalog_response(request, with_usage=False)
 
 
 @router.get("/graphs_with_usage")
-def list_graphs_with_usage():
+def list_graphs_with_usage(request: Request):
     """前端选择知识图谱弹窗：图谱列表 + 今日已用次数、每日限额（用于展示剩余次数）"""
-    graphs = graph_list(include_private=False)
-    out = []
-    for g in graphs:
-        gid = g["id"]
-        used = query_stat_get_today(gid)
-        limit = graph_get(gid)["daily_limit"]
-        out.append({
-            **g,
-            "today_used": used,
-            "daily_limit": limit,
-        })
-    return out
+    return _catalog_response(request, with_usage=True)
+
+
+@router.get("/quota/{graph_id}")
+async def get_quota(graph_id: int, username: str | None = Depends(get_current_user_optional)):
+    """图谱及当前登录用户今日的已用 / 剩余次数（不占用次数）"""
+    g = await db.graph_get(graph_id)
+    if not g:
+        raise HTTPException(status_code=404, detail="图谱不存在")
+    return {"graph_id": graph_id, **await quota.usage(g, username)}
 
 
 @router.post("/register", response_model=TokenResponse)
@@ -124,19 +152,64 @@ def user_me(username: str | None = Depends(get_current_user_optional)):
     return {"username": username}
 
 
-@router.get("/query_history", response_model=list)
+@router.get("/query_history")
 def get_query_history(
-    graph_id: int,
+    graph_id: Optional[int] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    summary: bool = False,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    username: str | None = Depends(get_current_user_optional),
+):
+    """当前用户 7 天内的查询记录，按时间倒序；未登录返回空列表。
+    不传 limit 时返回某图谱（graph_id 必填）的全部记录列表；传 limit 时分页返回 {"items", "next_cursor"}，
+    可按 graph_id、since / until（日期或 ISO 时间）过滤，summary=true 时回答截断（完整内容见 /query_history/{id}）。"""
+    if limit is None:
+        if graph_id is None:
+            raise HTTPException(status_code=400, detail="缺少 graph_id")
+        if not username:
+            return []
+        u = user_get_by_username(username)
+        if not u:
+            return []
+        return query_history_list(u["id"], graph_id)
+    page_empty = {"items": [], "next_cursor": None}
+    if not username:
+        return page_empty
+    u = user_get_by_username(username)
+    if not u:
+        return page_empty
+    try:
+        return query_history_page(
+            u["id"],
+            graph_id=graph_id,
+            since=parse_history_time(since),
+            until=parse_history_time(until, end=True),
+            cursor=cursor,
+            limit=max(1, min(limit, 100)),
+            summary=summary,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/query_history/{history_id}")
+def get_query_history_item(
+    history_id: int,
     username: str | None = Depends(get_current_user_optional),
 ):
-    """当前用户在某图谱下、7 天内的查询记录；未登录返回空列表。"""
+    """当前用户的单条完整查询记录"""
     if not username:
-        return []
+        raise HTTPException(status_code=401, detail="未登录")
     u = user_get_by_username(username)
     if not u:
-        return []
-    items = query_history_list(u["id"], graph_id)
-    return items
+        raise HTTPException(status_code=404, detail="用户不存在")
+    item = query_history_get(history_id, user_id=u["id"])
+    if not item:
+        raise HTTPException(status_code=404, detail="记录不存在")
+    return item
+
 
 @router.delete("/query_history/{history_id}")
 def delete_query_history(
@@ -181,42 +254,354 @@ def delete_me(username: str | None = Depends(get_current_user_optional)):
     user_delete(u["id"])
     return {"message": "已删除"}
 
+def _normalize_mode(mode: Optional[str]) -> str:
+    mode = mode.strip().lower() if mode else "hybrid"
+    return mode if mode in VALID_MODES else "hybrid"
+
+
+def _rerank_backend(requested: Optional[str]) -> Optional[str]:
+    """请求中指定的 rerank 后端；未指定为 None（随后按图谱设置，再按 RERANK_PROVIDER）"""
+    name = (requested or "").strip().lower() or None
+    if name is not None and name not in RERANKERS:
+        raise HTTPException(status_code=400, detail=f"rerank_backend 无效（可选 {' / '.join(RERANKERS)}）")
+    return name
+
+
+async def _answer_graph(g: dict, query_text: str, mode: str, username: Optional[str]) -> QueryResponse:
+    """对单个图谱查询（缓存 → 预占次数 → LLM），失败时退还次数并抛出 HTTPException"""
+    settings = get_settings()
+    with tracing.span("cache"):
+        answer, cache = await lookup_cached_answer(g["id"], g["working_dir"], query_text, mode=mode)
+    # 未命中缓存，或配置为命中也计数时，先原子预占今日次数（超限直接 429，不调用 LLM）
+    with tracing.span("quota"):
+        if answer is None or settings.answer_cache_count_hits:
+            res = await quota.reserve(g, username)
+        else:
+            res = await quota.peek(g, username)
+
+    shared = False
+    if answer is None:
+        try:
+            answer, shared = await answer_query(g["id"], g["working_dir"], query_text, mode=mode)
+        except Exception as e:
+            await quota.refund(res)
+            raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
+        # 复用他人进行中的查询时，按配置决定是否单独计数
+        if shared and not settings.singleflight_count_shared:
+            await quota.refund(res)
+
+    if answer is None:
+        await quota.refund(res)
+        raise HTTPException(status_code=500, detail="查询失败，模型返回为空，请稍后重试")
+
+    if res.user_id is not None:
+        with tracing.span("history"):
+            await db.query_history_add(res.user_id, g["id"], query_text.strip(), answer)
+
+    return QueryResponse(
+        answer=answer,
+        today_used=res.used,
+        daily_limit=res.limit,
+        user_used=res.user_used,
+        user_daily_limit=res.user_limit or None,
+        cache=cache,
+        shared=shared,
+    )
+
+
+def _set_server_timing(response: Response, trace: tracing.Trace) -> None:
+    if get_settings().server_timing:
+        response.headers["Server-Timing"] = trace.server_timing()
+
+
 @router.post("/query", response_model=QueryResponse)
 async def query(
     req: QueryRequest,
+    response: Response,
     username: str | None = Depends(get_current_user_optional),
 ):
     """对指定图谱进行 query，返回 AI 回答；已登录则保存查询记录（仅保留 7 天）。"""
     if not req.query.strip():
         raise HTTPException(status_code=400, detail="查询内容不能为空")
-    mode = req.mode.strip().lower() if req.mode else "hybrid"
-    if mode not in VALID_MODES:
-        mode = "hybrid"
-
-    g = graph_get(req.graph_id)
+    g = await db.graph_get(req.graph_id)
     if not g:
         raise HTTPException(status_code=404, detail="图谱不存在")
-    can_do, used, limit = can_query_today(req.graph_id)
-    if not can_do:
-        raise HTTPException(
-            status_code=429,
-            detail=f"今日查询次数已达上限（{limit} 次），请明日再试。"
-        )
+    mode = _normalize_mode(req.mode)
+    backend = _rerank_backend(req.rerank_backend) or g.get("rerank_backend")
+    async with tracing.traced("query", g["id"], mode) as trace:
+        with use_reranker(backend):
+            result = await _answer_graph(g, req.query, mode, username)
+    _set_server_timing(response, trace)
+    return result
+
 
+class MultiQueryRequest(BaseModel):
+    graph_ids: List[int]
+    query: str
+    mode: str = "hybrid"
+    merge: bool = False  # True：各图谱只检索，合并 rerank 后由一次 LLM 调用生成回答
+    rerank_backend: Optional[str] = None  # 所有图谱统一使用的 rerank 后端，默认各用图谱设置
+
+
+@router.post("/query/multi")
+async def query_multi(
+    req: MultiQueryRequest,
+    response: Response,
+    username: str | None = Depends(get_current_user_optional),
+):
+    """同一问题并发查询多个图谱（并发数受 MULTI_QUERY_CONCURRENCY 限制），总耗时接近最慢的一个图谱。
+    merge=false 时返回各图谱的回答；merge=true 时各图谱只检索，合并后统一 rerank 并生成一个回答。
+    每个实际查询的图谱各计一次今日次数；单个图谱失败（含超限）不影响其他图谱，错误写在对应结果中。"""
+    if not req.query.strip():
+        raise HTTPException(status_code=400, detail="查询内容不能为空")
+    settings = get_settings()
+    graph_ids = list(dict.fromkeys(req.graph_ids))
+    if not graph_ids:
+        raise HTTPException(status_code=400, detail="请至少选择一个图谱")
+    if len(graph_ids) > settings.multi_query_max_graphs:
+        raise HTTPException(status_code=400, detail=f"一次最多查询 {settings.multi_query_max_graphs} 个图谱")
+    graphs = await asyncio.gather(*(db.graph_get(gid) for gid in graph_ids))
+    missing = [gid for gid, g in zip(graph_ids, graphs) if not g]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"图谱不存在: {', '.join(map(str, missing))}")
+    mode = _normalize_mode(req.mode)
+    requested = _rerank_backend(req.rerank_backend)
+    # 整个请求计入 endpoint="multi"，其中每个图谱另计入 endpoint="multi_graph"（阶段耗时同时记入整个请求）
+    async with tracing.traced("multi", "all", mode) as trace:
+        result = await _query_multi(req, graphs, mode, requested, username)
+    _set_server_timing(response, trace)
+    return result
+
+
+async def _query_multi(
+    req: MultiQueryRequest, graphs: List[dict], mode: str, requested: Optional[str], username: Optional[str]
+) -> dict:
+    """query_multi 的主体，在整个请求的追踪内执行；requested 为请求指定的 rerank 后端"""
+    settings = get_settings()
+    sem = asyncio.Semaphore(max(1, settings.multi_query_concurrency))
+
+    def result(g: dict, **fields) -> dict:
+        return {"graph_id": g["id"], "name": g["name"], "answer": None, "error": None, "status": 200, **fields}
+
+    if not req.merge:
+        async def one(g: dict) -> dict:
+            async with sem:
+                try:
+                    async with tracing.traced("multi_graph", g["id"], mode, nested=True):
+                        with use_reranker(requested or g.get("rerank_backend")):
+                            r = await _answer_graph(g, req.query, mode, username)
+                except HTTPException as e:
+                    return result(g, error=e.detail, status=e.status_code)
+            return result(g, **r.model_dump())
+
+        results = await asyncio.gather(*(one(g) for g in graphs))
+        return {"mode": mode, "merge": False, "answer": None, "results": results}
+
+    async def retrieve(g: dict):
+        async with sem:
+            try:
+                async with tracing.traced("multi_graph", g["id"], mode, nested=True):
+                    with tracing.span("quota"):
+                        res = await quota.reserve(g, username)
+                    try:
+                        with use_reranker(requested or g.get("rerank_backend")):
+                            data = await retrieve_async(g["working_dir"], req.query, mode=mode)
+                    except Exception as e:
+                        await quota.refund(res)
+                        raise HTTPException(status_code=500, detail=f"检索失败: {str(e)}")
+            except HTTPException as e:
+                return result(g, error=e.detail, status=e.status_code), None, None
+        return result(g, today_used=res.used, daily_limit=res.limit), res, data
+
+    retrieved = await asyncio.gather(*(retrieve(g) for g in graphs))
+    charged = [(g, res, data) for g, (_, res, data) in zip(graphs, retrieved) if res is not None]
+    results = [r for r, _, _ in retrieved]
+    if not charged:
+        first = results[0]
+        raise HTTPException(status_code=first["status"], detail=first["error"])
     try:
-        answer = await query_async(g["working_dir"], req.query, mode=mode)
+        # 合并后的 rerank 不属于单个图谱：使用请求指定的后端，否则为 RERANK_PROVIDER
+        with use_reranker(requested):
+            answer = await synthesize_answer(
+                req.query, [(g["name"], data) for g, _, data in charged], top_n=settings.multi_query_top_n
+            )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
+        answer, error = None, f"查询失败: {str(e)}"
+    else:
+        error = None if answer else "查询失败，模型返回为空，请稍后重试"
+    if error:
+        for _, res, _ in charged:
+            await quota.refund(res)
+        raise HTTPException(status_code=500, detail=error)
+
+    user_id = charged[0][1].user_id
+    if user_id is not None:
+        with tracing.span("history"):
+            for g, _, _ in charged:
+                await db.query_history_add(user_id, g["id"], req.query.strip(), answer)
+    return {"mode": mode, "merge": True, "answer": answer, "results": results}
+
+
+class ContextQueryRequest(BaseModel):
+    graph_id: int
+    query: str
+    mode: str = "hybrid"
+    top_k: Optional[int] = None  # 检索的实体 / 关系数，默认沿用 LightRAG 配置
+    chunk_top_k: Optional[int] = None  # 保留的文本块数
+    max_entity_tokens: Optional[int] = None  # 实体部分的 token 预算
+    max_relation_tokens: Optional[int] = None  # 关系部分的 token 预算
+    max_total_tokens: Optional[int] = None  # 总 token 预算（文本块使用剩余部分）
+    rerank: bool = True  # 是否对结果统一 rerank 并附上 score
+    rerank_backend: Optional[str] = None  # http / local / bm25，默认用图谱设置或 RERANK_PROVIDER
 
-    if answer is None:
-        raise HTTPException(status_code=500, detail="查询失败，模型返回为空，请稍后重试")
 
-    query_stat_inc(req.graph_id)
-    used_after = used + 1
+# 只检索查询参数上限，避免单次请求拉取整个图谱
+CONTEXT_MAX_TOP_K = 200
+_CONTEXT_BUDGET_FIELDS = ("top_k", "chunk_top_k", "max_entity_tokens", "max_relation_tokens", "max_total_tokens")
 
-    if username:
-        u = user_get_by_username(username)
-        if u:
-            query_history_add(u["id"], req.graph_id, req.query.strip(), answer)
 
-    return QueryResponse(answer=answer, today_used=used_after, daily_limit=limit)
+@router.post("/query/context")
+async def query_context(req: ContextQueryRequest, response: Response):
+    """只检索不生成回答：返回结构化的实体、关系、文本块（rerank=true 时各带 score 并按其排序）与引用来源。
+    不调用 LLM 生成，延迟与成本远低于 /query；次数单独计数（CONTEXT_DAILY_LIMIT），不占图谱 daily_limit。"""
+    if not req.query.strip():
+        raise HTTPException(status_code=400, detail="查询内容不能为空")
+    params = {f: getattr(req, f) for f in _CONTEXT_BUDGET_FIELDS if getattr(req, f) is not None}
+    for f, v in params.items():
+        if v < 1:
+            raise HTTPException(status_code=400, detail=f"{f} 至少为 1")
+    for f in ("top_k", "chunk_top_k"):
+        if params.get(f, 0) > CONTEXT_MAX_TOP_K:
+            raise HTTPException(status_code=400, detail=f"{f} 不能超过 {CONTEXT_MAX_TOP_K}")
+    requested = _rerank_backend(req.rerank_backend)
+    g = await db.graph_get(req.graph_id)
+    if not g:
+        raise HTTPException(status_code=404, detail="图谱不存在")
+    mode = _normalize_mode(req.mode)
+    async with tracing.traced("context", g["id"], mode) as trace:
+        with tracing.span("quota"):
+            info = await quota.reserve_context(g)
+        try:
+            # LightRAG 内部不再 rerank（其结果不带分数），由 score_context 对实体、关系、文本块统一 rerank 一次
+            data = await retrieve_async(g["working_dir"], req.query, mode=mode, enable_rerank=False, **params)
+            with use_reranker(requested or g.get("rerank_backend")):
+                reranked = await score_context(req.query, data) if req.rerank else False
+        except Exception as e:
+            await quota.refund_context(g, info)
+            raise HTTPException(status_code=500, detail=f"检索失败: {str(e)}")
+    _set_server_timing(response, trace)
+    return {
+        "mode": mode,
+        "entities": data.get("entities") or [],
+        "relationships": data.get("relationships") or [],
+        "chunks": data.get("chunks") or [],
+        "references": data.get("references") or [],
+        "reranked": reranked,
+        # 实际使用的 rerank 后端、是否降级（fallback_from / reason）、耗时与前几名分数
+        "rerank": trace.reranks[-1] if reranked and trace.reranks else None,
+        "context_used": info["used"],
+        "context_daily_limit": info["limit"] or None,
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/query/stream")
+async def query_stream(
+    req: QueryRequest,
+    request: Request,
+    username: str | None = Depends(get_current_user_optional),
+):
+    """流式 query（Server-Sent Events）。事件依次为 retrieval（检索完成）、token（回答片段）、usage（完成后的用量），
+    出错时为 error。开始前预占今日次数，出错或客户端断开（同时取消上游 LLM 调用）时退还；查询记录在流正常结束时写入。"""
+    if not req.query.strip():
+        raise HTTPException(status_code=400, detail="查询内容不能为空")
+    mode = _normalize_mode(req.mode)
+    requested = _rerank_backend(req.rerank_backend)
+
+    g = await db.graph_get(req.graph_id)
+    if not g:
+        raise HTTPException(status_code=404, detail="图谱不存在")
+    backend = requested or g.get("rerank_backend")
+    # 追踪从这里开始，到流结束时才计入 rag_query_duration_seconds（开始响应前出错则立即计入）
+    trace = tracing.Trace("stream")
+    try:
+        with tracing.activate(trace):
+            with tracing.span("cache"):
+                cached, cache = await lookup_cached_answer(req.graph_id, g["working_dir"], req.query, mode=mode)
+            with tracing.span("quota"):
+                if cached is None or get_settings().answer_cache_count_hits:
+                    res = await quota.reserve(g, username)
+                else:
+                    res = await quota.peek(g, username)
+    except HTTPException as e:
+        tracing.finish(trace, req.graph_id, mode, e.status_code)
+        raise
+
+    async def cached_events():
+        yield {"type": "retrieval"}
+        yield {"type": "token", "text": cached}
+
+    async def events():
+        parts = []
+        completed = False
+        source = cached_events() if cached is not None else query_stream_async(g["working_dir"], req.query, mode=mode)
+        status = 499  # 未正常结束也未报错即客户端断开
+        try:
+            with tracing.activate(trace), use_reranker(backend):
+                try:
+                    async for ev in source:
+                        if await request.is_disconnected():
+                            return
+                        if ev["type"] == "retrieval":
+                            yield _sse("retrieval", {"graph_id": req.graph_id, "mode": mode, "cache": cache})
+                        else:
+                            parts.append(ev["text"])
+                            yield _sse("token", {"text": ev["text"]})
+                except Exception as e:
+                    status = 500
+                    yield _sse("error", {"detail": f"查询失败: {str(e)}"})
+                    return
+
+                answer = "".join(parts)
+                if not answer:
+                    status = 500
+                    yield _sse("error", {"detail": "查询失败，模型返回为空，请稍后重试"})
+                    return
+                completed = True
+
+                if cached is None:
+                    with tracing.span("cache_store"):
+                        await store_answer(req.graph_id, g["working_dir"], req.query, mode, answer)
+                if res.user_id is not None:
+                    with tracing.span("history"):
+                        await db.query_history_add(res.user_id, req.graph_id, req.query.strip(), answer)
+            status = 200
+            usage = {
+                "today_used": res.used,
+                "daily_limit": res.limit,
+                "user_used": res.user_used,
+                "user_daily_limit": res.user_limit or None,
+                "chunks": len(parts),
+                "answer_chars": len(answer),
+                "cache": cache,
+            }
+            if get_settings().server_timing:
+                usage["timings"] = trace.timings()
+                usage["rerank"] = trace.reranks
+            yield _sse("usage", usage)
+        finally:
+            # 客户端断开或出错时立即关闭检索 / 生成流，断开上游 DeepSeek 连接，不等垃圾回收
+            await source.aclose()
+            # 出错、回答为空或客户端中途断开：退还预占的次数
+            if not completed:
+                await quota.refund(res)
+            tracing.finish(trace, req.graph_id, mode, status)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,122 @@
+"""语义缓存：按问题向量的余弦相似度复用近似问题的回答
+
+每个图谱一块定长 float16 矩阵（capacity × dim，行向量已归一化），查找时一次矩阵乘得到全部相似度；
+满了按最近使用时间淘汰。图谱数据版本变化时整块重置。
+"""
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class _GraphVectors:
+    def __init__(self, version: str, dim: int, capacity: int):
+        self.version = version
+        self.vectors = np.zeros((capacity, dim), dtype=np.float16)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.modes: List[Optional[str]] = [None] * capacity
+        self.answers: List[Optional[str]] = [None] * capacity
+        self.size = 0
+
+    def search(self, mode: str, q: np.ndarray) -> Tuple[int, float]:
+        if self.size == 0:
+            return -1, 0.0
+        sims = self.vectors[: self.size].astype(np.float32) @ q
+        mask = np.fromiter((m == mode for m in self.modes[: self.size]), dtype=bool, count=self.size)
+        sims[~mask] = -1.0
+        i = int(np.argmax(sims))
+        return i, float(sims[i])
+
+    def add(self, mode: str, q: np.ndarray, answer: str) -> None:
+        capacity = self.vectors.shape[0]
+        if self.size < capacity:
+            i = self.size
+            self.size += 1
+        else:
+            i = int(np.argmin(self.last_used))
+        self.vectors[i] = q.astype(np.float16)
+        self.modes[i] = mode
+        self.answers[i] = answer
+        self.last_used[i] = time.monotonic()
+
+
+def _normalize(vec) -> Optional[np.ndarray]:
+    q = np.asarray(vec, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(q))
+    if norm == 0.0:
+        return None
+    return q / norm
+
+
+class SemanticCache:
+    def __init__(self):
+        self.capacity = 512
+        self.threshold = 0.95
+        self._graphs: Dict[int, _GraphVectors] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, capacity: int, threshold: float) -> None:
+        if capacity != self.capacity:
+            with self._lock:
+                self._graphs.clear()
+        self.capacity = capacity
+        self.threshold = threshold
+
+    def lookup(self, graph_id: int, version: str, mode: str, vec) -> Optional[Tuple[str, float]]:
+        """返回 (回答, 相似度)；低于阈值或无缓存返回 None"""
+        q = _normalize(vec)
+        with self._lock:
+            g = self._graphs.get(graph_id)
+            if g is not None and g.version != version:
+                del self._graphs[graph_id]
+                g = None
+            if q is None or g is None or g.vectors.shape[1] != q.shape[0]:
+                self.misses += 1
+                return None
+            i, score = g.search(mode, q)
+            if i < 0 or score < self.threshold:
+                self.misses += 1
+                return None
+            g.last_used[i] = time.monotonic()
+            self.hits += 1
+            return g.answers[i], score
+
+    def add(self, graph_id: int, version: str, mode: str, vec, answer: str) -> None:
+        q = _normalize(vec)
+        if q is None or not answer or self.capacity <= 0:
+            return
+        with self._lock:
+            g = self._graphs.get(graph_id)
+            if g is None or g.version != version or g.vectors.shape[1] != q.shape[0]:
+                g = _GraphVectors(version, q.shape[0], self.capacity)
+                self._graphs[graph_id] = g
+            g.add(mode, q, answer)
+
+    def invalidate_graph(self, graph_id: int) -> None:
+        with self._lock:
+            self._graphs.pop(graph_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._graphs.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "graphs": len(self._graphs),
+                "entries": sum(g.size for g in self._graphs.values()),
+                "capacity_per_graph": self.capacity,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,29 @@
+"""单飞（single-flight）：相同 key 的并发调用只执行一次，其余调用等待同一结果"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """返回 (结果, 是否复用了他人的执行)。
+        实际执行放在独立任务中：发起者断开（被取消）时，仍在等待的调用方不受影响。"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._calls = {}
+            self._loop = loop
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared += 1
+            return await asyncio.shield(task), True
+        task = loop.create_task(fn())
+        self._calls[key] = task
+        task.add_done_callback(lambda t: self._calls.pop(key, None) if self._calls.get(key) is t else None)
+        return await asyncio.shield(task), False
+
+    def in_flight(self) -> int:
+        return len(self._calls)
@@ -0,0 +1,304 @@
+"""查询耗时追踪与 Prometheus 指标
+
+- 查询接口用 traced(...) 包住整个请求：期间（含 LightRAG 内部派生的任务，contextvars 会随之复制）
+  各处的 span("阶段") 都记入本次请求，结束时按 {endpoint, graph, mode, status} 计入 rag_query_duration_seconds；
+- 请求内的 span 同时计入 rag_stage_duration_seconds{endpoint, stage}（导入任务等请求外的调用不计，只计上游指标）；
+- 上游 HTTP 调用（app.http_client）计入 rag_upstream_request_duration_seconds{upstream, endpoint, status}，
+  LLM / Embedding 的 token 用量计入 rag_upstream_tokens_total；
+- rerank 按实际给出结果的后端计入 rag_rerank_duration_seconds{backend, fallback_from}，降级计入 rag_rerank_fallbacks_total；
+  请求内的每次 rerank（后端、是否降级、前几名分数）记在 Trace.reranks，Server-Timing 的 rerank 项以 desc 标出后端；
+- LLM 调用的排队耗时计入 rag_llm_queue_wait_seconds{priority}（请求内同时记为 llm_queue 阶段），429 计入 rag_llm_throttled_total；
+- render() 输出 Prometheus 文本格式（GET /api/admin/metrics）；SERVER_TIMING=true 时查询响应带 Server-Timing 头。
+
+阶段名：cache / quota / history（SQLite 与缓存簿记）、rag_make / initialize_storages（冷启动加载图谱）、
+retrieval（LightRAG 检索，含关键词抽取、向量检索与 rerank，直到开始生成回答）、keyword_extraction、
+embedding、rerank、llm_queue（LLM 调用排队）、llm（生成回答，流式为首个分片前的耗时）、generation（流式输出全部分片）。
+"""
+import asyncio
+import bisect
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, ...], Any] = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + n
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = sorted(self._series.items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in series]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                # 各桶计数（非累计）+ 超出最大桶的计数、总和
+                s = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][bisect.bisect_left(self.buckets, value)] += 1
+            s[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = sorted((k, (list(v[0]), v[1])) for k, v in self._series.items())
+        lines = self.header()
+        for key, (counts, total) in series:
+            acc = 0
+            for bound, n in zip(self.buckets, counts):
+                acc += n
+                le = 'le="%s"' % _num(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {acc}")
+            acc += counts[-1]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {acc}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(round(total, 6))}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {acc}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+QUERY_SECONDS = Histogram(
+    "rag_query_duration_seconds", "查询请求端到端耗时", ("endpoint", "graph", "mode", "status")
+)
+STAGE_SECONDS = Histogram("rag_stage_duration_seconds", "查询各阶段耗时", ("endpoint", "stage"))
+UPSTREAM_SECONDS = Histogram(
+    "rag_upstream_request_duration_seconds", "上游 HTTP 请求耗时（至收到响应头，每次尝试单独计，不含重试等待）",
+    ("upstream", "endpoint", "status"),
+)
+UPSTREAM_RETRIES = Counter("rag_upstream_retries_total", "上游请求重试次数", ("upstream", "endpoint", "reason"))
+UPSTREAM_TOKENS = Counter("rag_upstream_tokens_total", "上游返回的 token 用量", ("upstream", "kind"))
+RERANK_SECONDS = Histogram(
+    "rag_rerank_duration_seconds", "rerank 耗时（按给出结果的后端；降级时含等待原后端的时间）",
+    ("backend", "fallback_from", "status"),
+)
+RERANK_FALLBACKS = Counter("rag_rerank_fallbacks_total", "rerank 降级次数", ("backend", "fallback", "reason"))
+LLM_QUEUE_SECONDS = Histogram(
+    "rag_llm_queue_wait_seconds", "LLM 调用在 app.llm_scheduler 中的排队耗时", ("priority",)
+)
+LLM_THROTTLES = Counter("rag_llm_throttled_total", "DeepSeek 返回 429 的次数（每次收窄 LLM 并发窗口）")
+RERANK_TOP_SCORES = 5  # Trace.reranks 中保留的前几名分数
+
+
+class Trace:
+    """一次请求内记录的阶段耗时；parent 不为空时同时记入父请求（多图谱查询中的单个图谱）"""
+
+    def __init__(self, endpoint: str, parent: Optional["Trace"] = None):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+        self.parent = parent
+        self.reranks: List[Dict[str, Any]] = []
+        self._open: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans.append((name, seconds))
+        if self.parent is not None:
+            self.parent.spans.append((name, seconds))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def timings(self) -> Dict[str, float]:
+        """各阶段耗时（毫秒，同名阶段合计），按首次出现的顺序，最后是 total"""
+        out: Dict[str, float] = {}
+        for name, seconds in self.spans:
+            out[name] = out.get(name, 0.0) + seconds * 1000
+        out["total"] = self.elapsed() * 1000
+        return {k: round(v, 1) for k, v in out.items()}
+
+    def add_rerank(self, info: Dict[str, Any]) -> None:
+        self.reranks.append(info)
+        if self.parent is not None:
+            self.parent.reranks.append(info)
+
+    def server_timing(self) -> str:
+        parts = []
+        for name, ms in self.timings().items():
+            part = f"{name};dur={ms}"
+            if name == "rerank" and self.reranks:
+                backends = dict.fromkeys(
+                    r["backend"] if not r["fallback_from"] else f"{r['backend']}<-{r['fallback_from']}" for r in self.reranks
+                )
+                part += ';desc="%s"' % " ".join(backends)
+            parts.append(part)
+        return ", ".join(parts)
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("rag_trace", default=None)
+
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+
+def record(name: str, seconds: float) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
+        STAGE_SECONDS.observe(seconds, endpoint=trace.endpoint, stage=name)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """记录一个阶段的耗时（同步或异步代码中均可用 with）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def begin(name: str) -> None:
+    """开始一个不在同一代码块内结束的阶段（如 retrieval 在 LLM 开始生成时结束）；不在请求内时忽略"""
+    trace = _current.get()
+    if trace is not None:
+        trace._open[name] = time.perf_counter()
+
+
+def end(name: str) -> None:
+    """结束 begin 开始的阶段；重复调用无副作用"""
+    trace = _current.get()
+    if trace is not None:
+        started = trace._open.pop(name, None)
+        if started is not None:
+            record(name, time.perf_counter() - started)
+
+
+@contextmanager
+def activate(trace: Trace) -> Iterator[Trace]:
+    """在代码块内把 trace 设为当前请求（不计入 rag_query_duration_seconds，用于流式接口开始响应前的部分）"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # 异步生成器在其他上下文中被关闭（如被垃圾回收）
+            _current.set(None)
+
+
+def finish(trace: Trace, graph: Any, mode: str, status: Any) -> None:
+    QUERY_SECONDS.observe(trace.elapsed(), endpoint=trace.endpoint, graph=graph, mode=mode, status=status)
+
+
+@asynccontextmanager
+async def traced(endpoint: str, graph: Any, mode: str, nested: bool = False, trace: Optional[Trace] = None):
+    """追踪一次查询：产出 Trace（可传入已开始的 trace 继续记录）；退出时按 HTTPException 状态码
+    （客户端断开记为 499，其他异常记为 500）计入 rag_query_duration_seconds。nested=True 时阶段同时记入外层请求"""
+    if trace is None:
+        trace = Trace(endpoint, parent=_current.get() if nested else None)
+    status = 200
+    try:
+        with activate(trace):
+            yield trace
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except asyncio.CancelledError:
+        status = 499
+        raise
+    except BaseException:
+        status = 500
+        raise
+    finally:
+        finish(trace, graph, mode, status)
+
+
+def rerank_result(
+    backend: str,
+    fallback_from: Optional[str],
+    reason: Optional[str],
+    documents: int,
+    ranked: List[Dict[str, Any]],
+    seconds: float,
+    ok: bool = True,
+) -> None:
+    """记录一次 rerank：backend 为给出结果的后端，fallback_from 为超时（reason="timeout"）或出错而放弃的后端"""
+    RERANK_SECONDS.observe(seconds, backend=backend, fallback_from=fallback_from or "", status="ok" if ok else "error")
+    if fallback_from:
+        RERANK_FALLBACKS.inc(backend=fallback_from, fallback=backend, reason=reason)
+    trace = _current.get()
+    if trace is not None and ok:
+        trace.add_rerank({
+            "backend": backend,
+            "fallback_from": fallback_from,
+            "reason": reason,
+            "documents": documents,
+            "top_scores": [round(r["relevance_score"], 4) for r in ranked[:RERANK_TOP_SCORES]],
+            "ms": round(seconds * 1000, 1),
+        })
+
+
+def count_tokens(upstream: str, usage: Optional[Dict[str, Any]]) -> None:
+    """记录上游响应中的 usage（OpenAI 兼容格式）"""
+    if not isinstance(usage, dict):
+        return
+    for field, kind in (("prompt_tokens", "prompt"), ("completion_tokens", "completion")):
+        n = usage.get(field)
+        if isinstance(n, (int, float)) and n > 0:
+            UPSTREAM_TOKENS.inc(n, upstream=upstream, kind=kind)
+
+
+def render(gauges: Optional[Dict[str, Tuple[str, float]]] = None) -> str:
+    """全部指标的 Prometheus 文本格式；gauges 为调用方附加的即时值 {name: (help, value)}"""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for name, (help_text, value) in (gauges or {}).items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_num(value)}"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,203 @@
+"""上传文件的流式落盘与解码：按固定大小分块复制到磁盘，内存占用与文件大小无关。
+multipart 请求体在 Starlette 解析（落到临时文件）时即按 UPLOAD_MAX_REQUEST_MB 限制，见 UploadLimitMiddleware"""
+import asyncio
+import codecs
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+from app.config import DATA_DIR, get_settings
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+TEXT_ENCODINGS = ("utf-8", "gbk")
+STAGING_DIR = DATA_DIR / "uploads"
+STAGING_STALE_SECONDS = 24 * 3600  # 超过此时长未写入的上传临时目录视为进程中断的残留
+MULTIPART_OVERHEAD_BYTES = 1024 * 1024  # 请求体上限之外为 multipart 分段头与表单字段留的余量
+
+
+def _request_too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"上传总大小超过上限（{limit // (1024 * 1024)} MB）")
+
+
+class UploadBudget:
+    """单文件与单次请求的大小上限（字节，0 表示不限制），由 Settings 配置"""
+
+    def __init__(self, max_file_bytes: Optional[int] = None, max_request_bytes: Optional[int] = None):
+        settings = get_settings()
+        if max_file_bytes is None:
+            max_file_bytes = settings.upload_max_file_mb * 1024 * 1024
+        if max_request_bytes is None:
+            max_request_bytes = settings.upload_max_request_mb * 1024 * 1024
+        self.max_file_bytes = max_file_bytes
+        self.max_request_bytes = max_request_bytes
+        self.used = 0
+
+
+async def save_upload(f: UploadFile, dest: Path, budget: UploadBudget) -> int:
+    """把 UploadFile 分块复制到 dest，返回字节数；超出上限时删除已写部分并返回 413"""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    size = 0
+    try:
+        with open(dest, "wb") as out:
+            while True:
+                chunk = await f.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                budget.used += len(chunk)
+                if budget.max_file_bytes and size > budget.max_file_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"文件「{f.filename}」超过单文件大小上限（{budget.max_file_bytes // (1024 * 1024)} MB）",
+                    )
+                if budget.max_request_bytes and budget.used > budget.max_request_bytes:
+                    raise _request_too_large(budget.max_request_bytes)
+                await asyncio.to_thread(out.write, chunk)
+    except BaseException:
+        dest.unlink(missing_ok=True)
+        raise
+    finally:
+        await f.close()
+    return size
+
+
+class UploadLimitMiddleware:
+    """ASGI 中间件：multipart 请求体超过 UPLOAD_MAX_REQUEST_MB（另加分段头余量）时返回 413。
+    Content-Length 超限的请求在读取请求体之前拒绝；未声明长度（分块传输）的请求边读边计数，
+    超限时中止解析，不等 Starlette 把整个请求体落到临时文件后再由 save_upload 检查"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        max_request_bytes = get_settings().upload_max_request_mb * 1024 * 1024
+        if max_request_bytes <= 0 or not headers.get(b"content-type", b"").startswith(b"multipart/form-data"):
+            await self.app(scope, receive, send)
+            return
+        limit = max_request_bytes + MULTIPART_OVERHEAD_BYTES
+        length = headers.get(b"content-length", b"")
+        if length.isdigit() and int(length) > limit:
+            response = JSONResponse({"detail": _request_too_large(max_request_bytes).detail}, status_code=413)
+            await response(scope, receive, send)
+            return
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # 在表单解析中抛出，FastAPI 原样返回 413
+                    raise _request_too_large(max_request_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def _iter_decoded(path: Path, encoding: str) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)()
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+
+def scan_text(path: Path, filename: str) -> Tuple[str, bool]:
+    """逐块试解码确定编码（UTF-8 优先，其次 GBK），同时判断内容是否全为空白，不把整个文件读入内存。
+    返回 (编码, 是否空白)；都解不了时返回 400"""
+    for encoding in TEXT_ENCODINGS:
+        blank = True
+        try:
+            for piece in _iter_decoded(path, encoding):
+                if blank and piece.strip():
+                    blank = False
+            return encoding, blank
+        except UnicodeDecodeError:
+            continue
+    raise HTTPException(
+        status_code=400,
+        detail=f"文件「{filename}」编码不支持，请使用 UTF-8 或 GBK",
+    )
+
+
+def read_text(path: Path) -> str:
+    """读取单个文档供插入（按 UTF-8 / GBK 回退解码）"""
+    encoding, _ = scan_text(path, path.name)
+    return "".join(_iter_decoded(path, encoding))
+
+
+def new_staging_dir() -> Path:
+    """每次上传一个独立的临时目录，提交任务时整体改名为该任务的输入目录（见 app.jobs）"""
+    d = STAGING_DIR / uuid.uuid4().hex
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def _last_write(d: Path) -> float:
+    mtimes = [d.stat().st_mtime]
+    for p in d.iterdir():
+        try:
+            mtimes.append(p.stat().st_mtime)
+        except FileNotFoundError:
+            pass
+    return max(mtimes)
+
+
+def sweep_staging(max_age: float = STAGING_STALE_SECONDS) -> int:
+    """删除超过 max_age 秒未写入的上传临时目录，返回删除的个数。
+    进行中的上传（可能属于同一数据目录下的其他进程）不会被删除"""
+    if not STAGING_DIR.exists():
+        return 0
+    removed = 0
+    cutoff = time.time() - max_age
+    for d in STAGING_DIR.iterdir():
+        try:
+            if d.is_dir() and _last_write(d) < cutoff:
+                shutil.rmtree(d, ignore_errors=True)
+                removed += 1
+        except FileNotFoundError:
+            # 已被提交为任务或由其他进程清理
+            continue
+    return removed
+
+
+async def stage_txt_uploads(files: list, empty_detail: str) -> Path:
+    """把上传的 .txt 文件逐个流式落盘到临时目录并校验编码，丢弃空白文件；返回该目录。
+    出错时清理临时目录并抛出 HTTPException。"""
+    staging = new_staging_dir()
+    budget = UploadBudget()
+    try:
+        kept = 0
+        for i, f in enumerate(files):
+            if not f.filename or not f.filename.lower().endswith(".txt"):
+                raise HTTPException(status_code=400, detail=f"请上传 .txt 文件，当前文件: {f.filename or '未知'}")
+            dest = staging / f"{i:06d}.txt"
+            await save_upload(f, dest, budget)
+            _, blank = await asyncio.to_thread(scan_text, dest, f.filename)
+            if blank:
+                dest.unlink(missing_ok=True)
+            else:
+                kept += 1
+        if not kept:
+            raise HTTPException(status_code=400, detail=empty_detail)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return staging
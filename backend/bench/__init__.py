@@ -0,0 +1,4 @@
+"""离线压测套件：假上游（bench.fake_upstream）、合成图谱（bench.synth）、压测驱动（bench.run）与结果对比（bench.compare）
+
+全部在本机运行，不访问真实的 DeepSeek / 硅基流动；后端以临时数据目录（RAG_DATA_DIR）启动，不影响 data/。
+"""
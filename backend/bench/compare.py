@@ -0,0 +1,92 @@
+"""对比两次压测结果（bench.run 输出的 JSON），逐场景列出关键指标及变化
+
+用法（在 backend 目录下）：python -m bench.compare base.json new.json [--fail-on-regression 10]
+--fail-on-regression PCT：任一场景 p95 / p99 延迟变差超过 PCT% 或 RPS 下降超过 PCT% 时退出码为 1（便于在 CI 中使用）
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# (显示名, 取值路径, 越小越好)
+METRICS: Tuple[Tuple[str, Tuple[str, ...], bool], ...] = (
+    ("rps", ("rps",), False),
+    ("p50 ms", ("latency_ms", "p50"), True),
+    ("p95 ms", ("latency_ms", "p95"), True),
+    ("p99 ms", ("latency_ms", "p99"), True),
+    ("max ms", ("latency_ms", "max"), True),
+    ("errors", ("errors",), True),
+    ("rss peak MB", ("rss_mb", "peak"), True),
+    ("sqlite pool waits", ("sqlite_pool_waits",), True),
+    ("sqlite pool s", ("sqlite_pool_wait_seconds",), True),
+    ("sqlite lock waits", ("sqlite_lock_waits",), True),
+    ("sqlite lock s", ("sqlite_lock_wait_seconds",), True),
+    ("upstream retries", ("upstream_retries",), True),
+    ("llm 429s", ("llm_throttled",), True),
+    ("llm queue s", ("llm_queue_wait_seconds",), True),
+)
+REGRESSION_CHECKED = ("rps", "p95 ms", "p99 ms")
+
+
+def _get(stats: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    v: Any = stats
+    for key in path:
+        if not isinstance(v, dict):
+            return None
+        v = v.get(key)
+    if isinstance(v, dict):  # errors：按状态码的计数
+        return float(sum(v.values()))
+    return float(v) if isinstance(v, (int, float)) else None
+
+
+def _change(base: Optional[float], new: Optional[float]) -> Optional[float]:
+    if base is None or new is None or base == 0:
+        return None
+    return (new - base) / base * 100
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: Optional[float]) -> Tuple[List[str], List[str]]:
+    """返回 (表格行, 超过阈值的退化说明)"""
+    lines: List[str] = []
+    regressions: List[str] = []
+    names = list(dict.fromkeys([*base.get("scenarios", {}), *new.get("scenarios", {})]))
+    for name in names:
+        b = base.get("scenarios", {}).get(name)
+        n = new.get("scenarios", {}).get(name)
+        if b is None or n is None:
+            lines.append(f"[{name}] 仅出现在{'新' if b is None else '基准'}结果中")
+            continue
+        lines.append(f"[{name}]")
+        lines.append(f"  {'指标':<18}{'基准':>12}{'新':>12}{'变化':>10}")
+        for label, path, lower_better in METRICS:
+            bv, nv = _get(b, path), _get(n, path)
+            pct = _change(bv, nv)
+            fmt = lambda v: "-" if v is None else f"{v:.2f}"  # noqa: E731
+            lines.append(f"  {label:<18}{fmt(bv):>12}{fmt(nv):>12}{'-' if pct is None else f'{pct:+.1f}%':>10}")
+            if threshold is not None and label in REGRESSION_CHECKED and pct is not None:
+                worse = pct if lower_better else -pct
+                if worse > threshold:
+                    regressions.append(f"{name} {label} 变差 {worse:.1f}%")
+    return lines, regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bench.compare", description="对比两次压测结果")
+    parser.add_argument("base", help="基准结果 JSON")
+    parser.add_argument("new", help="新结果 JSON")
+    parser.add_argument("--fail-on-regression", type=float, default=None, metavar="PCT")
+    args = parser.parse_args(argv)
+    base = json.loads(Path(args.base).read_text(encoding="utf-8"))
+    new = json.loads(Path(args.new).read_text(encoding="utf-8"))
+    print(f"基准：{base.get('meta', {}).get('git_rev')}  新：{new.get('meta', {}).get('git_rev')}")
+    lines, regressions = compare(base, new, args.fail_on_regression)
+    print("\n".join(lines))
+    if regressions:
+        print("退化：" + "；".join(regressions), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
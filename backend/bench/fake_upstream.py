@@ -0,0 +1,233 @@
+"""本地假上游：模拟 DeepSeek（OpenAI 兼容 chat/completions）与硅基流动（embeddings、rerank），压测时不产生费用
+
+- POST /v1/chat/completions：
+  带 response_format 时按关键词抽取返回 JSON；提示词含 ---Input Text--- 时按 LightRAG 实体抽取格式
+  返回文本中出现的合成实体（见 bench.synth）及相邻实体间的关系；其余返回固定长度的回答，支持 stream（SSE，末尾附 usage）；
+- POST /v1/embeddings：词袋哈希向量（归一化，相同词的文本相似），维度与后端一致（1024）；
+- POST /v1/rerank：按查询词重合度打分，支持 top_n；
+- 延迟、抖动、错误率、流式分片间隔可配置；错误率按比例返回 503（后端会按退避重试）；
+  --llm-max-concurrency N 时同时处理的 chat 请求超过 N 即返回 429，模拟账号限流（测 LLM 调度）。
+
+用法（在 backend 目录下）：python -m bench.fake_upstream --port 18080 --llm-latency-ms 800
+后端配置 DEEPSEEK_API_BASE / SILICONCLOUD_API_BASE 为 http://127.0.0.1:18080/v1
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+import numpy as np
+from aiohttp import web
+
+from bench.synth import ENTITY_RE
+
+EMBEDDING_DIM = 1024
+TUPLE_DELIMITER = "<|#|>"
+COMPLETION_DELIMITER = "<|COMPLETE|>"
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+@dataclass
+class FakeConfig:
+    llm_latency_ms: float = 500
+    embedding_latency_ms: float = 50
+    rerank_latency_ms: float = 50
+    jitter_ms: float = 0
+    error_rate: float = 0.0
+    stream_chunks: int = 20
+    stream_chunk_ms: float = 20
+    answer_chars: int = 400
+    llm_max_concurrency: int = 0  # 0 表示不限
+
+
+def _words(text: str) -> List[str]:
+    return [w.lower() for w in _WORD_RE.findall(text)]
+
+
+def _embed(text: str) -> List[float]:
+    vec = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for w in _words(text) or [""]:
+        h = int.from_bytes(hashlib.md5(w.encode("utf-8")).digest()[:8], "little")
+        vec[h % EMBEDDING_DIM] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = float(np.linalg.norm(vec)) or 1.0
+    return (vec / norm).tolist()
+
+
+def _extraction(prompt: str) -> str:
+    text = prompt.split("---Input Text---", 1)[-1]
+    names = list(dict.fromkeys(ENTITY_RE.findall(text)))
+    rows = [TUPLE_DELIMITER.join(("entity", n, "Concept", f"{n} 是合成测试实体。")) for n in names]
+    rows += [
+        TUPLE_DELIMITER.join(("relation", a, b, "related", f"{a} 与 {b} 在同一段落中出现。"))
+        for a, b in zip(names, names[1:])
+    ]
+    rows.append(COMPLETION_DELIMITER)
+    return "\n".join(rows)
+
+
+def _answer(prompt: str, config: FakeConfig) -> str:
+    if "---Input Text---" in prompt:
+        return _extraction(prompt)
+    seed = "基于检索到的资料，合成回答。"
+    return (seed * (config.answer_chars // len(seed) + 1))[: config.answer_chars]
+
+
+def _usage(prompt: str, completion: str) -> Dict[str, int]:
+    # 粗略估算：按字符数 / 2
+    p, c = max(1, len(prompt) // 2), max(1, len(completion) // 2)
+    return {"prompt_tokens": p, "completion_tokens": c, "total_tokens": p + c}
+
+
+class FakeUpstream:
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.requests: Dict[str, int] = {}
+        self._llm_active = 0
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post("/v1/chat/completions", self.chat)
+        self.app.router.add_post("/v1/embeddings", self.embeddings)
+        self.app.router.add_post("/v1/rerank", self.rerank)
+        self.app.router.add_get("/stats", self.stats)
+
+    async def _delay(self, base_ms: float) -> None:
+        ms = base_ms + random.uniform(0, self.config.jitter_ms)
+        if ms > 0:
+            await asyncio.sleep(ms / 1000)
+
+    def _count(self, name: str) -> None:
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _maybe_error(self) -> None:
+        if self.config.error_rate > 0 and random.random() < self.config.error_rate:
+            raise web.HTTPServiceUnavailable(text='{"error": "fake upstream error"}', content_type="application/json")
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self._count("chat")
+        body = await request.json()
+        self._maybe_error()
+        limit = self.config.llm_max_concurrency
+        if limit and self._llm_active >= limit:
+            self._count("chat_429")
+            raise web.HTTPTooManyRequests(text='{"error": "fake rate limit"}', content_type="application/json")
+        self._llm_active += 1
+        try:
+            return await self._chat(request, body)
+        finally:
+            self._llm_active -= 1
+
+    async def _chat(self, request: web.Request, body: Dict[str, Any]) -> web.StreamResponse:
+        prompt = "\n".join(str(m.get("content") or "") for m in body.get("messages") or [])
+        if body.get("response_format"):
+            await self._delay(self.config.llm_latency_ms / 4)
+            user = str((body.get("messages") or [{}])[-1].get("content") or "")
+            entities = list(dict.fromkeys(ENTITY_RE.findall(user)))[:5]
+            content = json.dumps({"high_level_keywords": ["合成"], "low_level_keywords": entities}, ensure_ascii=False)
+            return web.json_response(self._completion(body, content, prompt))
+        content = _answer(prompt, self.config)
+        if not body.get("stream"):
+            await self._delay(self.config.llm_latency_ms)
+            return web.json_response(self._completion(body, content, prompt))
+
+        await self._delay(self.config.llm_latency_ms / 2)
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        n = max(1, self.config.stream_chunks)
+        size = max(1, len(content) // n + 1)
+        for i in range(0, len(content), size):
+            chunk = {"choices": [{"index": 0, "delta": {"content": content[i:i + size]}}]}
+            await resp.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await self._delay(self.config.stream_chunk_ms)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            tail = {"choices": [], "usage": _usage(prompt, content)}
+            await resp.write(f"data: {json.dumps(tail)}\n\n".encode("utf-8"))
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    def _completion(self, body: Dict[str, Any], content: str, prompt: str) -> Dict[str, Any]:
+        return {
+            "id": "fake",
+            "object": "chat.completion",
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": _usage(prompt, content),
+        }
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        self._count("embeddings")
+        body = await request.json()
+        self._maybe_error()
+        texts = body.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        await self._delay(self.config.embedding_latency_ms)
+        tokens = sum(len(t) for t in texts) // 2
+        return web.json_response({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": _embed(t)} for i, t in enumerate(texts)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def rerank(self, request: web.Request) -> web.Response:
+        self._count("rerank")
+        body = await request.json()
+        self._maybe_error()
+        await self._delay(self.config.rerank_latency_ms)
+        query = set(_words(body.get("query") or ""))
+        docs = body.get("documents") or []
+        scores = []
+        for i, d in enumerate(docs):
+            words = set(_words(d if isinstance(d, str) else json.dumps(d, ensure_ascii=False)))
+            scores.append((len(query & words) / (len(query) or 1), i))
+        scores.sort(reverse=True)
+        top_n = body.get("top_n") or len(scores)
+        return web.json_response({"results": [{"index": i, "relevance_score": s} for s, i in scores[:top_n]]})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests})
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m bench.fake_upstream", description="本地假 LLM / Embedding / Rerank 服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--llm-latency-ms", type=float, default=FakeConfig.llm_latency_ms)
+    parser.add_argument("--embedding-latency-ms", type=float, default=FakeConfig.embedding_latency_ms)
+    parser.add_argument("--rerank-latency-ms", type=float, default=FakeConfig.rerank_latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=FakeConfig.jitter_ms, help="每次延迟额外加 0~jitter 毫秒")
+    parser.add_argument("--error-rate", type=float, default=FakeConfig.error_rate, help="返回 503 的比例（0~1）")
+    parser.add_argument("--stream-chunks", type=int, default=FakeConfig.stream_chunks)
+    parser.add_argument("--stream-chunk-ms", type=float, default=FakeConfig.stream_chunk_ms)
+    parser.add_argument("--answer-chars", type=int, default=FakeConfig.answer_chars)
+    parser.add_argument(
+        "--llm-max-concurrency", type=int, default=FakeConfig.llm_max_concurrency,
+        help="同时处理的 chat 请求上限，超过返回 429（0 表示不限）",
+    )
+    return parser
+
+
+def config_from_args(args: argparse.Namespace) -> FakeConfig:
+    return FakeConfig(
+        llm_latency_ms=args.llm_latency_ms,
+        embedding_latency_ms=args.embedding_latency_ms,
+        rerank_latency_ms=args.rerank_latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        stream_chunks=args.stream_chunks,
+        stream_chunk_ms=args.stream_chunk_ms,
+        answer_chars=args.answer_chars,
+        llm_max_concurrency=args.llm_max_concurrency,
+    )
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    web.run_app(FakeUpstream(config_from_args(args)).app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+"""离线压测：启动假上游与后端（临时数据目录），导入合成图谱，按固定并发驱动各场景，输出可对比的 JSON
+
+场景：
+- query：POST /api/query。问题带序号，默认都不命中回答缓存；--repeat N 时问题在 N 个之间循环，测缓存命中路径；
+- stream：POST /api/query/stream，读完整个 SSE 流；
+- graphs：GET /api/graphs_with_usage（--etag 时带 If-None-Match，测 304 路径）；
+- ingest：POST /api/admin/graphs/{id}/update 上传合成文档并等待导入任务结束，延迟为任务端到端耗时。
+
+每个场景报告：请求数、按状态码的错误数、RPS、延迟 p50 / p95 / p99 / max（毫秒）、后端进程 RSS（开始、峰值、结束），
+以及 /api/admin/metrics 在场景前后的增量：SQLite 连接池等待（sqlite_pool_*：等空闲连接）与写锁等待（sqlite_lock_*：
+等其他连接或进程释放写锁，即 database is locked 后的重试）的次数与时长、上游重试次数、DeepSeek 429 次数与 LLM 排队总时长。
+
+用法（在 backend 目录下）：
+    python -m bench.run --scenarios query,graphs --concurrency 16 --requests 500 --output bench_result.json
+    python -m bench.run --scenarios query --env QUERY_STATS_FLUSH_INTERVAL=0 --output flush0.json
+    python -m bench.compare bench_result.json flush0.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+
+from bench import fake_upstream
+from bench.synth import make_documents, make_questions
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SCENARIOS = ("query", "stream", "graphs", "ingest")
+ADMIN_USERNAME = "bench"
+ADMIN_PASSWORD = "bench"
+JOB_FINISHED = ("succeeded", "failed", "cancelled")
+# 从 /api/admin/metrics 取增量的指标（同名不同标签的序列求和）
+METRIC_DELTAS = {
+    "db_pool_checkout_waits": "sqlite_pool_waits",
+    "db_pool_checkout_wait_seconds": "sqlite_pool_wait_seconds",
+    "db_lock_waits": "sqlite_lock_waits",
+    "db_lock_wait_seconds": "sqlite_lock_wait_seconds",
+    "rag_upstream_retries_total": "upstream_retries",
+    "rag_llm_throttled_total": "llm_throttled",
+    "rag_llm_queue_wait_seconds_sum": "llm_queue_wait_seconds",
+}
+_METRIC_LINE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values: List[float], p: float) -> Optional[float]:
+    """最近秩百分位（sorted_values 须已排序）"""
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    """进程常驻内存（仅 Linux，读取 /proc）"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as fp:
+            for line in fp:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def parse_metrics(text: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for line in text.splitlines():
+        m = _METRIC_LINE.match(line)
+        if m:
+            out[m.group(1)] = out.get(m.group(1), 0.0) + float(m.group(3))
+    return out
+
+
+class Processes:
+    """假上游与后端子进程"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.data_dir = Path(tempfile.mkdtemp(prefix="rag_bench_"))
+        self.fake_port = _free_port()
+        self.api_port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.api_port}"
+        self.fake: Optional[subprocess.Popen] = None
+        self.api: Optional[subprocess.Popen] = None
+        # 子进程日志默认丢弃（LightRAG 导入日志很多），--verbose 时输出到终端
+        self.log = None if args.verbose else subprocess.DEVNULL
+
+    def start(self) -> None:
+        a = self.args
+        self.fake = subprocess.Popen(
+            [
+                sys.executable, "-m", "bench.fake_upstream", "--port", str(self.fake_port),
+                "--llm-latency-ms", str(a.llm_latency_ms), "--embedding-latency-ms", str(a.embedding_latency_ms),
+                "--rerank-latency-ms", str(a.rerank_latency_ms), "--jitter-ms", str(a.jitter_ms),
+                "--error-rate", str(a.error_rate), "--llm-max-concurrency", str(a.llm_max_concurrency),
+            ],
+            cwd=BACKEND_DIR,
+            stdout=self.log,
+            stderr=self.log,
+        )
+        fake_base = f"http://127.0.0.1:{self.fake_port}/v1"
+        env = {
+            **os.environ,
+            "RAG_DATA_DIR": str(self.data_dir),
+            "DEEPSEEK_API_KEY": "bench",
+            "DEEPSEEK_API_BASE": fake_base,
+            "SILICONCLOUD_API_KEY": "bench",
+            "SILICONCLOUD_API_BASE": fake_base,
+            "ADMIN_USERNAME": ADMIN_USERNAME,
+            "ADMIN_PASSWORD": ADMIN_PASSWORD,
+            "SECRET_KEY": "bench-secret",
+        }
+        for item in a.env:
+            key, _, value = item.partition("=")
+            env[key.strip()] = value
+        self.api = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+             "--port", str(self.api_port), "--log-level", "warning"],
+            cwd=BACKEND_DIR,
+            env=env,
+            stdout=self.log,
+            stderr=self.log,
+        )
+
+    def stop(self) -> None:
+        for p in (self.api, self.fake):
+            if p is not None and p.poll() is None:
+                p.terminate()
+                try:
+                    p.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    p.kill()
+        if not self.args.keep_data:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace, procs: Processes, session: aiohttp.ClientSession):
+        self.args = args
+        self.procs = procs
+        self.session = session
+        self.base = procs.base_url
+        self.token = ""
+        self.graph_ids: List[int] = []
+        self.ingest_seed = 1000
+
+    @property
+    def admin_headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def wait_ready(self, timeout: float = 60) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.procs.api.poll() is not None:
+                raise RuntimeError("后端进程启动失败（加 --verbose 查看日志）")
+            try:
+                async with self.session.get(f"{self.base}/api/graphs") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError("等待后端启动超时")
+
+    async def login(self) -> None:
+        async with self.session.post(
+            f"{self.base}/api/admin/login", json={"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD}
+        ) as r:
+            r.raise_for_status()
+            self.token = (await r.json())["access_token"]
+
+    def _docs_form(self, docs, **fields: Any) -> aiohttp.FormData:
+        form = aiohttp.FormData()
+        for k, v in fields.items():
+            form.add_field(k, str(v))
+        for name, text in docs:
+            form.add_field("files", text.encode("utf-8"), filename=name, content_type="text/plain")
+        return form
+
+    async def wait_job(self, job_id: int, timeout: float = 3600) -> Dict[str, Any]:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            async with self.session.get(f"{self.base}/api/admin/jobs/{job_id}", headers=self.admin_headers) as r:
+                job = await r.json()
+            if job.get("status") in JOB_FINISHED:
+                return job
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"导入任务 {job_id} 超时")
+
+    async def setup_graphs(self) -> Dict[str, Any]:
+        """创建合成图谱并等待导入完成"""
+        a = self.args
+        started = time.perf_counter()
+        jobs = []
+        for i in range(a.graphs):
+            docs = make_documents(a.docs, a.entities, seed=i)
+            form = self._docs_form(docs, name=f"bench-{i}", description="合成压测图谱", daily_limit=10 ** 9)
+            async with self.session.post(f"{self.base}/api/admin/graphs", data=form, headers=self.admin_headers) as r:
+                r.raise_for_status()
+                body = await r.json()
+            self.graph_ids.append(body["id"])
+            jobs.append(body["job_id"])
+        results = await asyncio.gather(*(self.wait_job(j) for j in jobs))
+        failed = [j for j in results if j.get("status") != "succeeded"]
+        if failed:
+            raise RuntimeError(f"合成图谱导入失败：{failed[0].get('error')}")
+        return {
+            "graphs": a.graphs,
+            "docs_per_graph": a.docs,
+            "entities": a.entities,
+            "seconds": round(time.perf_counter() - started, 3),
+            "jobs": [{k: j.get(k) for k in ("chunks", "entities", "docs_done")} for j in results],
+        }
+
+    async def metrics(self) -> Dict[str, float]:
+        async with self.session.get(f"{self.base}/api/admin/metrics", headers=self.admin_headers) as r:
+            return parse_metrics(await r.text())
+
+    async def drive(self, name: str, request: Callable[[int], Awaitable[Any]]) -> Dict[str, Any]:
+        """以固定并发执行 request(i)，直到完成 --requests 次或超过 --duration 秒"""
+        a = self.args
+        latencies: List[float] = []
+        statuses: Dict[str, int] = {}
+        counter = iter(range(a.requests))
+        stop_at = time.monotonic() + a.duration if a.duration else None
+        pid = self.procs.api.pid
+        rss = {"start": rss_bytes(pid), "peak": rss_bytes(pid), "end": None}
+
+        async def sample_rss() -> None:
+            while True:
+                await asyncio.sleep(0.5)
+                value = rss_bytes(pid)
+                if value is not None and (rss["peak"] is None or value > rss["peak"]):
+                    rss["peak"] = value
+
+        async def worker() -> None:
+            for i in counter:
+                if stop_at is not None and time.monotonic() >= stop_at:
+                    return
+                t0 = time.perf_counter()
+                try:
+                    status = await request(i)
+                except Exception as e:
+                    status = type(e).__name__
+                latencies.append(time.perf_counter() - t0)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+        before = await self.metrics()
+        sampler = asyncio.create_task(sample_rss())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(a.concurrency)))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        rss["end"] = rss_bytes(pid)
+        after = await self.metrics()
+
+        latencies.sort()
+        ms = lambda v: None if v is None else round(v * 1000, 2)  # noqa: E731
+        ok = sum(n for s, n in statuses.items() if s in ("200", "304"))
+        return {
+            "requests": len(latencies),
+            "ok": ok,
+            "errors": {s: n for s, n in statuses.items() if s not in ("200", "304")},
+            "concurrency": a.concurrency,
+            "seconds": round(elapsed, 3),
+            "rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+            "latency_ms": {
+                "p50": ms(percentile(latencies, 50)),
+                "p95": ms(percentile(latencies, 95)),
+                "p99": ms(percentile(latencies, 99)),
+                "max": ms(latencies[-1] if latencies else None),
+                "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            },
+            "rss_mb": {k: None if v is None else round(v / 1024 / 1024, 1) for k, v in rss.items()},
+            **{out: round(after.get(m, 0.0) - before.get(m, 0.0), 6) for m, out in METRIC_DELTAS.items()},
+        }
+
+    # --- 场景 ---
+
+    def _question(self, i: int, scenario: str) -> Dict[str, Any]:
+        a = self.args
+        n = i % a.repeat if a.repeat else i
+        q = make_questions(1, a.entities, seed=n)[0]["query"]
+        if not a.repeat:
+            # 带上场景名，避免 stream 场景命中 query 场景留下的回答缓存
+            q = f"{q}（{scenario}#{i}）"
+        return {"graph_id": self.graph_ids[i % len(self.graph_ids)], "query": q, "mode": a.mode}
+
+    async def scenario_query(self, i: int) -> int:
+        async with self.session.post(f"{self.base}/api/query", json=self._question(i, "query")) as r:
+            await r.read()
+            return r.status
+
+    async def scenario_stream(self, i: int) -> int:
+        async with self.session.post(f"{self.base}/api/query/stream", json=self._question(i, "stream")) as r:
+            body = await r.text()
+            if r.status == 200 and "event: error" in body:
+                return 500
+            return r.status
+
+    async def scenario_graphs(self, i: int) -> int:
+        headers = {}
+        if self.args.etag and getattr(self, "_etag", None):
+            headers["If-None-Match"] = self._etag
+        async with self.session.get(f"{self.base}/api/graphs_with_usage", headers=headers) as r:
+            await r.read()
+            self._etag = r.headers.get("ETag")
+            return r.status
+
+    async def scenario_ingest(self, i: int) -> int:
+        self.ingest_seed += 1
+        docs = make_documents(self.args.ingest_docs, self.args.entities, seed=self.ingest_seed)
+        graph_id = self.graph_ids[i % len(self.graph_ids)]
+        form = self._docs_form(docs)
+        async with self.session.post(
+            f"{self.base}/api/admin/graphs/{graph_id}/update", data=form, headers=self.admin_headers
+        ) as r:
+            if r.status != 200:
+                return r.status
+            job_id = (await r.json())["job_id"]
+        job = await self.wait_job(job_id)
+        return 200 if job.get("status") == "succeeded" else 500
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    procs = Processes(args)
+    procs.start()
+    result: Dict[str, Any] = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        "scenarios": {},
+    }
+    try:
+        timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            bench = Bench(args, procs, session)
+            await bench.wait_ready()
+            await bench.login()
+            print(f"导入 {args.graphs} 个合成图谱（每个 {args.docs} 篇）…", file=sys.stderr)
+            result["setup"] = await bench.setup_graphs()
+            for name in args.scenarios:
+                print(f"场景 {name}：并发 {args.concurrency}…", file=sys.stderr)
+                stats = await bench.drive(name, getattr(bench, f"scenario_{name}"))
+                result["scenarios"][name] = stats
+                print(
+                    f"  {stats['requests']} 次，RPS {stats['rps']}，p50 {stats['latency_ms']['p50']} ms，"
+                    f"p95 {stats['latency_ms']['p95']} ms，p99 {stats['latency_ms']['p99']} ms，错误 {stats['errors']}",
+                    file=sys.stderr,
+                )
+    finally:
+        procs.stop()
+    return result
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m bench.run", description="离线压测（假上游 + 合成图谱）")
+    parser.add_argument("--scenarios", default="query,graphs", help=f"逗号分隔：{', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="每个场景的请求数")
+    parser.add_argument("--duration", type=float, default=0, help="每个场景最长秒数（0 表示只按请求数）")
+    parser.add_argument("--graphs", type=int, default=2, help="合成图谱数")
+    parser.add_argument("--docs", type=int, default=20, help="每个合成图谱的文档数")
+    parser.add_argument("--entities", type=int, default=300, help="实体编号范围")
+    parser.add_argument("--ingest-docs", type=int, default=5, help="ingest 场景每次上传的文档数")
+    parser.add_argument("--mode", default="hybrid")
+    parser.add_argument("--repeat", type=int, default=0, help="问题在前 N 个之间循环（0 表示每次都不同）")
+    parser.add_argument("--etag", action="store_true", help="graphs 场景带 If-None-Match")
+    parser.add_argument("--llm-latency-ms", type=float, default=fake_upstream.FakeConfig.llm_latency_ms)
+    parser.add_argument("--embedding-latency-ms", type=float, default=fake_upstream.FakeConfig.embedding_latency_ms)
+    parser.add_argument("--rerank-latency-ms", type=float, default=fake_upstream.FakeConfig.rerank_latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="假上游返回 503 的比例")
+    parser.add_argument(
+        "--llm-max-concurrency", type=int, default=0, help="假 DeepSeek 同时处理的请求上限，超过返回 429（0 表示不限）"
+    )
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给后端的配置，可重复")
+    parser.add_argument("--request-timeout", type=float, default=600)
+    parser.add_argument("--verbose", action="store_true", help="输出后端与假上游的日志")
+    parser.add_argument("--keep-data", action="store_true", help="保留临时数据目录")
+    parser.add_argument("--output", help="结果 JSON 路径（默认输出到标准输出）")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        print(f"未知场景：{', '.join(unknown)}（可选 {', '.join(SCENARIOS)}）", file=sys.stderr)
+        return 1
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+        print(f"结果：{args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
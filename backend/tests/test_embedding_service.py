@@ -0,0 +1,42 @@
+"""EmbeddingService 的合批与进行中请求共用"""
+import asyncio
+import unittest
+
+import numpy as np
+
+from app.embedding_service import EmbeddingService
+
+
+class SharedInflightTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.service = EmbeddingService()
+        self.service.cache_enabled = False
+        self.release = asyncio.Event()
+        self.calls = 0
+
+    async def _embed(self, texts):
+        self.calls += 1
+        await self.release.wait()
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+    async def test_cancelled_caller_does_not_cancel_others(self):
+        a = asyncio.create_task(self.service.embed(["same"], "m", self._embed))
+        b = asyncio.create_task(self.service.embed(["same"], "m", self._embed))
+        await asyncio.sleep(0.05)
+        a.cancel()
+        await asyncio.sleep(0)
+        self.release.set()
+        result = await asyncio.wait_for(b, 5)
+        self.assertEqual(result.shape, (1, 4))
+        self.assertTrue(a.cancelled())
+        self.assertEqual(self.calls, 1)
+
+    async def test_same_text_is_sent_once(self):
+        self.release.set()
+        results = await asyncio.gather(*(self.service.embed(["x", "y"], "m", self._embed) for _ in range(3)))
+        self.assertEqual([r.shape for r in results], [(2, 4)] * 3)
+        self.assertEqual(self.service.upstream_texts, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -57,6 +57,22 @@ export const adminUpdateGraph = (graphId, files) => {
     timeout: 300000,
   }).then(r => r.data)
 }
+// 后台导入任务：创建图谱 / 增量更新返回 job_id，轮询直到结束；失败或取消时抛出带 detail 的错误
+export const adminGetJob = (jobId) =>
+  api.get(`/admin/jobs/${jobId}`, { headers: authHeaders() }).then(r => r.data)
+export const adminWaitJob = async (jobId, intervalMs = 2000) => {
+  for (;;) {
+    const job = await adminGetJob(jobId)
+    if (job.status === 'succeeded') return job
+    if (job.status === 'failed' || job.status === 'cancelled') {
+      const detail = job.status === 'cancelled' ? '任务已取消' : (job.error || '导入失败')
+      throw { response: { data: { detail } } }
+    }
+    await new Promise(resolve => setTimeout(resolve, intervalMs))
+  }
+}
+export const adminCancelJob = (jobId) =>
+  api.post(`/admin/jobs/${jobId}/cancel`, null, { headers: authHeaders() }).then(r => r.data)
 export const adminDeleteGraph = (graphId) =>
   api.delete(`/admin/graphs/${graphId}`, { headers: authHeaders() }).then(r => r.data)
 export const adminPatchGraph = (graphId, data) =>
@@ -73,8 +89,11 @@ export const adminPatchEnv = (env) =>
 // 账号管理（管理员）
 export const adminGetUsers = (search) =>
   api.get('/admin/users', { params: search ? { search } : {}, headers: authHeaders() }).then(r => r.data)
-export const adminGetUserHistory = (userId) =>
-  api.get(`/admin/users/${userId}/history`, { headers: authHeaders() }).then(r => r.data)
+// params 含 limit 时分页返回 { items, next_cursor }；summary: true 时回答被截断，完整内容用 adminGetUserHistoryItem 获取
+export const adminGetUserHistory = (userId, params) =>
+  api.get(`/admin/users/${userId}/history`, { params: params || {}, headers: authHeaders() }).then(r => r.data)
+export const adminGetUserHistoryItem = (userId, historyId) =>
+  api.get(`/admin/users/${userId}/history/${historyId}`, { headers: authHeaders() }).then(r => r.data)
 export const adminUpdateUserPassword = (userId, newPassword) =>
   api.patch(`/admin/users/${userId}/password`, { new_password: newPassword }, { headers: authHeaders() }).then(r => r.data)
 export const adminDeleteUser = (userId) =>